@@ -1,12 +1,249 @@
 #include "pybind11/pybind11.h"
 #include "pybind11/stl.h"
 #include "pybind11/eigen.h"
+#include "pybind11/numpy.h"
 #include "multicopterDynamicsSim.hpp"
 
+#include <algorithm>
+#include <cmath>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
 namespace py = pybind11;
 
 void bind_MulticopterDynamicsSim(py::module &m);
 
+// Native closed-loop rollout, mirrors TrajectorySimulation.simulation_core with
+// UAV_pid_tracking and MulticopterModel.proceed_motor_speed step for step.
+namespace rollout {
+
+typedef Eigen::Matrix<double, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> RowMatrixXd;
+
+// Quaternion helpers (w, x, y, z), same arithmetic as pyTrajectoryUtils.utils
+Eigen::Vector4d mulQuat(const Eigen::Vector4d & q1, const Eigen::Vector4d & q0) {
+    Eigen::Vector4d q;
+    q << -q1[1]*q0[1] - q1[2]*q0[2] - q1[3]*q0[3] + q1[0]*q0[0],
+        q1[1]*q0[0] + q1[2]*q0[3] - q1[3]*q0[2] + q1[0]*q0[1],
+        -q1[1]*q0[3] + q1[2]*q0[0] + q1[3]*q0[1] + q1[0]*q0[2],
+        q1[1]*q0[2] - q1[2]*q0[1] + q1[3]*q0[0] + q1[0]*q0[3];
+    return q;
+}
+
+Eigen::Vector4d invQuat(const Eigen::Vector4d & q) {
+    Eigen::Vector4d q_inv(q[0], -q[1], -q[2], -q[3]);
+    return q_inv/(q[0]*q[0] + q[1]*q[1] + q[2]*q[2] + q[3]*q[3]);
+}
+
+Eigen::Vector4d vecvec2quat(const Eigen::Vector3d & vec1, const Eigen::Vector3d & vec2) {
+    Eigen::Vector4d q;
+    q[0] = std::sqrt(vec1.dot(vec1)*vec2.dot(vec2)) + vec1.dot(vec2);
+    if (q[0] < 1e-6) {
+        q[0] = 0.;
+        if (std::fabs(vec1[0]) > std::fabs(vec1[2])) {
+            q[1] = -vec1[1]; q[2] = vec1[0]; q[3] = 0.;
+        } else {
+            q[1] = 0.; q[2] = -vec1[2]; q[3] = vec1[1];
+        }
+    } else {
+        q[1] = vec1[1]*vec2[2] - vec1[2]*vec2[1];
+        q[2] = vec1[2]*vec2[0] - vec1[0]*vec2[2];
+        q[3] = vec1[0]*vec2[1] - vec1[1]*vec2[0];
+    }
+    return q/std::sqrt(q[0]*q[0] + q[1]*q[1] + q[2]*q[2] + q[3]*q[3]);
+}
+
+Eigen::Vector3d quatRotate(const Eigen::Vector4d & q, const Eigen::Vector3d & v) {
+    double invNormSq = 1./(q[0]*q[0] + q[1]*q[1] + q[2]*q[2] + q[3]*q[3]);
+    Eigen::Vector3d out;
+    out[0] = (v[0]*q[0]*q[0] - 2.*v[2]*q[0]*q[2] + 2.*v[1]*q[0]*q[3] +
+              v[0]*q[1]*q[1] + 2.*v[1]*q[1]*q[2] + 2.*v[2]*q[1]*q[3] -
+              v[0]*q[2]*q[2] - v[0]*q[3]*q[3])*invNormSq;
+    out[1] = (v[1]*q[0]*q[0] + 2.*v[2]*q[0]*q[1] - 2.*v[0]*q[0]*q[3] -
+              v[1]*q[1]*q[1] + 2.*v[0]*q[1]*q[2] + v[1]*q[2]*q[2] +
+              2.*v[2]*q[2]*q[3] - v[1]*q[3]*q[3])*invNormSq;
+    // v[2]*q[2] (not squared) kept as in quat_rotate
+    out[2] = (v[2]*q[0]*q[0] - 2.*v[1]*q[0]*q[1] + 2.*v[0]*q[0]*q[2] -
+              v[2]*q[1]*q[1] + 2.*v[0]*q[1]*q[3] - v[2]*q[2] +
+              2.*v[1]*q[2]*q[3] + v[2]*q[3]*q[3])*invNormSq;
+    return out;
+}
+
+Eigen::Vector3d quat2Euler(const Eigen::Vector4d & q) {
+    Eigen::Vector3d att;
+    att[0] = std::atan2(2.*(q[0]*q[1] + q[2]*q[3]), 1. - 2.*(q[1]*q[1] + q[2]*q[2]));
+    double sinp = 2.*(q[0]*q[2] - q[3]*q[1]);
+    if (std::fabs(sinp) >= 1.)
+        att[1] = std::copysign(M_PI/2., sinp);
+    else
+        att[1] = std::asin(sinp);
+    att[2] = std::atan2(2.*(q[0]*q[3] + q[1]*q[2]), 1. - 2.*(q[2]*q[2] + q[3]*q[3]));
+    return att;
+}
+
+Eigen::Vector4d euler2Quat(const Eigen::Vector3d & att) {
+    double cr = std::cos(att[0]/2), sr = std::sin(att[0]/2);
+    double cp = std::cos(att[1]/2), sp = std::sin(att[1]/2);
+    double cy = std::cos(att[2]/2), sy = std::sin(att[2]/2);
+    Eigen::Vector4d q;
+    q << cy*cp*cr + sy*sp*sr,
+        sr*cp*cy - cr*sp*sy,
+        cr*sp*cy + sr*cp*sy,
+        cr*cp*sy - sr*sp*cy;
+    return q;
+}
+
+template <int Dim>
+struct LowPassFilter {
+    typedef Eigen::Matrix<double, Dim, 1> Vec;
+    double gainP, gainQ;
+    Vec state, stateDer;
+
+    void proceedState(const Vec & input, double dt) {
+        double det = gainP*dt*dt + gainQ*dt + 1.;
+        Vec der = (stateDer + gainP*dt*input)/det - (dt*gainP*state)/det;
+        state = (dt*(stateDer + gainP*dt*input))/det + ((dt*gainQ + 1.)*state)/det;
+        stateDer = der;
+    }
+};
+
+// UAV_pid_tracking.control_update, vector bounds are broadcast to 3 by the caller
+struct TrackingController {
+    double vehicleMass;
+    Eigen::Vector3d vehicleInertia;
+    Eigen::Matrix4d invG1;
+    Eigen::Vector3d positionPGain, positionDGain, positionIGain;
+    Eigen::Vector3d velocityPGain, velocityDGain;
+    Eigen::Vector3d maxVelocityPosError, maxVelocityCommand, maxAccelerationCommand, maxAngrate;
+    Eigen::Vector3d attitudeGain, thrustDirection;
+    Eigen::Vector3d propGain, intGain, derGain, intBound;
+    Eigen::Vector3d intState, positionErrorIntegrator;
+
+    explicit TrackingController(const py::dict & gains) {
+        vehicleMass = gains["vehicleMass"].cast<double>();
+        vehicleInertia = gains["vehicleInertia"].cast<Eigen::Vector3d>();
+        positionPGain = gains["positionPGain"].cast<Eigen::Vector3d>();
+        positionDGain = gains["positionDGain"].cast<Eigen::Vector3d>();
+        positionIGain = gains["positionIGain"].cast<Eigen::Vector3d>();
+        velocityPGain = gains["velocityPGain"].cast<Eigen::Vector3d>();
+        velocityDGain = gains["velocityDGain"].cast<Eigen::Vector3d>();
+        maxVelocityPosError = gains["maxVelocityPosError"].cast<Eigen::Vector3d>();
+        maxVelocityCommand = gains["maxVelocityCommand"].cast<Eigen::Vector3d>();
+        maxAccelerationCommand = gains["maxAccelerationCommand"].cast<Eigen::Vector3d>();
+        maxAngrate = gains["maxAngrate"].cast<Eigen::Vector3d>();
+        attitudeGain = gains["attitudeGain"].cast<Eigen::Vector3d>();
+        thrustDirection = gains["thrustDirection"].cast<Eigen::Vector3d>();
+        propGain = gains["propGain"].cast<Eigen::Vector3d>();
+        intGain = gains["intGain"].cast<Eigen::Vector3d>();
+        derGain = gains["derGain"].cast<Eigen::Vector3d>();
+        intBound = gains["intBound"].cast<Eigen::Vector3d>();
+        intState = gains["intState"].cast<Eigen::Vector3d>();
+        positionErrorIntegrator = gains["positionErrorIntegrator"].cast<Eigen::Vector3d>();
+
+        double momentArm = gains["momentArm"].cast<double>();
+        double thrustCoeff = gains["thrustCoeff"].cast<double>();
+        double torqueCoeff = gains["torqueCoeff"].cast<double>();
+        double invG1xy = 1./(4.*thrustCoeff*momentArm);
+        double invG1z = 1./(4.*torqueCoeff);
+        double invG1t = 1./(4.*thrustCoeff);
+        invG1 <<  invG1xy,  invG1xy, -invG1z, -invG1t,
+                 -invG1xy,  invG1xy,  invG1z, -invG1t,
+                 -invG1xy, -invG1xy, -invG1z, -invG1t,
+                  invG1xy, -invG1xy,  invG1z, -invG1t;
+    }
+
+    static Eigen::Vector3d saturate(const Eigen::Vector3d & vec, const Eigen::Vector3d & bound) {
+        return vec.cwiseMin(bound).cwiseMax(-bound);
+    }
+
+    Eigen::Vector4d controlUpdate(const Eigen::Ref<const Eigen::VectorXd> & ref,
+        const Eigen::Vector3d & curpos, const Eigen::Vector3d & curvel, const Eigen::Vector3d & curacc,
+        const Eigen::Vector3d & curatt, const Eigen::Vector3d & curattVel, const Eigen::Vector3d & curattAcc,
+        double dt) {
+        Eigen::Vector3d pos_err = ref.segment<3>(0) - curpos;
+        positionErrorIntegrator += dt*pos_err;
+        Eigen::Vector3d vel_err = ref.segment<3>(3) - curvel;
+
+        Eigen::Vector3d vel_cmd = positionPGain.cwiseProduct(saturate(pos_err, maxVelocityPosError))
+            + positionDGain.cwiseProduct(vel_err)
+            + positionIGain.cwiseProduct(positionErrorIntegrator);
+        vel_err += saturate(vel_cmd, maxVelocityCommand);
+
+        Eigen::Vector3d acc_err = ref.segment<3>(6) - curacc;
+        Eigen::Vector3d acc_cmd = velocityPGain.cwiseProduct(vel_err) + velocityDGain.cwiseProduct(acc_err);
+        acc_cmd = saturate(acc_cmd, maxAccelerationCommand);
+        acc_cmd[2] -= 9.81;
+        Eigen::Vector3d thrust_cmd = vehicleMass*acc_cmd;
+
+        Eigen::Vector4d att_ref = euler2Quat(Eigen::Vector3d(0., 0., ref[15]));
+        Eigen::Vector4d att_cur = euler2Quat(curatt);
+        Eigen::Vector4d thrust_rot = vecvec2quat(thrustDirection, quatRotate(att_ref, thrust_cmd));
+        Eigen::Vector4d att_cmd = mulQuat(att_ref, thrust_rot);
+
+        Eigen::Vector4d att_error = mulQuat(invQuat(att_cur), att_cmd);
+        if (att_error[0] < 0.)
+            att_error *= -1.;
+        Eigen::Vector3d angrate_cmd = quat2Euler(att_error).cwiseProduct(attitudeGain);
+
+        double thrustCommand = thrust_cmd.norm();
+        Eigen::Vector3d stateDev = saturate(angrate_cmd, maxAngrate) - curattVel;
+        intState += dt*stateDev;
+        intState = intState.cwiseMax(-intBound).cwiseMin(intBound);
+        Eigen::Vector3d angAccCommand = propGain.cwiseProduct(stateDev)
+            + intGain.cwiseProduct(intState) - derGain.cwiseProduct(curattAcc);
+
+        // thrust_mixing
+        Eigen::Vector4d momentThrust;
+        momentThrust << vehicleInertia.cwiseProduct(angAccCommand), -thrustCommand;
+        Eigen::Vector4d motorSpeedsSquared = invG1*momentThrust;
+        Eigen::Vector4d propSpeedCommand;
+        for (int i = 0; i < 4; i++)
+            propSpeedCommand[i] = std::copysign(std::sqrt(std::fabs(motorSpeedsSquared[i])), motorSpeedsSquared[i]);
+        return propSpeedCommand;
+    }
+};
+
+// Caller-provided trace arrays (any row stride, e.g. fields of a structured array), written in place
+struct TraceBuffer {
+    double * data = nullptr;
+    py::ssize_t rows = 0, dim = 0, rowStride = 0, colStride = 0;
+
+    TraceBuffer(const py::dict & buffers, const char * key, py::ssize_t dim_) {
+        if (!buffers.contains(key))
+            return;
+        py::object obj = buffers[key];
+        if (!py::isinstance<py::array_t<double>>(obj))
+            throw std::invalid_argument(std::string("rollout buffer ") + key + " must be a float64 array");
+        py::array buf = py::reinterpret_borrow<py::array>(obj);
+        if (!buf.writeable())
+            throw std::invalid_argument(std::string("rollout buffer ") + key + " is read-only");
+        py::ssize_t buf_dim = (buf.ndim() > 1) ? buf.shape(1) : 1;
+        if (buf.ndim() > 2 || buf_dim != dim_)
+            throw std::invalid_argument(std::string("rollout buffer ") + key + " has a wrong shape");
+        data = static_cast<double *>(buf.mutable_data());
+        rows = buf.shape(0);
+        dim = dim_;
+        rowStride = buf.strides(0)/py::ssize_t(sizeof(double));
+        colStride = (buf.ndim() > 1) ? buf.strides(1)/py::ssize_t(sizeof(double)) : 1;
+    }
+
+    template <typename Derived>
+    void write(py::ssize_t it, const Eigen::MatrixBase<Derived> & vec) {
+        if (data == nullptr || it >= rows)
+            return;
+        for (py::ssize_t i = 0; i < dim; i++)
+            data[it*rowStride + i*colStride] = vec[i];
+    }
+
+    void write(py::ssize_t it, double val) {
+        if (data == nullptr || it >= rows)
+            return;
+        data[it*rowStride] = val;
+    }
+};
+
+} // namespace rollout
+
 PYBIND11_MODULE(multicopter_dynamics_sim, m) {
     m.doc() = "Python package of multicopterDynamicsSim";
     bind_MulticopterDynamicsSim(m);
@@ -66,8 +303,8 @@ void bind_MulticopterDynamicsSim(py::module &m) {
             py::arg("forceProcessNoiseAutoCorrelation")=0.0005,
             py::arg("gravity")=Eigen::Vector3d(0.,0.,9.81))
         .def(py::init<int>(), py::arg("numCopter"))
-//         .def("setRandomSeed", &MulticopterDynamicsSim::setRandomSeed, "set random seed",
-//             py::arg("multicopterSeed"), py::arg("imuSeed"))
+        .def("setRandomSeed", &MulticopterDynamicsSim::setRandomSeed, "set random seed",
+            py::arg("multicopterSeed"), py::arg("imuSeed"))
         .def("setVehicleProperties", &MulticopterDynamicsSim::setVehicleProperties, "set vehicle properties",
             py::arg("vehicleMass"), py::arg("vehicleInertia"), py::arg("aeroMomentCoefficient"), 
             py::arg("dragCoefficient"), 
@@ -149,6 +386,148 @@ void bind_MulticopterDynamicsSim(py::module &m) {
             return vec;
             }, "get vehicle state")
 
+        .def("rollout", [](MulticopterDynamicsSim & multicopterSim,
+            const Eigen::Ref<const rollout::RowMatrixXd> & reference,
+            py::dict controller_gains, double freq_ctrl, py::dict abort_thresholds,
+            py::dict state, py::dict buffers, int N_step) {
+            // reference: (N_step or N_step+1, 18) rows of status_ref[:,2:], an extra row is the
+            //     lookahead for the tracking errors of the last step.
+            // controller_gains: UAV_pid_tracking gains, intState and positionErrorIntegrator are updated.
+            // abort_thresholds: maxPosErr, minPosErr, maxYawErr, minYawErr (cosine of the yaw bounds).
+            // state: MulticopterModel state (get_state keys, LPF derivatives, clocks) and the running
+            //     posErr, yawErr, posErrMax, yawErrMax, failureStartIdx, idxOffset, all updated in place.
+            // buffers: trace name -> float64 array (row stride free), written row by row.
+            // Returns (number of steps run, local failure index or -1).
+            rollout::TrackingController controller(controller_gains);
+            rollout::TraceBuffer bufPos(buffers, "pos", 3), bufVel(buffers, "vel", 3), bufAcc(buffers, "acc", 3),
+                bufAtt(buffers, "att", 3), bufAttQ(buffers, "att_q", 4),
+                bufAccRaw(buffers, "acc_raw", 3), bufGyroRaw(buffers, "gyro_raw", 3),
+                bufAccLpf(buffers, "acc_lpf", 3), bufGyroLpf(buffers, "gyro_lpf", 3),
+                bufMs(buffers, "ms", 4), bufMsC(buffers, "ms_c", 4),
+                bufPosErr(buffers, "pos_err", 1), bufYawErr(buffers, "yaw_err", 1);
+            double maxPosErr = abort_thresholds["maxPosErr"].cast<double>();
+            double minPosErr = abort_thresholds["minPosErr"].cast<double>();
+            double maxYawErr = abort_thresholds["maxYawErr"].cast<double>();
+            double minYawErr = abort_thresholds["minYawErr"].cast<double>();
+
+            double simFreq = state["simFreq"].cast<double>();
+            double imuFreq = state["imuFreq"].cast<double>();
+            double simTime = state["simTime"].cast<double>();
+            double simTimeDynamics = state["simTimeDynamics"].cast<double>();
+            double imuTime = state["imuTime"].cast<double>();
+            double gainP = state["lpfGainP"].cast<double>();
+            double gainQ = state["lpfGainQ"].cast<double>();
+            rollout::LowPassFilter<3> lpfAcc{gainP, gainQ,
+                state["acceleration"].cast<Eigen::Vector3d>(), state["accelerationDer"].cast<Eigen::Vector3d>()};
+            rollout::LowPassFilter<3> lpfGyro{gainP, gainQ,
+                state["angular_velocity"].cast<Eigen::Vector3d>(), state["angular_acceleration"].cast<Eigen::Vector3d>()};
+            rollout::LowPassFilter<4> lpfMs{gainP, gainQ,
+                state["motor_speed"].cast<Eigen::Vector4d>(), state["motor_acceleration"].cast<Eigen::Vector4d>()};
+
+            Eigen::Vector3d pos = state["position"].cast<Eigen::Vector3d>();
+            Eigen::Vector3d vel = state["velocity"].cast<Eigen::Vector3d>();
+            Eigen::Vector3d att = state["attitude_euler_angle"].cast<Eigen::Vector3d>();
+            Eigen::Vector4d att_q = state["attitude"].cast<Eigen::Vector4d>();
+            Eigen::Vector3d accRaw = state["acceleration_raw"].cast<Eigen::Vector3d>();
+            Eigen::Vector3d gyroRaw = state["gyroscope_raw"].cast<Eigen::Vector3d>();
+            Eigen::Vector3d angVRaw = Eigen::Vector3d::Zero();
+            Eigen::Quaterniond attitude;
+            std::vector<double> motorSpeed = state["motor_speed_raw"].cast<std::vector<double>>();
+
+            double posErr = state["posErr"].cast<double>();
+            double yawErr = state["yawErr"].cast<double>();
+            double posErrMax = state["posErrMax"].cast<double>();
+            double yawErrMax = state["yawErrMax"].cast<double>();
+            int failureStartIdx = state["failureStartIdx"].cast<int>();
+            int idxOffset = state["idxOffset"].cast<int>();
+            int failureIdx = -1;
+
+            double dt = 1.0/freq_ctrl;
+            std::vector<double> motorCommand(4);
+            int it = 0;
+            for (; it < N_step; it++) {
+                Eigen::Vector4d ms_c = controller.controlUpdate(reference.row(it).transpose(),
+                    pos, vel, lpfAcc.state, att, lpfGyro.state, lpfGyro.stateDer, dt);
+                for (int i = 0; i < 4; i++)
+                    motorCommand[i] = ms_c[i];
+
+                // MulticopterModel.proceed_motor_speed
+                simTime += dt;
+                while (simTime > simTimeDynamics + 1./simFreq) {
+                    multicopterSim.proceedState_RK4(1./simFreq, motorCommand);
+                    simTimeDynamics += 1./simFreq;
+                    if (simTimeDynamics >= imuTime) {
+                        multicopterSim.getIMUMeasurement(accRaw, gyroRaw);
+                        lpfAcc.proceedState(accRaw, 1./imuFreq);
+                        lpfGyro.proceedState(gyroRaw, 1./imuFreq);
+                        imuTime += 1./imuFreq;
+                    }
+                    multicopterSim.getVehicleState(pos, vel, angVRaw, attitude, motorSpeed);
+                    att_q << attitude.w(), attitude.x(), attitude.y(), attitude.z();
+                    att = rollout::quat2Euler(att_q);
+                    lpfMs.proceedState(Eigen::Map<Eigen::Vector4d>(motorSpeed.data()), 1./simFreq);
+                }
+
+                bufPos.write(it, pos);
+                bufVel.write(it, vel);
+                bufAcc.write(it, lpfAcc.state);
+                bufAtt.write(it, att);
+                bufAttQ.write(it, att_q);
+                bufAccRaw.write(it, accRaw);
+                bufGyroRaw.write(it, gyroRaw);
+                bufAccLpf.write(it, lpfAcc.state);
+                bufGyroLpf.write(it, lpfGyro.state);
+                bufMs.write(it, lpfMs.state);
+                bufMsC.write(it, ms_c);
+
+                if (it+1 < reference.rows()) {
+                    double yaw_next = reference(it+1, 15);
+                    posErr = (reference.row(it+1).segment<3>(0).transpose() - pos).norm();
+                    yawErr = std::max(std::cos(yaw_next - att[2]), std::cos(M_PI - yaw_next + att[2]));
+                    posErrMax = std::max(posErrMax, posErr);
+                    yawErrMax = std::max(yawErrMax, std::acos(yawErr));
+                    bufPosErr.write(it+1, posErr);
+                    bufYawErr.write(it+1, std::acos(yawErr));
+                }
+                if ((posErr > minPosErr || yawErr < minYawErr) && failureStartIdx == -1)
+                    failureStartIdx = idxOffset + it;
+                if ((posErr < minPosErr && yawErr > minYawErr) && failureStartIdx != -1)
+                    failureStartIdx = -1;
+                if (posErr > maxPosErr || yawErr < maxYawErr) {
+                    failureIdx = it;
+                    it++;
+                    break;
+                }
+            }
+
+            controller_gains["intState"] = controller.intState;
+            controller_gains["positionErrorIntegrator"] = controller.positionErrorIntegrator;
+            state["simTime"] = simTime;
+            state["simTimeDynamics"] = simTimeDynamics;
+            state["imuTime"] = imuTime;
+            state["position"] = pos;
+            state["velocity"] = vel;
+            state["attitude"] = att_q;
+            state["attitude_euler_angle"] = att;
+            state["acceleration_raw"] = accRaw;
+            state["gyroscope_raw"] = gyroRaw;
+            state["acceleration"] = lpfAcc.state;
+            state["accelerationDer"] = lpfAcc.stateDer;
+            state["angular_velocity"] = lpfGyro.state;
+            state["angular_acceleration"] = lpfGyro.stateDer;
+            state["motor_speed_raw"] = Eigen::VectorXd(Eigen::Map<Eigen::VectorXd>(motorSpeed.data(), motorSpeed.size()));
+            state["motor_speed"] = lpfMs.state;
+            state["motor_acceleration"] = lpfMs.stateDer;
+            state["posErr"] = posErr;
+            state["yawErr"] = yawErr;
+            state["posErrMax"] = posErrMax;
+            state["yawErrMax"] = yawErrMax;
+            state["failureStartIdx"] = failureStartIdx;
+            return py::make_tuple(it, failureIdx);
+            }, "closed-loop UAV_pid_tracking rollout over a reference, see pyMulticopterSim MulticopterModel.rollout_tracking",
+            py::arg("reference"), py::arg("controller_gains"), py::arg("freq_ctrl"),
+            py::arg("abort_thresholds"), py::arg("state"), py::arg("buffers"), py::arg("N_step"))
+
         .def("getVehiclePosition", &MulticopterDynamicsSim::getVehiclePosition, "get vehicle position")
         .def("getVehicleVelocity", &MulticopterDynamicsSim::getVehicleVelocity, "get vehicle velocity")
         .def("getVehicleAttitude", &MulticopterDynamicsSim::getVehicleAttitude, "get vehicle attitude")
@@ -3,6 +3,8 @@
 
 import os, sys
 import copy
+import multiprocessing
+from collections import OrderedDict
 import numpy as np
 # import pandas as pd
 import scipy
@@ -15,6 +17,8 @@ from pyDOE import lhs
 # from mpl_toolkits.mplot3d import Axes3D
 from cvxpy import *
 import cvxpy as cp
+import osqp
+from scipy import sparse
 # import plotly
 import plotly.graph_objects as go
 from scipy.interpolate import interp1d
@@ -22,18 +26,82 @@ from scipy.interpolate import interp1d
 # from pyTrajectoryUtils.pyTrajectoryUtils.quadModel import QuadModel
 from pyTrajectoryUtils.pyTrajectoryUtils.utils import *
 from pyTrajectoryUtils.pyTrajectoryUtils.minSnapTrajectory import MinSnapTrajectory
+from mfboTrajectory.utilsConvexDecomp import CompiledCourse
+
+# snap_acc_obj options of update_traj, shared with update_traj_batch and its ray memo keys
+UPDATE_TRAJ_OPTIONS = dict( \
+    deg_init_min=0, deg_init_max=4, deg_end_min=0, deg_end_max=2, \
+    deg_init_yaw_min=0, deg_init_yaw_max=4, deg_end_yaw_min=0, deg_end_yaw_max=2, \
+    flag_init_point=True)
 
 class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
     def __init__(self, *args, **kwargs):
         """
         yaw_mode (int): The mode for yaw control.
         qp_optimizer (str): The quadratic programming optimizer to use.
+            'osqp', 'gurobi', 'cvxopt' solve through cvxpy, 'osqp_native' keeps a sparse OSQP workspace per course.
         default_t_set_scale (float): The default scale for the time set. Default is 1.0.
+        flag_compiled_qp (bool): Reuse the parametrized corridor QP across calls. Default is True.
+        flag_t_scale_memory (bool): Start snap_obj from the t_scale that last succeeded on the course. Default is True.
+        flag_lazy_corridor (bool): Add corridor rows lazily as cutting planes. Always solved with a native
+            OSQP workspace per course, whatever qp_optimizer is. Default is False.
+        lazy_stride (int): Sample stride of the initial corridor rows in lazy mode. Default is 20.
+        lazy_max_round (int): Maximum number of cutting plane rounds in lazy mode. Default is 20.
+        corridor_mode (str): 'sample' constrains N_POINTS samples per segment, 'bernstein' constrains
+            the MAX_POLY_DEG+1 Bernstein control points, which bounds the whole segment. Default is 'sample'.
+            CompiledCourse.corridor_mode overrides it per course.
+        course_cache_size (int): Number of courses kept compiled by get_compiled_course (LRU). Default is 64.
+        qp_cache_size (int): Number of compiled corridor QPs and lazy row masks kept per cache (LRU). Default is 64.
+        flag_traj_memo (bool): Memoize update_traj results in an LRU cache. Default is True.
+        traj_memo_max_bytes (int): Memory cap of the update_traj memo. Default is 256MB.
+        traj_memo_quantum (float): Quantization of alpha in the memo key. Default is 1e-9.
+        flag_feas_index (bool): Classify sanity_check_batch samples from the per-direction
+            feasibility bracket when it decides them. Default is False, labels come from sanity_check.
+        feas_index_quantum (float): Quantization of the normalized time direction in the index key. Default is 1e-4.
+        feas_index_rtol (float): Relative bracket width of the threshold search. Default is 1e-2.
+        flag_feas_index_midpoint (bool): Label samples inside a bracket narrower than feas_index_rtol
+            by the bracket midpoint (approximate) instead of evaluating them. Default is False.
+        flag_feas_search (bool): Bisect the threshold of every newly evaluated direction by rescaling
+            its trajectory, costs sanity_check calls but no QP. Default is False.
+        feas_index_max_expand (int): Maximum number of doublings/halvings to bracket the threshold. Default is 6.
         """
         super().__init__(*args, **kwargs)
         self.yaw_mode = kwargs.get('yaw_mode', 0)
         self.qp_optimizer = kwargs.get('qp_optimizer', 'osqp')
         self.default_t_set_scale = 4.0 # CHANGED FROM 1.0
+        self.flag_compiled_qp = kwargs.get('flag_compiled_qp', True)
+        self.course_cache_size = kwargs.get('course_cache_size', 64)
+        self.qp_cache_size = kwargs.get('qp_cache_size', 64)
+        self._snap_qp_cache = OrderedDict()
+        self._course_cache = OrderedDict()
+        self._snap_osqp_cache = OrderedDict()
+        self.flag_t_scale_memory = kwargs.get('flag_t_scale_memory', True)
+        self.t_scale_stats = dict()
+        self._t_scale_course = dict()
+        self.flag_lazy_corridor = kwargs.get('flag_lazy_corridor', False)
+        self.lazy_stride = kwargs.get('lazy_stride', 20)
+        self.lazy_max_round = kwargs.get('lazy_max_round', 20)
+        self.lazy_info = dict()
+        self._lazy_qp_cache = OrderedDict()
+        self.corridor_mode = kwargs.get('corridor_mode', 'sample')
+        self.flag_traj_memo = kwargs.get('flag_traj_memo', True)
+        self.traj_memo_max_bytes = kwargs.get('traj_memo_max_bytes', 256*1024*1024)
+        self.traj_memo_quantum = kwargs.get('traj_memo_quantum', 1e-9)
+        self.reset_traj_memo()
+        self.flag_feas_index = kwargs.get('flag_feas_index', False)
+        self.feas_index_quantum = kwargs.get('feas_index_quantum', 1e-4)
+        self.feas_index_rtol = kwargs.get('feas_index_rtol', 1e-2)
+        self.flag_feas_index_midpoint = kwargs.get('flag_feas_index_midpoint', False)
+        self.flag_feas_search = kwargs.get('flag_feas_search', False)
+        self.feas_index_max_expand = kwargs.get('feas_index_max_expand', 6)
+        self.reset_feas_index()
+        
+        # Monomial to Bernstein coefficients, b_j = sum_{k<=j} comb(j,k)/comb(deg,k)*c_k
+        deg = self.MAX_POLY_DEG
+        idx = np.arange(deg+1)
+        bernstein_mat = comb(idx[:,None], idx[None,:])/comb(deg, idx)[None,:]
+        self.v0_bernstein = bernstein_mat.dot(self.v0_mat[0,:,:].T)
+        self.v1_bernstein = bernstein_mat.dot(self.v1_mat[0,:,:].T)
         
     ###############################################################################
     def save_trajectory_yaml(self, t_set, d_ordered, d_ordered_yaw=None, \
@@ -79,391 +147,1107 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         return
     
     ###############################################################################
-    def sanity_check(self, t_set, d_ordered, d_ordered_yaw=None, flag_parallel=False):
-        flag_loop = self.check_flag_loop(t_set,d_ordered)
-        N_POLY = t_set.shape[0]
-        
-        status = np.zeros((self.N_POINTS*N_POLY,18))
+    def get_status(self, t_set, d_ordered, d_ordered_yaw=None):
+        """Flat output samples used by sanity_check
 
-        for der in range(5):
-            if flag_loop:
-                V_t = self.generate_sampling_matrix_loop(t_set, N=self.N_POINTS, der=der)
-            else:
-                V_t = self.generate_sampling_matrix(t_set, N=self.N_POINTS, der=der, endpoint=True)
-            status[:,3*der:3*(der+1)] = V_t.dot(d_ordered)
+        Returns:
+            status: (N_POINTS*N_POLY, 18) np array, pos, vel, acc, jerk, snap, yaw, dyaw, ddyaw
+        """
+        flag_loop = self.check_flag_loop(t_set,d_ordered)
+        traj = self.get_piecewise_trajectory(t_set, d_ordered, d_ordered_yaw)
+        return traj.get_status(traj.get_sample_time(self.N_POINTS, endpoint=not flag_loop))
+    
+    def sanity_check(self, t_set, d_ordered, d_ordered_yaw=None, flag_parallel=False, flag_margin=False):
+        """
+        flag_parallel (bool): Use QuadModel.getWs_vector instead of the fused check_Ws_batch kernel.
+        flag_margin (bool): Also return the signed worst case motor speed margin, overall and per segment,
+            in units of w_max-w_min. Positive margins are feasible.
         
-        if np.all(d_ordered_yaw != None):
-            status_yaw_xy = np.zeros((self.N_POINTS*N_POLY,3,2))
-            for der in range(3):
-                if flag_loop:
-                    V_t = self.generate_sampling_matrix_loop_yaw(t_set, N=self.N_POINTS, der=der)
-                else:
-                    V_t = self.generate_sampling_matrix_yaw(t_set, N=self.N_POINTS, der=der, endpoint=True)
-                status_yaw_xy[:,der,:] = V_t.dot(d_ordered_yaw)
-            status[:,15:] = self.get_yaw_der(status_yaw_xy)
+        Returns:
+            flag_feasible, (margin, margin_seg (N_POLY,) np array) if flag_margin
+        """
+        status = self.get_status(t_set, d_ordered, d_ordered_yaw)
 
-        if flag_parallel:
+        if flag_margin:
+            margin_seg = np.min(self._quadModel.getWs_margin_batch(status).reshape(t_set.shape[0], self.N_POINTS), axis=1)
+            margin = np.min(margin_seg)
+            return margin > 0, margin, margin_seg
+        elif flag_parallel:
             ws, ctrl = self._quadModel.getWs_vector(status)
             if np.any(ws < self._quadModel.w_min) or np.any(ws > self._quadModel.w_max):
                 return False
         else:
-            for j in range(self.N_POINTS*N_POLY):
-                ws, ctrl = self._quadModel.getWs(status[j,:])
-                if np.any(ws < self._quadModel.w_min) or np.any(ws > self._quadModel.w_max):
-                    return False
+            flag_feasible, _ = self._quadModel.check_Ws_batch(status[np.newaxis,:,:])
+            return flag_feasible[0]
 
         return True
-    def sanity_check_multi(self, t_set1, d_ordered1, d_ordered_yaw1, t_set2, d_ordered2, d_ordered_yaw2):
-        # Drone 1
-        flag_loop = self.check_flag_loop(t_set1,d_ordered1)
-        N_POLY = t_set1.shape[0]
+    
+    def sanity_check_traj_batch(self, t_set, d_ordered, d_ordered_yaw=None, batch_size=64, flag_margin=False):
+        """sanity_check of B trajectories with one check_Ws_batch call per batch_size trajectories
         
-        status1 = np.zeros((self.N_POINTS*N_POLY,18))
-        if np.all(t_set1 == t_set2):
-            print("X_L1_t and X_L2_t are same")
-        for der in range(5):
-            if flag_loop:
-                V_t = self.generate_sampling_matrix_loop(t_set1, N=self.N_POINTS, der=der)
-            else:
-                V_t = self.generate_sampling_matrix(t_set1, N=self.N_POINTS, der=der, endpoint=True)
-            status1[:,3*der:3*(der+1)] = V_t.dot(d_ordered1)
+        flag_margin (bool): Return the signed worst case margin (B,) and per segment margin (B, N_POLY)
+            of sanity_check instead of the first violation index.
+
+        Args:
+            t_set: (B, N_POLY) np array
+            d_ordered: (B, N_DER*N_wp, 3) np array
+            d_ordered_yaw: (B, N_DER_YAW*N_wp, 2) np array or None
         
-        if np.all(d_ordered_yaw1 != None):
-            status_yaw_xy = np.zeros((self.N_POINTS*N_POLY,3,2))
-            for der in range(3):
-                if flag_loop:
-                    V_t = self.generate_sampling_matrix_loop_yaw(t_set1, N=self.N_POINTS, der=der)
+        Returns:
+            flag_feasible: (B,) bool np array
+            idx_violation: (B,) int np array, first infeasible sample of get_status, -1 if feasible
+        """
+        B = t_set.shape[0]
+        N_POLY = t_set.shape[1]
+        flag_feasible = np.zeros(B, dtype=bool)
+        idx_violation = -np.ones(B, dtype=np.int)
+        margin_seg = np.zeros((B, N_POLY))
+        for b_st in range(0, B, batch_size):
+            b_end = min(b_st+batch_size, B)
+            status = np.zeros((b_end-b_st, self.N_POINTS*t_set.shape[1], 18))
+            for b_ii in range(b_st, b_end):
+                if np.all(d_ordered_yaw != None):
+                    status[b_ii-b_st,:,:] = self.get_status(t_set[b_ii,:], d_ordered[b_ii,:,:], d_ordered_yaw[b_ii,:,:])
                 else:
-                    V_t = self.generate_sampling_matrix_yaw(t_set1, N=self.N_POINTS, der=der, endpoint=True)
-                status_yaw_xy[:,der,:] = V_t.dot(d_ordered_yaw1)
-            status1[:,15:] = self.get_yaw_der(status_yaw_xy)
-
-        flag_loop = self.check_flag_loop(t_set2,d_ordered2)
-        N_POLY = t_set2.shape[0]
-        # Drone 2
-        status2 = np.zeros((self.N_POINTS*N_POLY,18))
-
-        for der in range(5):
-            if flag_loop:
-                V_t = self.generate_sampling_matrix_loop(t_set2, N=self.N_POINTS, der=der)
+                    status[b_ii-b_st,:,:] = self.get_status(t_set[b_ii,:], d_ordered[b_ii,:,:])
+            if flag_margin:
+                margin_seg[b_st:b_end,:] = np.min( \
+                    self._quadModel.getWs_margin_batch(status).reshape(b_end-b_st, N_POLY, self.N_POINTS), axis=2)
             else:
-                V_t = self.generate_sampling_matrix(t_set2, N=self.N_POINTS, der=der, endpoint=True)
-            status2[:,3*der:3*(der+1)] = V_t.dot(d_ordered2)
+                flag_feasible[b_st:b_end], idx_violation[b_st:b_end] = self._quadModel.check_Ws_batch(status)
+        if flag_margin:
+            margin = np.min(margin_seg, axis=1)
+            return margin > 0, margin, margin_seg
+        return flag_feasible, idx_violation
+    def sanity_check_multi(self, t_set1, d_ordered1, d_ordered_yaw1, t_set2, d_ordered2, d_ordered_yaw2, min_dist=0.2, \
+                           flag_debug=False):
+        """Checks that the 2 drones keep min_dist apart over their common time window, see get_min_separation"""
+        if flag_debug and np.all(t_set1 == t_set2):
+            print("X_L1_t and X_L2_t are same")
         
-        if np.all(d_ordered_yaw2 != None):
-            status_yaw_xy = np.zeros((self.N_POINTS*N_POLY,3,2))
-            for der in range(3):
-                if flag_loop:
-                    V_t = self.generate_sampling_matrix_loop_yaw(t_set2, N=self.N_POINTS, der=der)
-                else:
-                    V_t = self.generate_sampling_matrix_yaw(t_set2, N=self.N_POINTS, der=der, endpoint=True)
-                status_yaw_xy[:,der,:] = V_t.dot(d_ordered_yaw2)
-            status2[:,15:] = self.get_yaw_der(status_yaw_xy)
-            
-        # Check if 2 drones collide. pos = np.array(status[:,0:3])
-        pos1 = np.array(status1[:,0:3])
-        pos2 = np.array(status2[:,0:3])
-        dist = np.linalg.norm(pos1 - pos2, axis=1)
-        if np.any(dist < 0.2):
-        #     print(f"Drone 1:{pos1} and 2:{pos2} collide")
+        # Check if 2 drones collide
+        dist, _ = self.get_min_separation(t_set1, d_ordered1, t_set2, d_ordered2, min_dist=min_dist)
+        if dist < min_dist:
+        #     print(f"Drone 1 and 2 collide")
             return False
         # print("No collision")
         return True
+    
+    def get_min_separation(self, t_set1, d_ordered1, t_set2, d_ordered2, min_dist=np.inf):
+        """Minimum distance between 2 position trajectories over their common time window
+
+        The window is split at the segment boundaries of both drones. Every interval is bounded
+        by the box of the Bernstein control points of p1-p2, intervals whose bound cannot go below
+        the current minimum (or min_dist) are skipped, the rest are minimized through the real
+        stationary points of |p1-p2|^2. Below min_dist the result is exact.
+
+        Returns:
+            dist: float, minimum separation
+            t_min: float, time of the minimum
+        """
+        poly_coeff1, _ = self.der_to_poly(t_set1, d_ordered1)
+        poly_coeff2, _ = self.der_to_poly(t_set2, d_ordered2)
+        T1 = np.concatenate(([0.], np.cumsum(t_set1)))
+        T2 = np.concatenate(([0.], np.cumsum(t_set2)))
+        T_end = min(T1[-1], T2[-1])
+        t_break = np.unique(np.concatenate((T1, T2)))
+        t_break = t_break[t_break <= T_end]
+        t_st = t_break[:-1]
+        h = np.diff(t_break)
+        
+        # p1-p2 per interval in the normalized local time u in [0,1], t = t_st+u*h
+        deg = self.MAX_POLY_DEG
+        k = np.arange(deg+1)
+        def get_interval_poly(poly_coeff, T):
+            seg = np.clip(np.searchsorted(T, t_st, side='right')-1, 0, poly_coeff.shape[0]-1)
+            c = t_st-T[seg]
+            # Taylor shift by c, q_m = sum_k comb(k,m) c^(k-m) p_k
+            S = comb(k[None,None,:], k[None,:,None])*np.power(c[:,None,None], np.maximum(k[None,None,:]-k[None,:,None],0))
+            return np.matmul(S, poly_coeff[seg,:,:])*np.power(h[:,None,None], k[None,:,None])
+        diff = get_interval_poly(poly_coeff1, T1) - get_interval_poly(poly_coeff2, T2)
+        
+        # Broadphase, the curve stays in the box of its Bernstein control points
+        bernstein_mat = comb(k[:,None], k[None,:])/comb(deg, k)[None,:]
+        ctrl = np.matmul(bernstein_mat[None,:,:], diff)
+        gap = np.maximum(np.maximum(np.min(ctrl, axis=1), -np.max(ctrl, axis=1)), 0.)
+        dist_lb = np.linalg.norm(gap, axis=1)
+        
+        # Interval end points, first and last control points
+        dist_end = np.linalg.norm(np.concatenate((ctrl[:,0,:], ctrl[-1:,-1,:]), axis=0), axis=1)
+        idx = np.argmin(dist_end)
+        dist = dist_end[idx]
+        t_min = t_break[idx]
+        
+        # Narrowphase
+        for i in np.argsort(dist_lb):
+            if dist_lb[i] >= min(dist, min_dist):
+                break
+            sq = np.zeros(2*deg+1)
+            for dim in range(diff.shape[2]):
+                sq += np.polymul(diff[i,::-1,dim], diff[i,::-1,dim])
+            # Real parts of all roots are valid candidates, near double roots may come out complex
+            u = np.clip(np.roots(np.polyder(sq)).real, 0., 1.)
+            if u.shape[0] == 0:
+                continue
+            val = np.polyval(sq, u)
+            j = np.argmin(val)
+            dist_i = np.sqrt(max(val[j], 0.))
+            if dist_i < dist:
+                dist = dist_i
+                t_min = t_st[i]+u[j]*h[i]
+        return dist, t_min
+    
     ###############################################################################
-    def generate_sum_matrix(self, x, der=4, flag_loop=False):
-        Q = np.zeros((self.MAX_POLY_DEG+1,self.MAX_POLY_DEG+1))
-        for i in range(self.MAX_POLY_DEG+1):
-            for j in range(self.MAX_POLY_DEG+1):
-                if i >= der and j >= der:
-                    Q[i,j] = factorial(i)/factorial(i-der)*factorial(j)/factorial(j-der)/(i+j+1-2*der)
-        
-        V = np.hstack([self.v0_mat[0,:,:].T, self.v1_mat[0,:,:].T])
-        M = V.T.dot(Q).dot(V)
-        W0 = M[:self.N_DER,:self.N_DER]
-        W1 = M[:self.N_DER,self.N_DER:]
-        W1T = M[self.N_DER:,:self.N_DER]
-        W2 = M[self.N_DER:,self.N_DER:]
-        
+    def generate_sum_blocks(self, x, der=4, flag_yaw=False, flag_grad=False):
+        """Per segment blocks of generate_sum_matrix over the end points i and i+1
+
+        Returns:
+            blocks: (N_POLY, 2*N_DER, 2*N_DER) np array,
+                derivative of every block with respect to its segment time if flag_grad
+        """
+        if flag_yaw:
+            N_der = self.N_DER_YAW
+        else:
+            N_der = self.N_DER
+        M = self.get_sum_block(der=der, flag_yaw=flag_yaw)
+        T_mat = self.generate_time_scale(x, N_der)
+        T_mat = np.concatenate([T_mat, T_mat], axis=1)
+        blocks = T_mat[:,:,None]*M[None,:,:]*T_mat[:,None,:]/np.power(x, 2*der-1)[:,None,None]
+        if flag_grad:
+            # Entry (a,b) scales with x^(k_a+k_b-2*der+1)
+            k = np.tile(np.arange(N_der), 2)
+            blocks *= (k[:,None]+k[None,:]-2*der+1)[None,:,:]/x[:,None,None]
+        return blocks
+    
+    def generate_sum_matrix(self, x, der=4, flag_loop=False, flag_sparse=False, blocks=None):
+        N_POLY = x.shape[0]
+        if blocks is None:
+            blocks = self.generate_sum_blocks(x, der=der)
+        if flag_loop:
+            N_block = N_POLY
+        else:
+            N_block = N_POLY+1
+        return self.assemble_block_banded(blocks, N_block, self.N_DER, flag_loop=flag_loop, flag_sparse=flag_sparse)
+    
+    def generate_sum_matrix_yaw(self, x, der=2, flag_loop=False, flag_sparse=False):
+        M = self.get_sum_block(der=der, flag_yaw=True)
         N_POLY = x.shape[0]
+        T_mat = self.generate_time_scale(x, self.N_DER_YAW)
+        T_mat = np.concatenate([T_mat, T_mat], axis=1)
+        blocks = T_mat[:,:,None]*M[None,:,:]*T_mat[:,None,:]/np.power(x, 2*der-1)[:,None,None]
         if flag_loop:
-            Mat_obj = np.zeros((self.N_DER*N_POLY,self.N_DER*N_POLY))
+            N_block = N_POLY
         else:
-            Mat_obj = np.zeros((self.N_DER*(N_POLY+1),self.N_DER*(N_POLY+1)))
+            N_block = N_POLY+1
+        return self.assemble_block_banded(blocks, N_block, self.N_DER_YAW, flag_loop=flag_loop, flag_sparse=flag_sparse)
+    
+    def generate_sum_matrix_yaw_batch(self, x_batch, der=2, flag_loop=False):
+        """Batched generate_sum_matrix_yaw
+
+        Args:
+            x_batch: (B, N_POLY) np array of time allocations
+        Returns:
+            Mat_obj: (B, N, N) np array
+        """
+        M = self.get_sum_block(der=der, flag_yaw=True)
+        
+        B = x_batch.shape[0]
+        N_POLY = x_batch.shape[1]
+        # (B, N_POLY, N_DER_YAW) diagonal of T_mat for every segment
+        T_vec = np.power(x_batch[:,:,None], np.arange(self.N_DER_YAW)[None,None,:])
+        T_vec_all = np.concatenate([T_vec, T_vec], axis=2)
+        M_all = T_vec_all[:,:,:,None]*M[None,None,:,:]*T_vec_all[:,:,None,:] \
+            / np.power(x_batch, 2*der-1)[:,:,None,None]
+        if flag_loop:
+            Mat_obj = np.zeros((B,self.N_DER_YAW*N_POLY,self.N_DER_YAW*N_POLY))
+        else:
+            Mat_obj = np.zeros((B,self.N_DER_YAW*(N_POLY+1),self.N_DER_YAW*(N_POLY+1)))
         for i in range(N_POLY):
             if flag_loop:
                 i_n = (i+1)%(N_POLY)
             else:
                 i_n = (i+1)
-            T_mat = np.diag(self.generate_basis(x[i],self.N_DER-1,0))
-            Mat_obj[i*self.N_DER:(i+1)*self.N_DER, \
-                    i*self.N_DER:(i+1)*self.N_DER] \
-                += T_mat.dot(W0).dot(T_mat)/(x[i]**(2*der-1))
-            Mat_obj[i*self.N_DER:(i+1)*self.N_DER, \
-                    i_n*self.N_DER:(i_n+1)*self.N_DER] \
-                += T_mat.dot(W1).dot(T_mat)/(x[i]**(2*der-1))
-            Mat_obj[i_n*self.N_DER:(i_n+1)*self.N_DER, \
-                    i*self.N_DER:(i+1)*self.N_DER] \
-                += T_mat.dot(W1.T).dot(T_mat)/(x[i]**(2*der-1))
-            Mat_obj[i_n*self.N_DER:(i_n+1)*self.N_DER, \
-                    i_n*self.N_DER:(i_n+1)*self.N_DER] \
-                += T_mat.dot(W2).dot(T_mat)/(x[i]**(2*der-1))
-            
+            idx = np.concatenate((np.arange(i*self.N_DER_YAW,(i+1)*self.N_DER_YAW), \
+                                  np.arange(i_n*self.N_DER_YAW,(i_n+1)*self.N_DER_YAW)))
+            # add.at accumulates repeated indices of a single segment loop
+            np.add.at(Mat_obj, (slice(None),idx[:,None],idx[None,:]), M_all[:,i,:,:])
+        
         return Mat_obj
     
-    def generate_sum_matrix_yaw(self, x, der=2, flag_loop=False):
-        Q = np.zeros((self.MAX_POLY_DEG_YAW+1,self.MAX_POLY_DEG_YAW+1))
-        for i in range(self.MAX_POLY_DEG_YAW+1):
-            for j in range(self.MAX_POLY_DEG_YAW+1):
-                if i >= der and j >= der:
-                    Q[i,j] = 1/(i+j+1-2*der)*factorial(i)/factorial(i-der)*factorial(j)/factorial(j-der)
-        
-        V = np.hstack([self.v0_mat_yaw[0,:,:].T, self.v1_mat_yaw[0,:,:].T])
-        M = V.T.dot(Q).dot(V)
-        W0 = M[:self.N_DER_YAW,:self.N_DER_YAW]
-        W1 = M[:self.N_DER_YAW,self.N_DER_YAW:]
-        W2 = M[self.N_DER_YAW:,self.N_DER_YAW:]
-        
-        N_POLY = x.shape[0]
+    def get_compiled_course(self, plane_pos_set):
+        """Returns plane_pos_set as a CompiledCourse, compiling raw lists once"""
+        if isinstance(plane_pos_set, CompiledCourse):
+            return plane_pos_set
+        course_data = self._lru_get(self._course_cache, id(plane_pos_set))
+        # id() can be reused once a course is garbage collected
+        if course_data is None or course_data[0] is not plane_pos_set:
+            course_data = (plane_pos_set, CompiledCourse(plane_pos_set))
+            self._lru_set(self._course_cache, id(plane_pos_set), course_data, self.course_cache_size)
+        return course_data[1]
+
+    def _lru_get(self, cache, key):
+        value = cache.get(key, None)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+    def _lru_set(self, cache, key, value, max_size):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+        return
+
+    def _generate_snap_qp(self, x_t, points, plane_pos_set, waypoints, \
+                          deg_init_min=0, deg_init_max=4, deg_end_min=0, deg_end_max=0, \
+                          flag_init_point=True, flag_loop=False, qp_blocks=None):
+        N_POLY = x_t.shape[0]
+
+        corridor_mode = self.get_corridor_mode(plane_pos_set)
+        Q_blocks, V_seg = self._get_snap_qp_blocks(x_t, flag_loop=flag_loop, corridor_mode=corridor_mode, qp_blocks=qp_blocks)
+        Q_pos = self.generate_sum_matrix(x_t, der=4, flag_loop=flag_loop, flag_sparse=True, blocks=Q_blocks)
+        Q_obj = sparse.block_diag((Q_pos,Q_pos,Q_pos), format='csc')
+
+        # Create two scalar optimization variables.
         if flag_loop:
-            Mat_obj = np.zeros((self.N_DER_YAW*N_POLY,self.N_DER_YAW*N_POLY))
+            n = N_POLY*self.N_DER
         else:
-            Mat_obj = np.zeros((self.N_DER_YAW*(N_POLY+1),self.N_DER_YAW*(N_POLY+1)))
+            n = (N_POLY+1)*self.N_DER
+        x = Variable(n*3)
+        constraints = []
+        corridor_set = []
+
+        # Corridor constraints
+        for p_ii in range(len(plane_pos_set)):
+            # Polytope faces, corner, input and output boundaries
+            # Row i*N_row+j of kron(V_norm, V_t_tmp) is face i at sample j
+            V_t_tmp = self._get_corridor_matrix(x_t, plane_pos_set, p_ii, n, \
+                flag_loop=flag_loop, corridor_mode=corridor_mode, V_seg=V_seg[p_ii])
+            A = sparse.kron(plane_pos_set.V_norm[p_ii], V_t_tmp, format='csr')
+            constraints.append(A@x >= np.repeat(plane_pos_set.V_bias[p_ii], V_t_tmp.shape[0]))
+            corridor_set.append(constraints[-1])
+
+        # End point, starting point and higher derivative constraints
+        A_eq, b_eq, _, _ = self._generate_snap_eq_constraints( \
+            N_POLY, points, plane_pos_set, waypoints, \
+            deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
+            deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
+            flag_init_point=flag_init_point, flag_loop=flag_loop)
+        constraints.append(A_eq.tocsr()@x == b_eq)
+
+        # Form objective.
+        obj = Minimize(0.5*quad_form(x, Q_obj))
+
+        # Form problem.
+        prob = Problem(obj, constraints)
+        return prob, x, corridor_set
+
+    def _compile_snap_qp(self, N_POLY, N_wp, plane_pos_set, waypoints, \
+                         deg_init_min=0, deg_init_max=4, deg_end_min=0, deg_end_max=0, \
+                         flag_init_point=True, flag_loop=False, corridor_mode='sample'):
+        """Builds the corridor QP once with the time dependent values as cvxpy parameters
+
+        The snap objective is written as a sum of sum_squares(L_seg*x_seg) over segments,
+        where L_seg^T L_seg is the segment block of Q_pos over its two end points, and every
+        segment samples the same end point blocks with V_seg. The problem stays DPP,
+        block-tridiagonal, and is canonicalized only on the first solve.
+        """
+        if flag_loop:
+            n = N_POLY*self.N_DER
+        else:
+            n = (N_POLY+1)*self.N_DER
+        x = Variable(n*3)
+        N_row = self.get_corridor_row_count(corridor_mode)
+        V_seg_set = []
+        constraints = []
+        corridor_set = []
+
+        # Snap cost
+        L_seg_set = []
+        cost = 0
+        for p_ii in range(N_POLY):
+            if flag_loop:
+                p_ii_n = (p_ii+1)%N_POLY
+            else:
+                p_ii_n = (p_ii+1)
+            L_seg = cp.Parameter((2*self.N_DER,2*self.N_DER))
+            L_seg_set.append(L_seg)
+            for dim in range(3):
+                x_seg = cp.hstack([ \
+                    x[dim*n+p_ii*self.N_DER:dim*n+(p_ii+1)*self.N_DER], \
+                    x[dim*n+p_ii_n*self.N_DER:dim*n+(p_ii_n+1)*self.N_DER]])
+                cost += cp.sum_squares(L_seg@x_seg)
+
+        # Corridor constraints
+        for p_ii in range(len(plane_pos_set)):
+            if flag_loop:
+                p_ii_n = (p_ii+1)%(len(plane_pos_set))
+            else:
+                p_ii_n = (p_ii+1)
+
+            V_seg = cp.Parameter((N_row,2*self.N_DER))
+            V_seg_set.append(V_seg)
+            pos_seg = []
+            for dim in range(3):
+                x_seg = cp.hstack([ \
+                    x[dim*n+p_ii*self.N_DER:dim*n+(p_ii+1)*self.N_DER], \
+                    x[dim*n+p_ii_n*self.N_DER:dim*n+(p_ii_n+1)*self.N_DER]])
+                pos_seg.append(V_seg@x_seg)
+            pos_seg = cp.vstack(pos_seg)
+
+            V_norm = plane_pos_set.V_norm[p_ii]
+            V_bias = plane_pos_set.V_bias[p_ii]
+            constraints.append(V_norm@pos_seg >= np.repeat(V_bias[:,None],N_row,axis=1))
+            corridor_set.append(constraints[-1])
+
+        # End point, starting point and higher derivative constraints, the waypoint rows are set per solve
+        A_eq, b_eq, point_row, point_idx = self._generate_snap_eq_constraints( \
+            N_POLY, None, plane_pos_set, waypoints, \
+            deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
+            deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
+            flag_init_point=flag_init_point, flag_loop=flag_loop)
+        b_eq_param = cp.Parameter(b_eq.shape[0])
+        constraints.append(A_eq.tocsr()@x == b_eq_param)
+
+        obj = Minimize(0.5*cost)
+        prob = Problem(obj, constraints)
+
+        qp_data = dict()
+        qp_data["prob"] = prob
+        qp_data["x"] = x
+        qp_data["L_seg_set"] = L_seg_set
+        qp_data["V_seg_set"] = V_seg_set
+        qp_data["corridor_set"] = corridor_set
+        qp_data["b_eq"] = b_eq
+        qp_data["b_eq_param"] = b_eq_param
+        qp_data["point_row"] = point_row
+        qp_data["point_idx"] = point_idx
+        return qp_data
+
+    def _get_snap_qp_compiled(self, x_t, points, plane_pos_set, waypoints, t_scale, \
+                              deg_init_min=0, deg_init_max=4, deg_end_min=0, deg_end_max=0, \
+                              flag_init_point=True, flag_loop=False, qp_blocks=None):
+        N_POLY = x_t.shape[0]
+        corridor_mode = self.get_corridor_mode(plane_pos_set)
+        qp_key = (plane_pos_set.course_id, tuple(waypoints), N_POLY, flag_loop, \
+                  deg_init_min, deg_init_max, deg_end_min, deg_end_max, flag_init_point, corridor_mode)
+        qp_data = self._lru_get(self._snap_qp_cache, qp_key)
+        if qp_data is None:
+            qp_data = self._compile_snap_qp(N_POLY, points.shape[0], plane_pos_set, waypoints, \
+                deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
+                deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
+                flag_init_point=flag_init_point, flag_loop=flag_loop, corridor_mode=corridor_mode)
+            self._lru_set(self._snap_qp_cache, qp_key, qp_data, self.qp_cache_size)
+
+        # Update time dependent parameters
+        Q_blocks, V_seg = self._get_snap_qp_blocks(x_t, flag_loop=flag_loop, corridor_mode=corridor_mode, qp_blocks=qp_blocks)
+        w, U = np.linalg.eigh(Q_blocks)
+        L_blocks = np.sqrt(np.maximum(w,0))[:,:,None]*np.transpose(U,(0,2,1))
+        for p_ii in range(len(qp_data["L_seg_set"])):
+            qp_data["L_seg_set"][p_ii].value = L_blocks[p_ii,:,:]
+        for p_ii in range(len(qp_data["V_seg_set"])):
+            qp_data["V_seg_set"][p_ii].value = V_seg[p_ii]
+        b_eq = copy.deepcopy(qp_data["b_eq"])
+        b_eq[qp_data["point_row"]] = points[qp_data["point_idx"][:,0], qp_data["point_idx"][:,1]]
+        qp_data["b_eq_param"].value = b_eq
+
+        return qp_data["prob"], qp_data["x"], qp_data["corridor_set"]
+
+    def get_corridor_mode(self, plane_pos_set):
+        corridor_mode = getattr(plane_pos_set, "corridor_mode", None)
+        if corridor_mode is None:
+            corridor_mode = self.corridor_mode
+        assert corridor_mode in ['sample', 'bernstein']
+        return corridor_mode
+
+    def get_corridor_row_count(self, corridor_mode='sample'):
+        if corridor_mode == 'bernstein':
+            return self.MAX_POLY_DEG+1
+        return self.N_POINTS
+
+    def _get_segment_sampling_matrix(self, x_t, p_ii, flag_loop=False, corridor_mode='sample'):
+        """Position sampling matrix of segment p_ii over its two end point blocks
+
+        Returns:
+            V_seg: (N_POINTS, 2*N_DER) np array, same rows as generate_sampling_matrix,
+                or (MAX_POLY_DEG+1, 2*N_DER) Bernstein control points if corridor_mode is 'bernstein'
+        """
+        T_vec = self.generate_basis(x_t[p_ii],self.N_DER-1,0)
+        if corridor_mode == 'bernstein':
+            v0, v1 = self.v0_bernstein, self.v1_bernstein
+        elif not flag_loop and p_ii == x_t.shape[0]-1:
+            v0, v1 = self.v0_sanity_end[0,:,:], self.v1_sanity_end[0,:,:]
+        else:
+            v0, v1 = self.v0_sanity[0,:,:], self.v1_sanity[0,:,:]
+        return np.hstack([v0*T_vec, v1*T_vec])
+
+    def get_snap_qp_blocks_batch(self, x_batch, flag_loop=False, corridor_mode='sample'):
+        """Time dependent blocks of the corridor QP for every row of x_batch
+
+        Returns:
+            Q_blocks: (B, N_POLY, 2*N_DER, 2*N_DER) np array, generate_sum_blocks(x_batch[b,:], der=4)
+            V_seg: (B, N_POLY, N_row, 2*N_DER) np array, _get_segment_sampling_matrix of every segment
+        """
+        x_batch = np.array(x_batch, dtype=np.float64)
+        B, N_POLY = x_batch.shape
+        Q_blocks = self.generate_sum_blocks(x_batch.ravel(), der=4).reshape(B, N_POLY, 2*self.N_DER, 2*self.N_DER)
+        if corridor_mode == 'bernstein':
+            v0_set = np.tile(self.v0_bernstein[None,:,:], (N_POLY,1,1))
+            v1_set = np.tile(self.v1_bernstein[None,:,:], (N_POLY,1,1))
+        else:
+            v0_set = np.tile(self.v0_sanity[0:1,:,:], (N_POLY,1,1))
+            v1_set = np.tile(self.v1_sanity[0:1,:,:], (N_POLY,1,1))
+            if not flag_loop:
+                v0_set[-1,:,:] = self.v0_sanity_end[0,:,:]
+                v1_set[-1,:,:] = self.v1_sanity_end[0,:,:]
+        T_vec = self.generate_time_scale(x_batch.ravel(), self.N_DER).reshape(B, N_POLY, 1, self.N_DER)
+        V_seg = np.concatenate([v0_set[None,:,:,:]*T_vec, v1_set[None,:,:,:]*T_vec], axis=3)
+        return Q_blocks, V_seg
+
+    def scale_snap_qp_blocks(self, qp_blocks, t_scale):
+        """Blocks of t_set*t_scale from the (Q_blocks, V_seg) of t_set"""
+        Q_blocks, V_seg = qp_blocks
+        # Q entry (a,b) scales with x^(k_a+k_b-7), sampling column a with x^k_a
+        k = np.tile(np.arange(self.N_DER), 2)
+        Q_scale = np.power(t_scale, 1.0*(k[:,None]+k[None,:]-7))
+        return Q_blocks*Q_scale, V_seg*np.power(t_scale, 1.0*k)
+
+    def _get_snap_qp_blocks(self, x_t, flag_loop=False, corridor_mode='sample', qp_blocks=None):
+        if qp_blocks is None:
+            Q_blocks, V_seg = self.get_snap_qp_blocks_batch(x_t[None,:], flag_loop=flag_loop, corridor_mode=corridor_mode)
+            return Q_blocks[0], V_seg[0]
+        return qp_blocks
+
+    def _get_corridor_matrix(self, x_t, plane_pos_set, p_ii, n, flag_loop=False, corridor_mode='sample', V_seg=None):
+        """Corridor rows of segment p_ii over all n position variables of one axis
+
+        V_seg: sampling matrix of segment p_ii if already computed
+        Returns:
+            scipy.sparse csr_matrix of shape (N_row, n)
+        """
+        if flag_loop:
+            p_ii_n = (p_ii+1)%(len(plane_pos_set))
+        else:
+            p_ii_n = (p_ii+1)
+        if V_seg is None:
+            V_seg = self._get_segment_sampling_matrix(x_t, p_ii, flag_loop=flag_loop, corridor_mode=corridor_mode)
+        seg_col = np.concatenate((p_ii*self.N_DER+np.arange(self.N_DER), p_ii_n*self.N_DER+np.arange(self.N_DER)))
+        row = np.repeat(np.arange(V_seg.shape[0]), V_seg.shape[1])
+        col = np.tile(seg_col, V_seg.shape[0])
+        return sparse.csr_matrix((V_seg.ravel(), (row, col)), shape=(V_seg.shape[0],n))
+
+    def _compile_snap_qp_osqp(self, N_POLY, plane_pos_set, waypoints, \
+                              deg_init_min=0, deg_init_max=4, deg_end_min=0, deg_end_max=0, \
+                              flag_init_point=True, flag_loop=False, corridor_mode='sample'):
+        """Sparsity pattern of the corridor QP for a persistent OSQP workspace
+
+        P (upper triangle) and A are kept in CSC order, so only their data arrays
+        are replaced when the time allocation changes.
+        Rows of A: corridor rows of every segment first, then the equality rows.
+        """
+        if flag_loop:
+            n = N_POLY*self.N_DER
+            N_block = N_POLY
+        else:
+            n = (N_POLY+1)*self.N_DER
+            N_block = N_POLY+1
+        N_var = 3*n
+        der_idx = np.arange(self.N_DER)
+
+        # Objective, block tridiagonal for each axis
+        block_struct = np.zeros((N_block,N_block))
         for i in range(N_POLY):
+            i_n = (i+1)%N_block
+            block_struct[np.ix_([i,i_n],[i,i_n])] = 1
+        P_row, P_col = np.nonzero(np.triu(np.kron(block_struct, np.ones((self.N_DER,self.N_DER)))))
+        P_order = np.lexsort((P_row, P_col))
+        P_row, P_col = P_row[P_order], P_col[P_order]
+        P_row_all = np.concatenate([P_row+dim*n for dim in range(3)])
+        P_col_all = np.concatenate([P_col+dim*n for dim in range(3)])
+        P_indptr = np.concatenate(([0], np.cumsum(np.bincount(P_col_all, minlength=N_var))))
+
+        # Corridor constraints, values depend on t_set
+        A_row = []
+        A_col = []
+        l = []
+        u = []
+        N_row = 0
+        N_sample = self.get_corridor_row_count(corridor_mode)
+        corridor_shape = []
+        for p_ii in range(len(plane_pos_set)):
             if flag_loop:
-                i_n = (i+1)%(N_POLY)
+                p_ii_n = (p_ii+1)%(len(plane_pos_set))
             else:
-                i_n = (i+1)
-            T_mat = np.diag(self.generate_basis(x[i],self.N_DER_YAW-1,0))
-            Mat_obj[i*self.N_DER_YAW:(i+1)*self.N_DER_YAW, \
-                    i*self.N_DER_YAW:(i+1)*self.N_DER_YAW] \
-                += T_mat.dot(W0).dot(T_mat)/(x[i]**(2*der-1))
-            Mat_obj[i*self.N_DER_YAW:(i+1)*self.N_DER_YAW, \
-                    i_n*self.N_DER_YAW:(i_n+1)*self.N_DER_YAW] \
-                += T_mat.dot(W1).dot(T_mat)/(x[i]**(2*der-1))
-            Mat_obj[i_n*self.N_DER_YAW:(i_n+1)*self.N_DER_YAW, \
-                    i*self.N_DER_YAW:(i+1)*self.N_DER_YAW] \
-                += T_mat.dot(W1.T).dot(T_mat)/(x[i]**(2*der-1))
-            Mat_obj[i_n*self.N_DER_YAW:(i_n+1)*self.N_DER_YAW, \
-                    i_n*self.N_DER_YAW:(i_n+1)*self.N_DER_YAW] \
-                += T_mat.dot(W2).dot(T_mat)/(x[i]**(2*der-1))
+                p_ii_n = (p_ii+1)
+            N_plane = plane_pos_set.V_norm[p_ii].shape[0]
+            corridor_shape.append((N_plane,N_sample))
+            seg_col = np.concatenate((p_ii*self.N_DER+der_idx, p_ii_n*self.N_DER+der_idx))
+            row_t = N_row + np.arange(N_plane*N_sample).reshape(N_plane,N_sample,1,1)
+            col_t = (np.arange(3)[:,None]*n + seg_col[None,:]).reshape(1,1,3,2*self.N_DER)
+            row_t, col_t = np.broadcast_arrays(row_t, col_t)
+            A_row.append(row_t.ravel())
+            A_col.append(col_t.ravel())
+            l.append(np.repeat(plane_pos_set.V_bias[p_ii], N_sample))
+            u.append(np.inf*np.ones(N_plane*N_sample))
+            N_row += N_plane*N_sample
+        N_A_var = np.sum([x.shape[0] for x in A_row])
 
-        return Mat_obj
-    
-    def snap_obj(self, t_set, points, plane_pos_set, waypoints,\
-                 deg_init_min=0, deg_init_max=4, deg_end_min=0, deg_end_max=0, \
-                 flag_init_point=True, flag_fixed_point=False, flag_fixed_end_point=False):
-        
-        N_wp = points.shape[0]
-        flag_loop = self.check_flag_loop(t_set,points)
-        N_POLY = t_set.shape[0]
-        
-        t_scale_list = [self.default_t_set_scale]
-        for i in range(1,3):
-            t_scale_list.append(self.default_t_set_scale*np.power(2,i))
-            t_scale_list.append(self.default_t_set_scale/np.power(2,i))
-        
-        t_set_scale = self.default_t_set_scale
-        for t_scale in t_scale_list:
-            t_set_scale = t_scale
-            x_t = t_set*t_set_scale
+        # Equality constraints, constant values except the waypoint rows
+        A_eq, b_eq, point_row, point_idx = self._generate_snap_eq_constraints( \
+            N_POLY, None, plane_pos_set, waypoints, \
+            deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
+            deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
+            flag_init_point=flag_init_point, flag_loop=flag_loop)
+        A_row.append(N_row+A_eq.row)
+        A_col.append(A_eq.col)
+        A_val_const = A_eq.data
+        l.append(b_eq)
+        u.append(b_eq)
+        point_row = N_row+point_row
+        N_row += A_eq.shape[0]
+
+        A_row = np.concatenate(A_row)
+        A_col = np.concatenate(A_col)
+        A_perm = np.lexsort((A_row, A_col))
+
+        qp_data = dict()
+        qp_data["n"] = n
+        qp_data["N_row"] = N_row
+        qp_data["P_row"] = P_row
+        qp_data["P_col"] = P_col
+        qp_data["P_indices"] = P_row_all
+        qp_data["P_indptr"] = P_indptr
+        qp_data["N_A_var"] = N_A_var
+        qp_data["corridor_shape"] = corridor_shape
+        qp_data["A_val_const"] = A_val_const
+        qp_data["A_perm"] = A_perm
+        qp_data["A_indices"] = A_row[A_perm]
+        qp_data["A_indptr"] = np.concatenate(([0], np.cumsum(np.bincount(A_col, minlength=N_var))))
+        qp_data["l"] = np.concatenate(l)
+        qp_data["u"] = np.concatenate(u)
+        qp_data["point_row"] = point_row
+        qp_data["point_idx"] = point_idx
+        qp_data["solver"] = None
+        qp_data["x"] = None
+        qp_data["y"] = None
+        qp_data["t_scale"] = None
+        return qp_data
+
+    def _solve_snap_qp_osqp(self, x_t, points, plane_pos_set, waypoints, t_scale, \
+                            deg_init_min=0, deg_init_max=4, deg_end_min=0, deg_end_max=0, \
+                            flag_init_point=True, flag_loop=False, qp_blocks=None):
+        N_POLY = x_t.shape[0]
+        corridor_mode = self.get_corridor_mode(plane_pos_set)
+        qp_key = (plane_pos_set.course_id, tuple(waypoints), N_POLY, flag_loop, \
+                  deg_init_min, deg_init_max, deg_end_min, deg_end_max, flag_init_point, corridor_mode)
+        qp_data = self._lru_get(self._snap_osqp_cache, qp_key)
+        if qp_data is None:
+            qp_data = self._compile_snap_qp_osqp(N_POLY, plane_pos_set, waypoints, \
+                deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
+                deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
+                flag_init_point=flag_init_point, flag_loop=flag_loop, corridor_mode=corridor_mode)
+            self._lru_set(self._snap_osqp_cache, qp_key, qp_data, self.qp_cache_size)
+        N_var = 3*qp_data["n"]
+
+        Q_blocks, V_seg = self._get_snap_qp_blocks(x_t, flag_loop=flag_loop, corridor_mode=corridor_mode, qp_blocks=qp_blocks)
+        Q_pos = self.generate_sum_matrix(x_t, der=4, flag_loop=flag_loop, flag_sparse=True, blocks=Q_blocks).tocsr()
+        P_data = np.tile(np.asarray(Q_pos[qp_data["P_row"], qp_data["P_col"]]).ravel(), 3)
+
+        A_val = []
+        for p_ii in range(len(plane_pos_set)):
+            V_norm = plane_pos_set.V_norm[p_ii]
+            A_val.append((V_norm[:,None,:,None]*V_seg[p_ii][None,:,None,:]).ravel())
+        A_val.append(qp_data["A_val_const"])
+        A_data = np.concatenate(A_val)[qp_data["A_perm"]]
+
+        l = copy.deepcopy(qp_data["l"])
+        u = copy.deepcopy(qp_data["u"])
+        point_val = points[qp_data["point_idx"][:,0], qp_data["point_idx"][:,1]]
+        l[qp_data["point_row"]] = point_val
+        u[qp_data["point_row"]] = point_val
+
+        if qp_data["solver"] is None:
+            P = sparse.csc_matrix((P_data, qp_data["P_indices"], qp_data["P_indptr"]), shape=(N_var,N_var))
+            A = sparse.csc_matrix((A_data, qp_data["A_indices"], qp_data["A_indptr"]), shape=(qp_data["N_row"],N_var))
+            qp_data["solver"] = osqp.OSQP()
+            qp_data["solver"].setup(P=P, q=np.zeros(N_var), A=A, l=l, u=u, verbose=False, \
+                warm_start=True, eps_abs=1e-5, eps_rel=1e-5, max_iter=10000, polish=True)
+        else:
+            # Same sparsity pattern, only the factorization values change
+            qp_data["solver"].update(Px=P_data, Ax=A_data, l=l, u=u)
+            if np.all(qp_data["x"] != None):
+                # Derivative k of the last solution scales with (t_scale_prev/t_scale)^k
+                x_scale = np.tile(self.generate_basis(qp_data["t_scale"]/t_scale,self.N_DER-1,0), \
+                    np.int(N_var/self.N_DER))
+                qp_data["solver"].warm_start(x=qp_data["x"]*x_scale, y=qp_data["y"])
+
+        res = qp_data["solver"].solve()
+        if res.info.status in ["solved", "solved inaccurate"]:
+            qp_data["x"] = res.x
+            qp_data["y"] = res.y
+            qp_data["t_scale"] = t_scale
+            # OSQP multipliers of active lower bounds are negative
+            dual_set = []
+            N_row = 0
+            for shape in qp_data["corridor_shape"]:
+                N_row_n = N_row+shape[0]*shape[1]
+                dual_set.append(-res.y[N_row:N_row_n].reshape(shape))
+                N_row = N_row_n
+            return "optimal", res.x, dual_set
+        elif res.info.status in ["primal infeasible", "primal infeasible inaccurate"]:
+            return "infeasible", None, None
+        elif res.info.status in ["dual infeasible", "dual infeasible inaccurate"]:
+            return "unbounded", None, None
+        else:
+            return res.info.status, None, None
+
+    def _generate_snap_eq_constraints(self, N_POLY, points, plane_pos_set, waypoints, \
+                                      deg_init_min=0, deg_init_max=4, deg_end_min=0, deg_end_max=0, \
+                                      flag_init_point=True, flag_loop=False):
+        """End point, start point and higher derivative equality rows of the corridor QP
 
-            Q_pos = self.generate_sum_matrix(x_t, der=4, flag_loop=flag_loop)    
-            Q_obj = scipy.linalg.block_diag(Q_pos,Q_pos,Q_pos)
+        Shared by every qp_optimizer path. Rows fixed to a waypoint take their value
+        from points, which may be None to build the pattern once for compiled problems.
 
+        Returns:
+            A_eq: scipy.sparse coo_matrix
+            b_eq: np array, 0 on the point rows if points is None
+            point_row: np array of the rows equal to a waypoint coordinate
+            point_idx: (len(point_row), 2) np array of [waypoint, dim] of these rows
+        """
+        if flag_loop:
+            n = N_POLY*self.N_DER
+        else:
+            n = (N_POLY+1)*self.N_DER
+        A_row = []
+        A_col = []
+        A_val = []
+        b_eq = []
+        point_row = []
+        point_idx = []
+        def add_eq_row(col, val, bias):
+            A_row.extend([len(b_eq)]*len(col))
+            A_col.extend(col)
+            A_val.extend(val)
+            b_eq.append(bias)
+        def add_point_row(col, wp, dim):
+            point_row.append(len(b_eq))
+            point_idx.append([wp, dim])
+            add_eq_row([col], [1.0], 0.0 if points is None else points[wp,dim])
+
+        for p_ii in range(len(plane_pos_set)):
             if flag_loop:
-                V_t = self.generate_sampling_matrix(x_t, N=self.N_POINTS, der=0, endpoint=False)
+                p_ii_n = (p_ii+1)%(len(plane_pos_set))
+            else:
+                p_ii_n = (p_ii+1)
+            # Final plane end point
+            if waypoints[p_ii_n] == True:
+                for dim in range(3):
+                    add_point_row(dim*n+p_ii_n*self.N_DER, p_ii_n, dim)
             else:
-                V_t = self.generate_sampling_matrix(x_t, N=self.N_POINTS, der=0, endpoint=True)
+                add_eq_row(list(np.arange(3)*n+p_ii_n*self.N_DER), \
+                    list(plane_pos_set.output_norm[p_ii][0,:]), plane_pos_set.output_bias[p_ii][0])
+
+        # Starting point constraints
+        if flag_init_point:
+            for dim in range(3):
+                add_point_row(dim*n, 0, dim)
+
+        # End point higher derivative constraints
+        if deg_init_max > deg_init_min:
+            deg_min_t = np.int(np.maximum(1, deg_init_min))
+            for dim in range(3):
+                for k in range(deg_min_t, deg_init_max+1):
+                    add_eq_row([dim*n+k], [1.0], 0.0)
+
+        if not flag_loop and deg_end_max > deg_end_min:
+            deg_min_t = np.int(np.maximum(1, deg_end_min))
+            n_t = N_POLY*self.N_DER
+            for dim in range(3):
+                for k in range(deg_min_t, deg_end_max+1):
+                    add_eq_row([n_t+dim*n+k], [1.0], 0.0)
 
-            # Create two scalar optimization variables.
+        A_eq = sparse.coo_matrix((np.array(A_val, dtype=np.float64), \
+            (np.array(A_row, dtype=np.int), np.array(A_col, dtype=np.int))), shape=(len(b_eq),3*n))
+        return A_eq, np.array(b_eq, dtype=np.float64), \
+            np.array(point_row, dtype=np.int), np.array(point_idx, dtype=np.int).reshape(-1,2)
+
+    def _get_corridor_rows(self, V_seg, plane_pos_set, row_idx_set, n, flag_loop=False):
+        """Corridor rows row_idx_set[p_ii] of kron(V_norm, V_seg) for every segment, without the other rows
+
+        Returns:
+            A: scipy.sparse coo_matrix over the 3*n variables
+            l: np array of the lower bounds
+        """
+        A_row = []
+        A_col = []
+        A_val = []
+        l = []
+        N_row = 0
+        der_idx = np.arange(self.N_DER)
+        for p_ii in range(len(row_idx_set)):
             if flag_loop:
-                n = N_POLY*self.N_DER
+                p_ii_n = (p_ii+1)%(len(plane_pos_set))
             else:
-                n = (N_POLY+1)*self.N_DER
-            x = Variable(n*3)
-            constraints = []
+                p_ii_n = (p_ii+1)
+            N_sample = V_seg[p_ii].shape[0]
+            row_idx = row_idx_set[p_ii]
+            face_idx = row_idx // N_sample
+            sample_idx = row_idx % N_sample
+            seg_col = np.concatenate((p_ii*self.N_DER+der_idx, p_ii_n*self.N_DER+der_idx))
+            # (row, dim, col) entries V_norm[face,dim]*V_seg[sample,col]
+            val = plane_pos_set.V_norm[p_ii][face_idx,:][:,:,None]*V_seg[p_ii][sample_idx,:][:,None,:]
+            row_t, col_t = np.broadcast_arrays( \
+                (N_row+np.arange(row_idx.shape[0]))[:,None,None], \
+                (np.arange(3)[:,None]*n+seg_col[None,:])[None,:,:])
+            A_row.append(row_t.ravel())
+            A_col.append(col_t.ravel())
+            A_val.append(val.ravel())
+            l.append(plane_pos_set.V_bias[p_ii][face_idx])
+            N_row += row_idx.shape[0]
+        A = sparse.coo_matrix((np.concatenate(A_val), (np.concatenate(A_row), np.concatenate(A_col))), \
+            shape=(N_row,3*n))
+        return A, np.concatenate(l)
+
+    def _solve_snap_qp_lazy(self, x_t, points, plane_pos_set, waypoints, t_scale, \
+                            deg_init_min=0, deg_init_max=4, deg_end_min=0, deg_end_max=0, \
+                            flag_init_point=True, flag_loop=False, qp_blocks=None):
+        """Solves the corridor QP with corridor rows added as cutting planes
+
+        Starts from every lazy_stride-th sample of each corridor plane, or from the rows
+        kept on the last call for the course, checks the solution against all corridor
+        rows in one pass and re-solves warm with the violated rows added.
+        Always solved with native OSQP. The workspace of the course is kept, so a call whose
+        rows do not change only updates the values of the factorization; adding rows needs a new setup.
+        The number of rounds, setups and rows of the last solve are stored in self.lazy_info.
+        """
+        N_POLY = x_t.shape[0]
+        if flag_loop:
+            n = N_POLY*self.N_DER
+        else:
+            n = (N_POLY+1)*self.N_DER
+        N_var = 3*n
+        eps = 1e-5
 
-            # Corridor constraints
+        corridor_mode = self.get_corridor_mode(plane_pos_set)
+        Q_blocks, V_seg = self._get_snap_qp_blocks(x_t, flag_loop=flag_loop, corridor_mode=corridor_mode, qp_blocks=qp_blocks)
+        Q_pos = self.generate_sum_matrix(x_t, der=4, flag_loop=flag_loop, flag_sparse=True, blocks=Q_blocks)
+        P = sparse.triu(sparse.block_diag((Q_pos,Q_pos,Q_pos)), format='csc')
+        N_sample = self.get_corridor_row_count(corridor_mode)
+        A_eq, b_eq, _, _ = self._generate_snap_eq_constraints( \
+            N_POLY, points, plane_pos_set, waypoints, \
+            deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
+            deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
+            flag_init_point=flag_init_point, flag_loop=flag_loop)
+        seg_idx = np.arange(len(plane_pos_set))
+        if flag_loop:
+            seg_idx_n = (seg_idx+1)%(len(plane_pos_set))
+        else:
+            seg_idx_n = seg_idx+1
+
+        qp_key = (plane_pos_set.course_id, tuple(waypoints), N_POLY, flag_loop, corridor_mode, \
+                  deg_init_min, deg_init_max, deg_end_min, deg_end_max, flag_init_point)
+        qp_data = self._lru_get(self._lazy_qp_cache, qp_key)
+        if qp_data is None:
+            mask_set = []
             for p_ii in range(len(plane_pos_set)):
-                if flag_loop:
-                    p_ii_n = (p_ii+1)%(len(plane_pos_set))
-                else:
-                    p_ii_n = (p_ii+1)
+                mask = np.zeros((plane_pos_set.V_norm[p_ii].shape[0],N_sample), dtype=bool)
+                mask[:,::self.lazy_stride] = True
+                mask[:,-1] = True
+                mask_set.append(mask)
+            qp_data = dict(mask_set=mask_set, solver=None)
+        mask_set = [copy.deepcopy(mask) for mask in qp_data["mask_set"]]
 
-                # Add plane contraints
-                V_t_tmp = V_t[p_ii*self.N_POINTS:(p_ii+1)*self.N_POINTS,:]
-                for i in range(len(plane_pos_set[p_ii]["constraints_plane"])):
-                    v0 = np.array(plane_pos_set[p_ii]["constraints_plane"][i][0])
-                    v1 = np.array(plane_pos_set[p_ii]["constraints_plane"][i][1])
-                    for k in range(2,len(plane_pos_set[p_ii]["constraints_plane"][i])):
-                        v2 = np.array(plane_pos_set[p_ii]["constraints_plane"][i][k])
-                        res_t = np.fabs((v1-v0).dot(v2-v0)/np.linalg.norm(v1-v0)/np.linalg.norm(v2-v0))
-                        if res_t < 1-1e-4:
-                            break
-                    V_norm = np.cross(v1-v0, v2-v0)*1.0
-                    V_norm /= np.linalg.norm(V_norm)
-                    V_bias = V_norm.dot(v0)
-                    A = np.hstack([V_norm[0]*V_t_tmp,V_norm[1]*V_t_tmp,V_norm[2]*V_t_tmp])
-                    constraints.append(A*x >= V_bias)
-                
-                # Corner boundary
-                for i in range(len(plane_pos_set[p_ii]["corner_plane"])):
-                    v0 = np.array(plane_pos_set[p_ii]["corner_plane"][i][0])
-                    v1 = np.array(plane_pos_set[p_ii]["corner_plane"][i][1])
-                    v2 = np.array(plane_pos_set[p_ii]["corner_plane"][i][2])
-                    V_norm = np.cross(v1-v0, v2-v0)*1.0
-                    V_norm /= np.linalg.norm(V_norm)
-                    V_bias = V_norm.dot(v0)
-                    A = np.hstack([V_norm[0]*V_t_tmp,V_norm[1]*V_t_tmp,V_norm[2]*V_t_tmp])
-                    constraints.append(A*x >= V_bias)
-
-                # Init end point boundary
-                if len(plane_pos_set[p_ii]["input_plane"]) > 0:
-                    v0 = np.array(plane_pos_set[p_ii]["input_plane"][0])
-                    v1 = np.array(plane_pos_set[p_ii]["input_plane"][1])
-                    v2 = np.array(plane_pos_set[p_ii]["input_plane"][2])
-                    V_norm = np.cross(v1-v0, v2-v0)*1.0
-                    V_norm /= np.linalg.norm(V_norm)
-                    V_bias = V_norm.dot(v0)
-                    A = np.hstack([V_norm[0]*V_t_tmp,V_norm[1]*V_t_tmp,V_norm[2]*V_t_tmp])
-                    constraints.append(A*x >= V_bias)
-
-                # Init end point boundary
-                if len(plane_pos_set[p_ii]["input_plane"]) > 0:
-                    v0 = np.array(plane_pos_set[p_ii]["input_plane"][0])
-                    v1 = np.array(plane_pos_set[p_ii]["input_plane"][1])
-                    v2 = np.array(plane_pos_set[p_ii]["input_plane"][2])
-                    V_norm = np.cross(v1-v0, v2-v0)*1.0
-                    V_norm /= np.linalg.norm(V_norm)
-                    V_bias = V_norm.dot(v0)
-                    A = np.hstack([V_norm[0]*V_t_tmp,V_norm[1]*V_t_tmp,V_norm[2]*V_t_tmp])
-                    constraints.append(A*x >= V_bias)
-
-                # Final end point boundary
-                if len(plane_pos_set[p_ii]["output_plane"]) > 0:
-                    v0 = np.array(plane_pos_set[p_ii]["output_plane"][0])
-                    v1 = np.array(plane_pos_set[p_ii]["output_plane"][1])
-                    v2 = np.array(plane_pos_set[p_ii]["output_plane"][2])
-                    V_norm = np.cross(v1-v0, v2-v0)*1.0
-                    V_norm /= np.linalg.norm(V_norm)
-                    V_bias = V_norm.dot(v0)
-                    A = np.hstack([V_norm[0]*V_t_tmp,V_norm[1]*V_t_tmp,V_norm[2]*V_t_tmp])
-                    constraints.append(A*x >= V_bias)
-
-                # Final plane end point
-                if not flag_loop and p_ii == N_POLY-1:
-                    V_t_fixed = V_t[-1:,:]
-                else:
-                    V_t_fixed = V_t[(p_ii+1)*self.N_POINTS:(p_ii+1)*self.N_POINTS+1,:]
-                # if flag_fixed_point:
-                #     A = scipy.linalg.block_diag(V_t_fixed,V_t_fixed,V_t_fixed)
-                #     constraints.append(A*x == points[p_ii_n,:3])
-                # else:
-                #     if p_ii == len(plane_pos_set)-1:
-                #         if flag_fixed_end_point:
-                #             A = scipy.linalg.block_diag(V_t_fixed,V_t_fixed,V_t_fixed)
-                #             constraints.append(A*x == points[p_ii_n,:3])
-                #     else:
-                #         v0 = np.array(plane_pos_set[p_ii]["output_plane"][0])
-                #         v1 = np.array(plane_pos_set[p_ii]["output_plane"][1])
-                #         v2 = np.array(plane_pos_set[p_ii]["output_plane"][2])
-                #         V_norm = np.cross(v1-v0, v2-v0)*1.0
-                #         V_norm /= np.linalg.norm(V_norm)
-                #         V_bias = V_norm.dot(v0)                    
-                #         A = np.hstack([V_norm[0]*V_t_fixed,V_norm[1]*V_t_fixed,V_norm[2]*V_t_fixed])
-                #         constraints.append(A*x == V_bias)
-                if waypoints[p_ii_n] == True:
-                    A = scipy.linalg.block_diag(V_t_fixed,V_t_fixed,V_t_fixed)
-                    constraints.append(A*x == points[p_ii_n,:3])
-                else:
-                    v0 = np.array(plane_pos_set[p_ii]["output_plane"][0])
-                    v1 = np.array(plane_pos_set[p_ii]["output_plane"][1])
-                    v2 = np.array(plane_pos_set[p_ii]["output_plane"][2])
-                    V_norm = np.cross(v1-v0, v2-v0)*1.0
-                    V_norm /= np.linalg.norm(V_norm)
-                    V_bias = V_norm.dot(v0)                    
-                    A = np.hstack([V_norm[0]*V_t_fixed,V_norm[1]*V_t_fixed,V_norm[2]*V_t_fixed])
-                    constraints.append(A*x == V_bias)
-
-            # Starting point constraints
-            if flag_init_point:
-                start_point = points[0,:]
-                constraints.append(x[0] == start_point[0])
-                constraints.append(x[n] == start_point[1])
-                constraints.append(x[2*n] == start_point[2])
-
-#             if (flag_fixed_end_point or flag_fixed_point) and (not flag_loop):
-#                 end_point = points[-1,:]
-#                 constraints.append(x[N_POLY*self.N_DER] == end_point[0])
-#                 constraints.append(x[n+N_POLY*self.N_DER] == end_point[1])
-#                 constraints.append(x[2*n+N_POLY*self.N_DER] == end_point[2])
-                
-            # End point higher derivative constraints
-            if deg_init_max > deg_init_min:
-                deg_min_t = np.int(np.maximum(1, deg_init_min))
-                constraints.append(x[deg_min_t:deg_init_max+1] == 0)
-                constraints.append(x[n+deg_min_t:n+deg_init_max+1] == 0)
-                constraints.append(x[2*n+deg_min_t:2*n+deg_init_max+1] == 0)
-
-            if not flag_loop and deg_end_max > deg_end_min:
-                deg_min_t = np.int(np.maximum(1, deg_end_min))
-                n_t = N_POLY*self.N_DER
-                constraints.append(x[n_t+deg_min_t:n_t+deg_end_max+1] == 0)
-                constraints.append(x[n_t+n+deg_min_t:n_t+n+deg_end_max+1] == 0)
-                constraints.append(x[n_t+2*n+deg_min_t:n_t+2*n+deg_end_max+1] == 0)
-
-            # Form objective.
-            obj = Minimize(0.5*quad_form(x, Q_obj))
-
-            # Form and solve problem.
-            prob = Problem(obj, constraints)
-            try:
-                if self.qp_optimizer == 'osqp':
-                    prob.solve(solver=cp.OSQP, verbose=False)
-                elif self.qp_optimizer == 'gurobi':
-                    prob.solve(solver=cp.GUROBI, verbose=False)
-                elif self.qp_optimizer == 'cvxopt':
-                    prob.solve(solver=cp.CVXOPT, verbose=False)
-                else:
-                    continue
-            except cp.error.DCPError:
-                continue
-            except cp.error.SolverError:
+        N_setup = 0
+        for round_ii in range(self.lazy_max_round):
+            row_idx_set = [np.where(mask.ravel())[0] for mask in mask_set]
+            A_corr, l_corr = self._get_corridor_rows(V_seg, plane_pos_set, row_idx_set, n, flag_loop=flag_loop)
+            A = sparse.vstack([A_corr, A_eq], format='csc')
+            l = np.concatenate([l_corr, b_eq])
+            u = np.concatenate([np.inf*np.ones(l_corr.shape[0]), b_eq])
+
+            solver = qp_data["solver"]
+            if round_ii == 0 and solver is not None \
+                    and np.array_equal(P.indices, qp_data["P_indices"]) and np.array_equal(P.indptr, qp_data["P_indptr"]) \
+                    and np.array_equal(A.indices, qp_data["A_indices"]) and np.array_equal(A.indptr, qp_data["A_indptr"]):
+                # Same rows as the stored workspace, only the values change
+                solver.update(Px=P.data, Ax=A.data, l=l, u=u)
+                # Derivative k of the last solution scales with (t_scale_prev/t_scale)^k
+                x_scale = np.tile(self.generate_basis(qp_data["t_scale"]/t_scale,self.N_DER-1,0), \
+                    np.int(N_var/self.N_DER))
+                solver.warm_start(x=qp_data["x"]*x_scale, y=qp_data["y"])
+            else:
+                solver = osqp.OSQP()
+                solver.setup(P=P, q=np.zeros(N_var), A=A, l=l, u=u, verbose=False, \
+                    warm_start=True, eps_abs=eps, eps_rel=eps, max_iter=10000, polish=True)
+                N_setup += 1
+                if round_ii > 0:
+                    solver.warm_start(x=x_prev, y=y_prev)
+            res = solver.solve()
+            if res.info.status not in ["solved", "solved inaccurate"]:
+                break
+
+            # Check all samples on the segment blocks, keep the multipliers of the rows that were solved with
+            x_block = res.x.reshape(3,-1,self.N_DER)
+            d_seg = np.concatenate([x_block[:,seg_idx,:], x_block[:,seg_idx_n,:]], axis=2)
+            flag_violated = False
+            dual_set = []
+            y_set = []
+            N_row = 0
+            for p_ii in range(len(mask_set)):
+                pos = V_seg[p_ii].dot(d_seg[:,p_ii,:].T)
+                slack = plane_pos_set.V_norm[p_ii].dot(pos.T) - plane_pos_set.V_bias[p_ii][:,None]
+                y_full = np.zeros(mask_set[p_ii].size)
+                y_full[row_idx_set[p_ii]] = res.y[N_row:N_row+row_idx_set[p_ii].shape[0]]
+                N_row += row_idx_set[p_ii].shape[0]
+                dual_set.append(-y_full.reshape(mask_set[p_ii].shape))
+                violated = (slack < -eps) & ~mask_set[p_ii]
+                if np.any(violated):
+                    flag_violated = True
+                    mask_set[p_ii] = mask_set[p_ii] | violated
+                y_set.append(y_full[mask_set[p_ii].ravel()])
+            if not flag_violated:
+                break
+            x_prev = res.x
+            y_prev = np.concatenate(y_set + [res.y[N_row:]])
+
+        N_row_full = np.sum([mask.size for mask in mask_set])
+        N_row_lazy = np.sum([np.sum(mask) for mask in mask_set])
+        self.lazy_info = dict(round=round_ii+1, setup=N_setup, rows=N_row_lazy, rows_full=N_row_full, \
+            active=np.sum([np.sum(dual > eps) for dual in dual_set]) if res.info.status in ["solved", "solved inaccurate"] else 0)
+
+        if res.info.status in ["solved", "solved inaccurate"]:
+            if flag_violated:
+                prRed("[snap_obj] Lazy corridor rows did not converge in {} rounds".format(self.lazy_max_round))
+            else:
+                # The workspace matches mask_set, reused by the next call on the course
+                qp_data = dict(mask_set=mask_set, solver=solver, x=res.x, y=res.y, t_scale=t_scale, \
+                    P_indices=P.indices, P_indptr=P.indptr, A_indices=A.indices, A_indptr=A.indptr)
+            qp_data["mask_set"] = mask_set
+            self._lru_set(self._lazy_qp_cache, qp_key, qp_data, self.qp_cache_size)
+            return "optimal", res.x, dual_set
+        elif res.info.status in ["primal infeasible", "primal infeasible inaccurate"]:
+            return "infeasible", None, None
+        elif res.info.status in ["dual infeasible", "dual infeasible inaccurate"]:
+            return "unbounded", None, None
+        else:
+            return res.info.status, None, None
+
+    def _solve_snap_qp(self, x_t, points, plane_pos_set, waypoints, t_scale, \
+                       deg_init_min=0, deg_init_max=4, deg_end_min=0, deg_end_max=0, \
+                       flag_init_point=True, flag_loop=False, qp_blocks=None):
+        """Solves the corridor QP with the selected qp_optimizer
+
+        qp_blocks: (Q_blocks, V_seg) of x_t from get_snap_qp_blocks_batch, computed here if None
+
+        Returns:
+            prob_status: cvxpy problem status, None if the solver failed
+            x_value: solution, None if not available
+            dual_set: list of (N_plane, N_row) multipliers of the corridor rows, None if not available
+        """
+        if self.flag_lazy_corridor:
+            return self._solve_snap_qp_lazy( \
+                x_t, points, plane_pos_set, waypoints, t_scale, \
+                deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
+                deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
+                flag_init_point=flag_init_point, flag_loop=flag_loop, qp_blocks=qp_blocks)
+
+        if self.qp_optimizer == 'osqp_native':
+            return self._solve_snap_qp_osqp( \
+                x_t, points, plane_pos_set, waypoints, t_scale, \
+                deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
+                deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
+                flag_init_point=flag_init_point, flag_loop=flag_loop, qp_blocks=qp_blocks)
+
+        if self.flag_compiled_qp:
+            prob, x, corridor_set = self._get_snap_qp_compiled( \
+                x_t, points, plane_pos_set, waypoints, t_scale, \
+                deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
+                deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
+                flag_init_point=flag_init_point, flag_loop=flag_loop, qp_blocks=qp_blocks)
+        else:
+            prob, x, corridor_set = self._generate_snap_qp( \
+                x_t, points, plane_pos_set, waypoints, \
+                deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
+                deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
+                flag_init_point=flag_init_point, flag_loop=flag_loop, qp_blocks=qp_blocks)
+
+        try:
+            if self.qp_optimizer == 'osqp':
+                prob.solve(solver=cp.OSQP, verbose=False)
+            elif self.qp_optimizer == 'gurobi':
+                prob.solve(solver=cp.GUROBI, verbose=False)
+            elif self.qp_optimizer == 'cvxopt':
+                prob.solve(solver=cp.CVXOPT, verbose=False)
+            else:
+                return None, None, None
+        except cp.error.DCPError:
+            return None, None, None
+        except cp.error.SolverError:
+            return None, None, None
+        # The compiled problem keeps the values of the previous solve
+        dual_set = []
+        for p_ii in range(len(corridor_set)):
+            if corridor_set[p_ii].dual_value is None:
+                dual_set = None
+                break
+            dual_set.append(np.reshape(corridor_set[p_ii].dual_value, \
+                (-1,self.get_corridor_row_count(self.get_corridor_mode(plane_pos_set)))))
+        return prob.status, x.value, dual_set
+
+    def get_t_scale_list(self, course_id=None):
+        """Fallback ladder of time scales for snap_obj
+
+        Starts from the scale that last succeeded on the course, followed by
+        the default ladder [s, 2s, s/2, 4s, s/4] with s = default_t_set_scale.
+        """
+        t_scale_list = [self.default_t_set_scale]
+        for i in range(1,3):
+            t_scale_list.append(self.default_t_set_scale*np.power(2,i))
+            t_scale_list.append(self.default_t_set_scale/np.power(2,i))
+        if self.flag_t_scale_memory and course_id in self._t_scale_course:
+            t_scale_last = self._t_scale_course[course_id]
+            t_scale_list = [t_scale_last] + [x for x in t_scale_list if x != t_scale_last]
+        return t_scale_list
+
+    def get_t_scale_stats(self):
+        """Returns the number of attempts and successes of each t_scale rung"""
+        return copy.deepcopy(self.t_scale_stats)
+
+    def reset_t_scale_stats(self):
+        self.t_scale_stats = dict()
+        self._t_scale_course = dict()
+
+    def get_snap_obj_grad(self, t_set, d_ordered, plane_pos_set, dual_set, der=4, flag_loop=False):
+        """Gradient of the optimal snap cost with respect to t_set
+
+        Envelope theorem at the QP optimum: only the objective and the corridor rows
+        depend on t_set, so d res/dt = d^T dQ/dt d - 2*dual^T d(V*d)/dt.
+
+        Args:
+            d_ordered: (N_DER*N_wp, 3) optimal derivatives at t_set
+            dual_set: list of (N_plane, N_row) corridor multipliers of 0.5*d^T Q d at t_set
+        Returns:
+            grad: np array of len t_set.shape[0]
+        """
+        N_POLY = t_set.shape[0]
+        seg_idx = np.arange(N_POLY)
+        if flag_loop:
+            seg_idx_n = (seg_idx+1)%N_POLY
+        else:
+            seg_idx_n = seg_idx+1
+        d_block = d_ordered.reshape(-1,self.N_DER,3)
+        d_seg = np.concatenate([d_block[seg_idx,:,:], d_block[seg_idx_n,:,:]], axis=1)
+        
+        dQ_blocks = self.generate_sum_blocks(t_set, der=der, flag_grad=True)
+        grad = np.einsum('pad,pab,pbd->p', d_seg, dQ_blocks, d_seg)
+        
+        if dual_set is not None:
+            corridor_mode = self.get_corridor_mode(plane_pos_set)
+            k = np.tile(np.arange(self.N_DER), 2)
+            for p_ii in range(len(dual_set)):
+                dV_seg = self._get_segment_sampling_matrix(t_set, p_ii, flag_loop=flag_loop, \
+                    corridor_mode=corridor_mode)*k[None,:]/t_set[p_ii]
+                dpos = dV_seg.dot(d_seg[p_ii,:,:])
+                grad[p_ii] -= 2*np.sum(np.multiply(dual_set[p_ii], plane_pos_set.V_norm[p_ii].dot(dpos.T)))
+        return grad
+
+    def get_acc_obj_grad(self, t_set, d_ordered_yaw, der=2, flag_loop=False):
+        """Gradient of the yaw cost trace(d^T Q_yaw d) with respect to t_set at the optimal d_ordered_yaw"""
+        N_POLY = t_set.shape[0]
+        seg_idx = np.arange(N_POLY)
+        if flag_loop:
+            seg_idx_n = (seg_idx+1)%N_POLY
+        else:
+            seg_idx_n = seg_idx+1
+        d_block = d_ordered_yaw.reshape(-1,self.N_DER_YAW,d_ordered_yaw.shape[1])
+        d_seg = np.concatenate([d_block[seg_idx,:,:], d_block[seg_idx_n,:,:]], axis=1)
+        dQ_blocks = self.generate_sum_blocks(t_set, der=der, flag_yaw=True, flag_grad=True)
+        return np.einsum('pad,pab,pbd->p', d_seg, dQ_blocks, d_seg)
+
+    def snap_obj(self, t_set, points, plane_pos_set, waypoints,\
+                 deg_init_min=0, deg_init_max=4, deg_end_min=0, deg_end_max=0, \
+                 flag_init_point=True, flag_fixed_point=False, flag_fixed_end_point=False, \
+                 flag_grad=False, qp_blocks=None):
+        """
+        qp_blocks: (Q_blocks, V_seg) of t_set from get_snap_qp_blocks_batch, rescaled for every t_scale tried
+        Returns:
+            res: snap cost at t_set
+            d_ordered: (N_DER*N_wp, 3) np array
+            grad (optional): gradient of res with respect to t_set if flag_grad
+        """
+
+        N_wp = points.shape[0]
+        flag_loop = self.check_flag_loop(t_set,points)
+        N_POLY = t_set.shape[0]
+        plane_pos_set = self.get_compiled_course(plane_pos_set)
+        if flag_loop:
+            n = N_POLY*self.N_DER
+        else:
+            n = (N_POLY+1)*self.N_DER
+
+        t_scale_list = self.get_t_scale_list(plane_pos_set.course_id)
+
+        t_set_scale = t_scale_list[0]
+        for t_scale in t_scale_list:
+            t_set_scale = t_scale
+            self.t_scale_stats.setdefault(t_scale, dict(attempt=0, success=0))
+            self.t_scale_stats[t_scale]["attempt"] += 1
+            x_t = t_set*t_set_scale
+            if qp_blocks is None:
+                qp_blocks_t = None
+            else:
+                qp_blocks_t = self.scale_snap_qp_blocks(qp_blocks, t_set_scale)
+            prob_status, x_value, dual_set = self._solve_snap_qp( \
+                x_t, points, plane_pos_set, waypoints, t_scale, \
+                deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
+                deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
+                flag_init_point=flag_init_point, flag_loop=flag_loop, qp_blocks=qp_blocks_t)
+            if prob_status is None:
                 continue
 
-            if prob.status not in ["infeasible", "unbounded"] and np.all(x.value != None):
-                if self.default_t_set_scale != t_scale:
-                    prRed("[snap_obj] Update t_scale from {} to {}.".format(self.default_t_set_scale, t_scale))
-                    # self.default_t_set_scale = t_scale
+            if prob_status not in ["infeasible", "unbounded"] and np.all(x_value != None):
+                self.t_scale_stats[t_scale]["success"] += 1
+                if t_scale_list[0] != t_scale:
+                    prRed("[snap_obj] Update t_scale from {} to {}.".format(t_scale_list[0], t_scale))
+                    self._t_scale_course[plane_pos_set.course_id] = t_scale
                 break
             else:
-                prRed(prob.status)
-        
-        if prob.status in ["infeasible", "unbounded"]:
+                prRed(prob_status)
+
+        if prob_status in ["infeasible", "unbounded"]:
             prRed("[snap_obj] Failed to optimize t_set")
             return
-        elif np.any(x.value == None):
+        elif np.any(x_value == None):
             prRed("[snap_obj] x value is None")
             d_ordered = np.zeros((n,3))
             for i in range(N_wp):
                 d_ordered[i*self.N_DER,:] = points[i,:3]
+            if flag_grad:
+                return np.inf, d_ordered, np.zeros(N_POLY)
             return np.inf, d_ordered
 #             return np.finfo('d').max, d_ordered
-        
+
         d_ordered = np.zeros((n,3))
-        d_ordered[:,0] = x.value[:n]
-        d_ordered[:,1] = x.value[n:2*n]
-        d_ordered[:,2] = x.value[2*n:]
-        
+        d_ordered[:,0] = x_value[:n]
+        d_ordered[:,1] = x_value[n:2*n]
+        d_ordered[:,2] = x_value[2*n:]
+
         d_ordered_ret = self.get_alpha_matrix(1/t_set_scale,N_wp).dot(d_ordered)
-        d_ordered_all = np.vstack([d_ordered_ret[:,0:1],d_ordered_ret[:,1:2],d_ordered_ret[:,2:3]])
-        
-        Q_pos = self.generate_sum_matrix(t_set, der=4, flag_loop=flag_loop)    
-        Q_obj = scipy.linalg.block_diag(Q_pos,Q_pos,Q_pos)
-        res = d_ordered_all.T.dot(Q_obj).dot(d_ordered_all)
-        
+
+        # Same as d_ordered_all^T blockdiag(Q_pos,Q_pos,Q_pos) d_ordered_all
+        Q_pos = self.generate_sum_matrix(t_set, der=4, flag_loop=flag_loop, flag_sparse=True, \
+            blocks=None if qp_blocks is None else qp_blocks[0])
+        res = np.sum(np.multiply(d_ordered_ret, Q_pos.dot(d_ordered_ret)))
+
+        if flag_grad:
+            # Corridor rows are scale invariant while the cost scales with t_set_scale^-(2*der-1)
+            if dual_set is not None:
+                dual_set = [x*np.power(t_set_scale, 7) for x in dual_set]
+            grad = self.get_snap_obj_grad(t_set, d_ordered_ret, plane_pos_set, dual_set, der=4, flag_loop=flag_loop)
+            return res, d_ordered_ret, grad
         return res, d_ordered_ret
-    
+
     def acc_obj(self, t_set, b, b_ext_init=None, b_ext_end=None, 
                  deg_init_min=0, deg_init_max=2, deg_end_min=0, deg_end_max=0):
         flag_loop = self.check_flag_loop(t_set,b)
@@ -516,12 +1300,73 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
             res = 1e10
         return res, d_ordered
     
+    def acc_obj_batch(self, t_batch, b, deg_init_min=0, deg_init_max=2, deg_end_min=0, deg_end_max=0):
+        """Batched acc_obj with zero b_ext_init and b_ext_end
+
+        Args:
+            t_batch: (B, N_POLY) np array
+            b: (N_wp, 2) or (B, N_wp, 2) np array
+        Returns:
+            res: (B,) np array
+            d_ordered: (B, N_DER_YAW*N_wp, 2) np array
+        """
+        B = t_batch.shape[0]
+        flag_loop = self.check_flag_loop(t_batch[0,:],b[0] if b.ndim == 3 else b)
+        if b.ndim == 2:
+            b = np.repeat(b[None,:,:], B, axis=0)
+        N_b = b.shape[1]
+        b_ext_init = np.zeros((B,deg_init_max-deg_init_min,b.shape[2]))
+        b_ext_end = np.zeros((B,deg_end_max-deg_end_min,b.shape[2]))
+        
+        if flag_loop:
+            P = self.generate_perm_matrix(t_batch.shape[1]-1, self.N_DER_YAW)
+        else:
+            P = self.generate_perm_matrix(t_batch.shape[1], self.N_DER_YAW)
+        
+        Q_yaw = self.generate_sum_matrix_yaw_batch(t_batch, der=2, flag_loop=flag_loop)
+        R = np.matmul(np.matmul(P[None,:,:], Q_yaw), P.T[None,:,:])
+        
+        if flag_loop:
+            R_idx = np.concatenate((np.arange(N_b,N_b+deg_init_min),
+                                    np.arange(N_b+deg_init_max,R.shape[1])), axis=0)
+        else:
+            R_idx = np.concatenate((np.arange(N_b,N_b+deg_init_min),
+                                    np.arange(N_b+deg_init_max,R.shape[1]-self.N_DER+1+deg_end_min),
+                                    np.arange(R.shape[1]-self.N_DER+1+deg_end_max,R.shape[1])), axis=0)
+        Rpp = R[:,R_idx[:,None],R_idx[None,:]]
+        Rpp_inv = np.zeros_like(Rpp)
+        flag_cond = np.linalg.cond(Rpp) < 1/np.finfo(Rpp.dtype).eps
+        if np.any(flag_cond):
+            Rpp_inv[flag_cond] = np.linalg.inv(Rpp[flag_cond])
+        if np.any(~flag_cond):
+            Rpp_inv[~flag_cond] = np.linalg.pinv(Rpp[~flag_cond])
+        R_fp = R[:,np.arange(N_b)[:,None],R_idx[None,:]]
+        d_p = -np.matmul(np.matmul(Rpp_inv, np.transpose(R_fp,(0,2,1))), b)
+        N_p = d_p.shape[1]
+        if flag_loop:
+            d_tmp = np.concatenate((b,
+                                  d_p[:,:deg_init_min,:],
+                                  b_ext_init,
+                                  d_p[:,deg_init_min:,:]),axis=1)
+        else:
+            d_tmp = np.concatenate((b,
+                                  d_p[:,:deg_init_min,:],
+                                  b_ext_init,
+                                  d_p[:,deg_init_min:N_p-self.N_DER+1+deg_end_max,:],
+                                  b_ext_end,
+                                  d_p[:,N_p-self.N_DER+1+deg_end_max:,:]),axis=1)
+        res = np.einsum('bij,bik,bkj->b', d_tmp, R, d_tmp)
+        d_ordered = np.matmul(P.T[None,:,:], d_tmp)
+        
+        res[res < -1e-3] = 1e10
+        return res, d_ordered
+    
     def snap_acc_obj(self, t_set, points, plane_pos_set, waypoints,\
                      deg_init_min=0, deg_init_max=4, deg_end_min=0, deg_end_max=0, \
                      deg_init_yaw_min=0, deg_init_yaw_max=4, deg_end_yaw_min=0, deg_end_yaw_max=0, \
                      flag_init_point=True, flag_fixed_point=False, \
                      flag_fixed_end_point=False, \
-                     yaw_mode=0, kt=0, mu=1.0):
+                     yaw_mode=0, kt=0, mu=1.0, flag_grad=False):
         """
         Computes the snap acceleration objective for a given set of waypoints and time intervals.
         Parameters:
@@ -542,18 +1387,22 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         yaw_mode (int, optional): Mode for yaw calculation. Default is 0.
         kt (float, optional): Weight for time intervals. Default is 0.
         mu (float, optional): Weight for yaw objective. Default is 1.0.
+        flag_grad (bool, optional): Also return the gradient of res with respect to t_set. Default is False.
+            The yaw boundary values of yaw_mode 1 are treated as constant.
         Returns:
         tuple: A tuple containing:
             - res (float): The computed snap acceleration objective.
             - d_ordered_ret (numpy.ndarray): The ordered derivatives for position.
             - d_ordered_yaw_ret (numpy.ndarray): The ordered derivatives for yaw.
+            - grad (numpy.ndarray, optional): Gradient of res with respect to t_set if flag_grad.
         """
         pos_obj = lambda x: self.snap_obj( \
              x, points, plane_pos_set, waypoints, \
              deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
              deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
              flag_fixed_end_point=flag_fixed_end_point,\
-             flag_init_point=flag_init_point, flag_fixed_point=flag_fixed_point)
+             flag_init_point=flag_init_point, flag_fixed_point=flag_fixed_point, \
+             flag_grad=flag_grad)
         
         yaw_obj = lambda x, b: self.acc_obj( \
              x, b, \
@@ -566,25 +1415,59 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         else:
             t_set_scale = 1.0
         x_t = t_set*t_set_scale
-        res, d_ordered = pos_obj(x_t)
-        if yaw_mode == 0:
-            b_yaw = np.zeros((points.shape[0],2))
-            b_yaw[:,0] = 1
-        elif yaw_mode == 1:
-            b_yaw = self.get_yaw_forward(x_t, d_ordered)
-        elif yaw_mode == 2:
-            if points.shape[1] != 4:
-                print("Wrong points format. Append yaw column")
-            b_yaw = np.zeros((points.shape[0],2))
-            b_yaw[:,0] = np.cos(points[:,-1])
-            b_yaw[:,1] = np.sin(points[:,-1])
+        
+        # With kt=0 every t_set on the same ray solves the same problem at x_t
+        traj = None
+        if kt == 0:
+            ray_key = self.get_snap_acc_ray_key(x_t, points, plane_pos_set, waypoints, \
+                deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
+                deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
+                deg_init_yaw_min=deg_init_yaw_min, deg_init_yaw_max=deg_init_yaw_max, \
+                deg_end_yaw_min=deg_end_yaw_min, deg_end_yaw_max=deg_end_yaw_max, \
+                flag_init_point=flag_init_point, flag_fixed_point=flag_fixed_point, \
+                flag_fixed_end_point=flag_fixed_end_point, yaw_mode=yaw_mode, mu=mu)
+            traj = self.get_traj_memo(ray_key, stat_prefix="ray_")
+            if traj is not None and flag_grad and np.all(traj[3] == None):
+                traj = None
+        
+        if traj is None:
+            if flag_grad:
+                res, d_ordered, grad_x = pos_obj(x_t)
+            else:
+                res, d_ordered = pos_obj(x_t)
+                grad_x = None
+            if yaw_mode == 0:
+                b_yaw = np.zeros((points.shape[0],2))
+                b_yaw[:,0] = 1
+            elif yaw_mode == 1:
+                b_yaw = self.get_yaw_forward(x_t, d_ordered)
+            elif yaw_mode == 2:
+                if points.shape[1] != 4:
+                    print("Wrong points format. Append yaw column")
+                b_yaw = np.zeros((points.shape[0],2))
+                b_yaw[:,0] = np.cos(points[:,-1])
+                b_yaw[:,1] = np.sin(points[:,-1])
+            else:
+                raise("Wrong yaw_mode")
+            res_yaw, d_ordered_yaw = yaw_obj(x=x_t, b=b_yaw)
+            res += mu*res_yaw + kt*np.sum(x_t)
+            if flag_grad:
+                flag_loop = self.check_flag_loop(x_t,b_yaw)
+                grad_x += mu*self.get_acc_obj_grad(x_t, d_ordered_yaw, der=2, flag_loop=flag_loop) + kt
+            if kt == 0:
+                self.set_traj_memo(ray_key, (res, d_ordered, d_ordered_yaw, grad_x))
         else:
-            raise("Wrong yaw_mode")
-        res_yaw, d_ordered_yaw = yaw_obj(x=x_t, b=b_yaw)
-        res += mu*res_yaw + kt*np.sum(x_t)
+            res, d_ordered, d_ordered_yaw, grad_x = traj
         
         d_ordered_ret = self.get_alpha_matrix(1/t_set_scale,N_wp).dot(d_ordered)
         d_ordered_yaw_ret = self.get_alpha_matrix_yaw(1/t_set_scale,N_wp).dot(d_ordered_yaw)
+        if flag_grad:
+            if kt == 0:
+                # x_t = t_set*10*N/sum(t_set) only depends on the direction of t_set
+                grad = t_set_scale*(grad_x - grad_x.dot(t_set)/np.sum(t_set))
+            else:
+                grad = grad_x
+            return res, d_ordered_ret, d_ordered_yaw_ret, grad
         return res, d_ordered_ret, d_ordered_yaw_ret
     
     ###############################################################################
@@ -596,21 +1479,38 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
                           deg_end_yaw_min=0, deg_end_yaw_max=0, \
                           t_set_init=None,
                           mu=1.0, kt=0, flag_fixed_end_point=False, \
-                          flag_rand_init=False, flag_numpy_opt=False, flag_scipy_opt=True):
-        pos_yaw_obj = lambda x: self.snap_acc_obj(
-            t_set=x, points=points, plane_pos_set=plane_pos_set, \
+                          flag_rand_init=False, flag_numpy_opt=False, flag_scipy_opt=True, \
+                          flag_analytic_grad=True, waypoints=None):
+        plane_pos_set = self.get_compiled_course(plane_pos_set)
+        if np.all(waypoints == None):
+            waypoints = plane_pos_set.waypoints
+        pos_yaw_obj = lambda x, flag_grad=False: self.snap_acc_obj(
+            t_set=x, points=points, plane_pos_set=plane_pos_set, waypoints=waypoints, \
             deg_init_min=deg_init_min, deg_init_max=deg_init_max, \
             deg_end_min=deg_end_min, deg_end_max=deg_end_max, \
             deg_init_yaw_min=deg_init_yaw_min, deg_init_yaw_max=deg_init_yaw_max, \
             deg_end_yaw_min=deg_end_yaw_min, deg_end_yaw_max=deg_end_yaw_max, \
             flag_init_point=True, flag_fixed_point=False, \
             flag_fixed_end_point=flag_fixed_end_point, \
-            yaw_mode=yaw_mode, kt=kt, mu=mu)
+            yaw_mode=yaw_mode, kt=kt, mu=mu, flag_grad=flag_grad)
         
         def f_obj(x):
             res, d_ordered, d_ordered_yaw = pos_yaw_obj(x)
             return res
         
+        # L-BFGS-B evaluates fprime right after f_obj at the same point
+        grad_cache = dict(x=None, grad=None)
+        def f_obj_grad(x):
+            res, d_ordered, d_ordered_yaw, grad = pos_yaw_obj(x, flag_grad=True)
+            grad_cache["x"] = np.array(x)
+            grad_cache["grad"] = grad
+            return res
+        
+        def f_grad(x):
+            if np.all(grad_cache["x"] == None) or np.any(grad_cache["x"] != x):
+                f_obj_grad(x)
+            return grad_cache["grad"]
+        
         if flag_loop:
             N_POLY = len(plane_pos_set)
         else:
@@ -687,10 +1587,15 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
             for i in range(t_set.shape[0]):
                 bounds.append((0.01, 100.0))
 
-            res_x, res_f, res_d = scipy.optimize.fmin_l_bfgs_b(\
-                                        f_obj, x0=t_set, bounds=bounds, \
-                                        approx_grad=True, epsilon=1e-4, maxiter=MAX_ITER, \
-                                        iprint=1)
+            if flag_analytic_grad:
+                res_x, res_f, res_d = scipy.optimize.fmin_l_bfgs_b(\
+                                            f_obj_grad, x0=t_set, fprime=f_grad, bounds=bounds, \
+                                            maxiter=MAX_ITER, iprint=1)
+            else:
+                res_x, res_f, res_d = scipy.optimize.fmin_l_bfgs_b(\
+                                            f_obj, x0=t_set, bounds=bounds, \
+                                            approx_grad=True, epsilon=1e-4, maxiter=MAX_ITER, \
+                                            iprint=1)
             t_set = np.array(res_x)
         
         rel_snap, d_ordered, d_ordered_yaw = pos_yaw_obj(t_set)
@@ -703,6 +1608,210 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         
         return self.optimize_alpha(points_new, t_set, d_ordered, d_ordered_yaw, alpha_scale)
     
+    def reset_traj_memo(self):
+        self._traj_memo = OrderedDict()
+        self._traj_memo_bytes = 0
+        self.traj_memo_stats = dict(hit=0, miss=0, ray_hit=0, ray_miss=0, evict=0)
+
+    def get_solver_memo_key(self):
+        # Solver options of the corridor QP, memoized solutions of other settings are not reused
+        return (self.qp_optimizer, self.flag_compiled_qp, \
+                self.flag_lazy_corridor, self.lazy_stride, self.lazy_max_round)
+
+    def get_traj_memo_key(self, t_set, points, plane_pos_set, waypoints, alpha_set, \
+                          yaw_mode=0, flag_fixed_end_point=True, flag_fixed_point=False):
+        plane_pos_set = self.get_compiled_course(plane_pos_set)
+        alpha_q = np.round(np.array(alpha_set, dtype=np.float64)/self.traj_memo_quantum).astype(np.int64)
+        return (plane_pos_set.course_id, self.get_corridor_mode(plane_pos_set), \
+                np.array(t_set, dtype=np.float64).tobytes(), np.array(points, dtype=np.float64).tobytes(), \
+                tuple(waypoints), alpha_q.tobytes(), yaw_mode, flag_fixed_end_point, flag_fixed_point) \
+                + self.get_solver_memo_key()
+
+    def get_ray_memo_key(self, x_t, points, plane_pos_set, waypoints, *args):
+        """Memo key of snap_acc_obj with kt=0, x_t is the normalized time allocation 10*N*t_set/sum(t_set)
+
+        args: remaining snap_acc_obj options that change the solution
+        """
+        plane_pos_set = self.get_compiled_course(plane_pos_set)
+        x_q = np.round(np.array(x_t, dtype=np.float64)/(10.0*x_t.shape[0])/self.traj_memo_quantum).astype(np.int64)
+        return ("ray", plane_pos_set.course_id, self.get_corridor_mode(plane_pos_set), \
+                np.array(points, dtype=np.float64).tobytes(), tuple(waypoints), x_q.tobytes()) \
+                + self.get_solver_memo_key() + tuple(args)
+
+    def get_snap_acc_ray_key(self, x_t, points, plane_pos_set, waypoints, \
+                             deg_init_min=0, deg_init_max=4, deg_end_min=0, deg_end_max=0, \
+                             deg_init_yaw_min=0, deg_init_yaw_max=4, deg_end_yaw_min=0, deg_end_yaw_max=0, \
+                             flag_init_point=True, flag_fixed_point=False, flag_fixed_end_point=False, \
+                             yaw_mode=0, mu=1.0):
+        """get_ray_memo_key of snap_acc_obj with the same options"""
+        return self.get_ray_memo_key(x_t, points, plane_pos_set, waypoints, \
+            deg_init_min, deg_init_max, deg_end_min, deg_end_max, \
+            deg_init_yaw_min, deg_init_yaw_max, deg_end_yaw_min, deg_end_yaw_max, \
+            flag_init_point, flag_fixed_point, flag_fixed_end_point, yaw_mode, mu)
+
+    def get_traj_memo(self, memo_key, stat_prefix=""):
+        """Returns a copy of the memoized (t_set_new, d_ordered, d_ordered_yaw) or None"""
+        if not self.flag_traj_memo:
+            return None
+        traj = self._traj_memo.get(memo_key, None)
+        if traj is None:
+            self.traj_memo_stats[stat_prefix+"miss"] += 1
+            return None
+        self.traj_memo_stats[stat_prefix+"hit"] += 1
+        self._traj_memo.move_to_end(memo_key)
+        return copy.deepcopy(traj)
+
+    def set_traj_memo(self, memo_key, traj):
+        if not self.flag_traj_memo:
+            return
+        if memo_key in self._traj_memo:
+            traj_old = self._traj_memo.pop(memo_key)
+            self._traj_memo_bytes -= np.sum([x.nbytes for x in traj_old if isinstance(x, np.ndarray)])
+        traj = copy.deepcopy(traj)
+        self._traj_memo[memo_key] = traj
+        self._traj_memo_bytes += np.sum([x.nbytes for x in traj if isinstance(x, np.ndarray)])
+        while self._traj_memo_bytes > self.traj_memo_max_bytes and len(self._traj_memo) > 0:
+            _, traj_old = self._traj_memo.popitem(last=False)
+            self._traj_memo_bytes -= np.sum([x.nbytes for x in traj_old if isinstance(x, np.ndarray)])
+            self.traj_memo_stats["evict"] += 1
+
+    def reset_feas_index(self):
+        self._feas_index = dict()
+        self.feas_index_stats = dict(hit=0, miss=0, conflict=0)
+
+    def get_feas_index_key(self, t_set_new, points, plane_pos_set, waypoints, *args):
+        """Key of the time-ratio direction t_set_new/sum(t_set_new)
+
+        args: remaining options that change the trajectory
+        """
+        plane_pos_set = self.get_compiled_course(plane_pos_set)
+        t_set_new = np.array(t_set_new, dtype=np.float64)
+        u_q = np.round(t_set_new/np.sum(t_set_new)/self.feas_index_quantum).astype(np.int64)
+        return (plane_pos_set.course_id, self.get_corridor_mode(plane_pos_set), \
+                np.array(points, dtype=np.float64).tobytes(), tuple(waypoints), u_q.tobytes()) \
+                + self.get_solver_memo_key() + tuple(args)
+
+    def get_feas_index(self, feas_key, t_total):
+        """Classifies the total time t_total on the direction of feas_key
+
+        Uniform time scaling by alpha multiplies the k-th derivative by alpha^-k,
+        so along a direction feasibility is a threshold on the total time.
+
+        Returns:
+            label: True/False if the stored bracket decides it, None if it has to be evaluated
+        """
+        if not self.flag_feas_index:
+            return None
+        bracket = self._feas_index.get(feas_key, None)
+        label = None
+        if bracket is not None:
+            t_infeas, t_feas = bracket
+            if t_total >= t_feas:
+                label = True
+            elif t_total <= t_infeas:
+                label = False
+            elif self.flag_feas_index_midpoint and t_feas - t_infeas <= self.feas_index_rtol*t_feas:
+                label = t_total >= 0.5*(t_infeas + t_feas)
+        if label is None:
+            self.feas_index_stats["miss"] += 1
+        else:
+            self.feas_index_stats["hit"] += 1
+        return label
+
+    def set_feas_index(self, feas_key, t_total, label):
+        """Tightens the bracket (largest infeasible, smallest feasible total time) of the direction
+
+        t_total=np.inf with label False marks a direction where the QP fails, infeasible at every total time.
+        """
+        if not self.flag_feas_index:
+            return
+        t_infeas, t_feas = self._feas_index.get(feas_key, (0.0, np.inf))
+        if not label and not np.isfinite(t_total):
+            if np.isfinite(t_feas):
+                # A feasible total time was stored for the direction or its bin
+                self.feas_index_stats["conflict"] += 1
+            self._feas_index[feas_key] = (np.inf, np.inf)
+            return
+        if label:
+            t_feas = min(t_feas, t_total)
+        else:
+            t_infeas = max(t_infeas, t_total)
+        if t_infeas >= t_feas and np.isfinite(t_total):
+            # Not monotone along the direction, or a neighbouring direction in the same bin
+            self.feas_index_stats["conflict"] += 1
+            if label:
+                t_infeas, t_feas = 0.0, t_total
+            else:
+                t_infeas, t_feas = t_total, np.inf
+        self._feas_index[feas_key] = (t_infeas, t_feas)
+
+    def search_margin_threshold(self, margin_fn, rtol=1e-2, max_expand=6):
+        """Smallest alpha with margin_fn(alpha) > 0, assuming the margin grows with alpha
+
+        Starts from alpha=1, doubles/halves until the sign changes and then
+        interpolates the margin in log(alpha) (safeguarded false position).
+
+        Returns:
+            alpha_lo: largest infeasible alpha found, None if every probe was feasible
+            alpha_hi: smallest feasible alpha found, None if every probe was infeasible
+        """
+        alpha_lo, alpha_hi = None, None
+        margin_lo, margin_hi = None, None
+        alpha = 1.0
+        for it in range(max_expand+1):
+            margin = margin_fn(alpha)
+            if margin > 0:
+                alpha_hi, margin_hi = alpha, margin
+            else:
+                alpha_lo, margin_lo = alpha, margin
+            if alpha_lo is not None and alpha_hi is not None:
+                break
+            if alpha_lo is None:
+                alpha = 0.5*alpha_hi
+            else:
+                alpha = 2.0*alpha_lo
+        
+        if alpha_lo is None or alpha_hi is None:
+            return alpha_lo, alpha_hi
+        while alpha_hi - alpha_lo > rtol*alpha_hi:
+            log_lo = np.log(alpha_lo)
+            log_hi = np.log(alpha_hi)
+            alpha = np.sqrt(alpha_lo*alpha_hi)
+            if np.isfinite(margin_lo) and np.isfinite(margin_hi) and margin_hi > margin_lo:
+                log_alpha = log_lo + (log_hi-log_lo)*(-margin_lo)/(margin_hi-margin_lo)
+                # Stay away from the ends so the bracket keeps shrinking from both sides
+                log_alpha = np.clip(log_alpha, log_lo+0.1*(log_hi-log_lo), log_hi-0.1*(log_hi-log_lo))
+                alpha = np.exp(log_alpha)
+            margin = margin_fn(alpha)
+            if margin > 0:
+                alpha_hi, margin_hi = alpha, margin
+            else:
+                alpha_lo, margin_lo = alpha, margin
+        return alpha_lo, alpha_hi
+
+    def get_status_alpha_power(self):
+        """Power of alpha of every get_status column under t_set*alpha"""
+        return np.array([0,0,0,1,1,1,2,2,2,3,3,3,4,4,4,0,1,2])
+
+    def search_feas_threshold(self, feas_key, t_set, d_ordered, d_ordered_yaw=None):
+        """Searches the feasibility threshold of the direction by rescaling a solved trajectory, no QP
+
+        Returns:
+            label: sanity_check result of (t_set, d_ordered, d_ordered_yaw)
+        """
+        status = self.get_status(t_set, d_ordered, d_ordered_yaw)
+        der_pow = self.get_status_alpha_power()
+        margin_fn = lambda alpha: np.min(self._quadModel.getWs_margin_batch(status*np.power(alpha, -der_pow)))
+        alpha_lo, alpha_hi = self.search_margin_threshold(margin_fn, \
+            rtol=self.feas_index_rtol, max_expand=self.feas_index_max_expand)
+        
+        t_total = np.sum(t_set)
+        if alpha_lo is not None:
+            self.set_feas_index(feas_key, t_total*alpha_lo, False)
+        if alpha_hi is not None:
+            self.set_feas_index(feas_key, t_total*alpha_hi, True)
+        return (alpha_hi is not None) and (alpha_hi <= 1.0)
+
     def update_traj(self, t_set, points, plane_pos_set, waypoints, alpha_set=None, \
                     yaw_mode=0, flag_run_sim=False, \
                     flag_fixed_end_point=True, \
@@ -721,17 +1830,20 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         
         pos_yaw_obj = lambda x: self.snap_acc_obj(
             t_set=x, points=points, plane_pos_set=plane_pos_set, waypoints=waypoints,\
-            deg_init_min=0,deg_init_max=4, \
-            deg_end_min=0,deg_end_max=2, \
-            deg_init_yaw_min=0,deg_init_yaw_max=4, \
-            deg_end_yaw_min=0,deg_end_yaw_max=2, \
             flag_fixed_end_point=flag_fixed_end_point, \
-            flag_init_point=True, flag_fixed_point=flag_fixed_point, \
-            yaw_mode=yaw_mode)
+            flag_fixed_point=flag_fixed_point, \
+            yaw_mode=yaw_mode, **UPDATE_TRAJ_OPTIONS)
         # Scale time with alpha_set
         t_set_new = np.multiply(t_set, alpha_set)
         # Calculate snap oh both position and yaw
-        res, d_ordered, d_ordered_yaw = pos_yaw_obj(t_set_new)
+        memo_key = self.get_traj_memo_key(t_set, points, plane_pos_set, waypoints, alpha_set, \
+            yaw_mode=yaw_mode, flag_fixed_end_point=flag_fixed_end_point, flag_fixed_point=flag_fixed_point)
+        traj = self.get_traj_memo(memo_key)
+        if traj is None:
+            res, d_ordered, d_ordered_yaw = pos_yaw_obj(t_set_new)
+            self.set_traj_memo(memo_key, (t_set_new, d_ordered, d_ordered_yaw))
+        else:
+            t_set_new, d_ordered, d_ordered_yaw = traj
         
         if flag_run_sim:
             debug_array = self.sim.run_simulation_from_der( \
@@ -758,6 +1870,169 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         else:
             return t_set_new, d_ordered, d_ordered_yaw
     
+    def update_traj_batch(self, t_set, points, plane_pos_set, waypoints, alpha_matrix, \
+                          yaw_mode=0, flag_fixed_end_point=True, flag_fixed_point=False):
+        """Batched update_traj over the rows of alpha_matrix
+
+        The objective and sampling blocks of the corridor QP are built for the whole batch
+        (get_snap_qp_blocks_batch) and solved per sample on the shared compiled structure,
+        the yaw problem and the time rescaling are vectorized over the batch.
+        Samples where the QP fails keep an all-zero d_ordered.
+        Rows found in the update_traj memo are not solved again.
+
+        Returns:
+            t_set_new: (B, N_POLY) np array, t_set*alpha_matrix
+            d_ordered: (B, N_DER*N_wp, 3) np array
+            d_ordered_yaw: (B, N_DER_YAW*N_wp, 2) np array
+        """
+        alpha_matrix = np.array(alpha_matrix).reshape(-1, t_set.shape[0])
+        plane_pos_set = self.get_compiled_course(plane_pos_set)
+        B = alpha_matrix.shape[0]
+        N_wp = points.shape[0]
+        
+        t_set_new = np.multiply(t_set[None,:], alpha_matrix)
+        d_ordered = np.zeros((B,N_wp*self.N_DER,3))
+        d_ordered_yaw = np.zeros((B,N_wp*self.N_DER_YAW,2))
+        
+        memo_key_set = []
+        idx_miss = []
+        for b_ii in range(B):
+            memo_key = self.get_traj_memo_key(t_set, points, plane_pos_set, waypoints, alpha_matrix[b_ii,:], \
+                yaw_mode=yaw_mode, flag_fixed_end_point=flag_fixed_end_point, flag_fixed_point=flag_fixed_point)
+            memo_key_set.append(memo_key)
+            traj = self.get_traj_memo(memo_key)
+            if traj is None:
+                idx_miss.append(b_ii)
+            else:
+                t_set_new[b_ii,:], d_ordered[b_ii,:,:], d_ordered_yaw[b_ii,:,:] = traj
+        if len(idx_miss) == 0:
+            return t_set_new, d_ordered, d_ordered_yaw
+        idx_miss = np.array(idx_miss)
+        B_miss = idx_miss.shape[0]
+        
+        # Same normalization as snap_acc_obj with kt=0
+        t_set_scale = 10.0*t_set_new.shape[1]/np.sum(t_set_new[idx_miss,:], axis=1)
+        x_t = t_set_new[idx_miss,:]*t_set_scale[:,None]
+        
+        d_ordered_miss = np.zeros((B_miss,N_wp*self.N_DER,3))
+        d_ordered_yaw_miss = np.zeros((B_miss,N_wp*self.N_DER_YAW,2))
+        res_miss = np.zeros(B_miss)
+        flag_solved = np.zeros(B_miss, dtype=bool)
+        # Same options as update_traj, so rays solved by snap_acc_obj are shared
+        opt = UPDATE_TRAJ_OPTIONS
+        ray_key_set = []
+        idx_solve = []
+        for b_ii in range(B_miss):
+            ray_key = self.get_snap_acc_ray_key(x_t[b_ii,:], points, plane_pos_set, waypoints, \
+                flag_fixed_point=flag_fixed_point, flag_fixed_end_point=flag_fixed_end_point, \
+                yaw_mode=yaw_mode, **opt)
+            ray_key_set.append(ray_key)
+            traj = self.get_traj_memo(ray_key, stat_prefix="ray_")
+            if traj is None:
+                idx_solve.append(b_ii)
+            else:
+                res_miss[b_ii], d_ordered_miss[b_ii,:,:], d_ordered_yaw_miss[b_ii,:,:], _ = traj
+                flag_solved[b_ii] = True
+        idx_solve = np.array(idx_solve, dtype=np.int)
+        
+        if idx_solve.shape[0] > 0:
+            flag_loop = self.check_flag_loop(t_set, points)
+            Q_blocks, V_seg = self.get_snap_qp_blocks_batch(x_t[idx_solve,:], flag_loop=flag_loop, \
+                corridor_mode=self.get_corridor_mode(plane_pos_set))
+        for s_ii, b_ii in enumerate(idx_solve):
+            ret = self.snap_obj( \
+                x_t[b_ii,:], points, plane_pos_set, waypoints, \
+                deg_init_min=opt["deg_init_min"], deg_init_max=opt["deg_init_max"], \
+                deg_end_min=opt["deg_end_min"], deg_end_max=opt["deg_end_max"], \
+                flag_fixed_end_point=flag_fixed_end_point, \
+                flag_init_point=opt["flag_init_point"], flag_fixed_point=flag_fixed_point, \
+                qp_blocks=(Q_blocks[s_ii], V_seg[s_ii]))
+            if ret is not None:
+                res_miss[b_ii] = ret[0]
+                d_ordered_miss[b_ii,:,:] = ret[1]
+                flag_solved[b_ii] = True
+        
+        # Failed rows keep an all-zero d_ordered, no yaw problem for them
+        idx_solve = idx_solve[flag_solved[idx_solve]]
+        if idx_solve.shape[0] > 0:
+            if yaw_mode == 0:
+                b_yaw = np.zeros((points.shape[0],2))
+                b_yaw[:,0] = 1
+            elif yaw_mode == 1:
+                b_yaw = np.zeros((idx_solve.shape[0],points.shape[0],2))
+                for b_ii in range(idx_solve.shape[0]):
+                    b_yaw[b_ii,:,:] = self.get_yaw_forward(x_t[idx_solve[b_ii],:], d_ordered_miss[idx_solve[b_ii],:,:])
+            elif yaw_mode == 2:
+                if points.shape[1] != 4:
+                    print("Wrong points format. Append yaw column")
+                b_yaw = np.zeros((points.shape[0],2))
+                b_yaw[:,0] = np.cos(points[:,-1])
+                b_yaw[:,1] = np.sin(points[:,-1])
+            else:
+                raise("Wrong yaw_mode")
+            res_yaw, d_ordered_yaw_miss[idx_solve,:,:] = self.acc_obj_batch(x_t[idx_solve,:], b_yaw, \
+                deg_init_min=opt["deg_init_yaw_min"], deg_init_max=opt["deg_init_yaw_max"], \
+                deg_end_min=opt["deg_end_yaw_min"], deg_end_max=opt["deg_end_yaw_max"])
+            res_miss[idx_solve] += res_yaw
+            for b_ii in idx_solve:
+                self.set_traj_memo(ray_key_set[b_ii], \
+                    (res_miss[b_ii], d_ordered_miss[b_ii,:,:], d_ordered_yaw_miss[b_ii,:,:], None))
+        
+        # get_alpha_matrix(1/t_set_scale) is diagonal with t_set_scale^k
+        alpha_vec = np.tile(np.power(t_set_scale[:,None], np.arange(self.N_DER)[None,:]), (1,N_wp))
+        alpha_vec_yaw = np.tile(np.power(t_set_scale[:,None], np.arange(self.N_DER_YAW)[None,:]), (1,N_wp))
+        d_ordered[idx_miss,:,:] = d_ordered_miss*alpha_vec[:,:,None]
+        d_ordered_yaw[idx_miss,:,:] = d_ordered_yaw_miss*alpha_vec_yaw[:,:,None]
+        for b_ii in idx_miss[flag_solved]:
+            self.set_traj_memo(memo_key_set[b_ii], (t_set_new[b_ii,:], d_ordered[b_ii,:,:], d_ordered_yaw[b_ii,:,:]))
+        return t_set_new, d_ordered, d_ordered_yaw
+    
+    def sanity_check_batch(self, t_set, points, plane_pos_set, waypoints, alpha_matrix, \
+                           yaw_mode=0, flag_fixed_end_point=True, flag_fixed_point=False):
+        """Feasibility of update_traj_batch rows, answered from the feasibility index where it can
+
+        Only the undecided rows are solved and checked, their results tighten the index.
+
+        Returns:
+            label: (B,) bool np array
+        """
+        alpha_matrix = np.array(alpha_matrix).reshape(-1, t_set.shape[0])
+        t_set_new = np.multiply(t_set[None,:], alpha_matrix)
+        B = alpha_matrix.shape[0]
+        label = np.zeros(B, dtype=bool)
+        
+        feas_key_set = []
+        idx_eval = []
+        for b_ii in range(B):
+            feas_key = self.get_feas_index_key(t_set_new[b_ii,:], points, plane_pos_set, waypoints, \
+                yaw_mode, flag_fixed_end_point, flag_fixed_point)
+            feas_key_set.append(feas_key)
+            label_b = self.get_feas_index(feas_key, np.sum(t_set_new[b_ii,:]))
+            if label_b is None:
+                idx_eval.append(b_ii)
+            else:
+                label[b_ii] = label_b
+        if len(idx_eval) == 0:
+            return label
+        idx_eval = np.array(idx_eval, dtype=np.int)
+        
+        t_set_eval, d_ordered, d_ordered_yaw = self.update_traj_batch( \
+            t_set, points, plane_pos_set, waypoints, alpha_matrix[idx_eval,:], \
+            yaw_mode=yaw_mode, flag_fixed_end_point=flag_fixed_end_point, flag_fixed_point=flag_fixed_point)
+        flag_feasible, _ = self.sanity_check_traj_batch(t_set_eval, d_ordered, d_ordered_yaw)
+        for e_ii, b_ii in enumerate(idx_eval):
+            if np.sum(d_ordered[e_ii,1:4,:]) == 0.0:
+                # The QP is solved on the normalized time, so it fails along the whole direction
+                self.set_feas_index(feas_key_set[b_ii], np.inf, False)
+                continue
+            label[b_ii] = flag_feasible[e_ii]
+            if self.flag_feas_search:
+                self.search_feas_threshold(feas_key_set[b_ii], \
+                    t_set_eval[e_ii,:], d_ordered[e_ii,:,:], d_ordered_yaw[e_ii,:,:])
+            else:
+                self.set_feas_index(feas_key_set[b_ii], np.sum(t_set_eval[e_ii,:]), label[b_ii])
+        return label
+    
     def wrapper_sanity_check(self, args):
         points = args[0]
         plane_pos_set = args[1]
@@ -799,72 +2074,72 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
                 flag_fixed_point=flag_fixed_point)
         return self.sanity_check_multi(t_set_new1, d_ordered1, d_ordered_yaw1, t_set_new2, d_ordered2, d_ordered_yaw2)
     
+    def check_sim_collision(self, t_set, debug_value, plane_pos_set, max_col_err=0.1, flag_loop=False):
+        """Marks the first corridor violation of a simulated flight as its failure_idx"""
+        N_POLY = t_set.shape[0]
+        time_array = debug_value["time"]
+        pos_array = debug_value["pos"]
+        p_ii = 0
+        p_ii_n = 1
+        t_bias = 0
+        flag_update_poly = True
+        for idx in range(time_array.shape[0]):
+            if (time_array[idx]-t_bias) > t_set[p_ii]:
+                t_bias += t_set[p_ii]
+                p_ii += 1
+                if flag_loop:
+                    p_ii_n = (p_ii+1)%(N_POLY)
+                else:
+                    p_ii_n = (p_ii+1)
+                if p_ii == N_POLY:
+                    break
+                flag_update_poly = True
+            elif idx == 0:
+                flag_update_poly = True
+            else:
+                flag_update_poly = False
+
+            if flag_update_poly:
+                V_norm = plane_pos_set.face_norm[p_ii]
+                V_bias = plane_pos_set.face_bias[p_ii]
+
+            if np.any(V_norm.dot(pos_array[idx,:])-V_bias < -max_col_err):
+                if debug_value["failure_idx"] == -1:
+                    debug_value["failure_idx"] = idx
+                else:
+                    failure_idx = debug_value["failure_idx"]
+                    if failure_idx > idx:
+                        debug_value["failure_idx"] = idx
+                prRed("crashed at {}".format(idx))
+                break
+        return
+    
     # run simulation with multiple loops & rampin
     def run_sim_loop(self, t_set, d_ordered, d_ordered_yaw, plane_pos_set, \
-                     N_loop=1, flag_debug=False, max_pos_err=2.0, max_col_err=0.1, N_trial=3):
+                     N_loop=1, flag_debug=False, max_pos_err=2.0, max_col_err=0.1, N_trial=3, seed=0, \
+                     flag_native=False):
         """
-        
+        A noise-free simulator flies the trajectory once for all N_trial trials.
+        Flight #trial is seeded by (seed, trial) as in run_sim_loop_batch, so the verdict is reproducible.
+        flag_native (bool): Fly with the native rollout (simulation_core_native), stops at the
+            first failed trial. Default is False.
         """        
         flag_loop = False
         N_wp = np.int(d_ordered.shape[0]/self.N_DER)
         N_POLY = t_set.shape[0]
         if N_wp == N_POLY:
             flag_loop = True
+        plane_pos_set = self.get_compiled_course(plane_pos_set)
         
         t_set_new = t_set
-        N_success_t = 0
-        for idx_trial_t in range(N_trial):
+        for idx_trial_t in range(self.sim.get_N_flight(N_trial)):
             debug_array = self.sim.run_simulation_from_der(t_set_new, d_ordered, d_ordered_yaw, N_trial=1, 
                                                            max_pos_err=max_pos_err, min_pos_err=0.1, 
                                                            max_yaw_err=120., min_yaw_err=60., 
-                                                           freq_ctrl=200)
-
-            time_array = debug_array[0]["time"]
-            pos_array = debug_array[0]["pos"]
-            p_ii = 0
-            p_ii_n = 1
-            t_bias = 0
-            flag_update_poly = True
-            for idx in range(time_array.shape[0]):
-                if (time_array[idx]-t_bias) > t_set_new[p_ii]:
-                    t_bias += t_set_new[p_ii]
-                    p_ii += 1
-                    if flag_loop:
-                        p_ii_n = (p_ii+1)%(N_POLY)
-                    else:
-                        p_ii_n = (p_ii+1)
-                    if p_ii == N_POLY:
-                        break
-                    flag_update_poly = True
-                elif idx == 0:
-                    flag_update_poly = True
-                else:
-                    flag_update_poly = False
-
-                if flag_update_poly:
-                    V_norm = np.zeros((len(plane_pos_set[p_ii]["constraints_plane"]),3))
-                    V_bias = np.zeros(len(plane_pos_set[p_ii]["constraints_plane"]))
-                    for i in range(len(plane_pos_set[p_ii]["constraints_plane"])):
-                        v0 = np.array(plane_pos_set[p_ii]["constraints_plane"][i][0])
-                        v1 = np.array(plane_pos_set[p_ii]["constraints_plane"][i][1])
-                        for k in range(2,len(plane_pos_set[p_ii]["constraints_plane"][i])):
-                            v2 = np.array(plane_pos_set[p_ii]["constraints_plane"][i][k])
-                            res_t = np.fabs((v1-v0).dot(v2-v0)/np.linalg.norm(v1-v0)/np.linalg.norm(v2-v0))
-                            if res_t < 1-1e-4:
-                                break
-                        V_norm[i,:] = np.cross(v1-v0, v2-v0)
-                        V_norm[i,:] /= np.linalg.norm(V_norm[i,:])
-                        V_bias[i] = V_norm[i,:].dot(v0)
-
-                if np.any(V_norm.dot(pos_array[idx,:])-V_bias < -max_col_err):
-                    if debug_array[0]["failure_idx"] == -1:
-                        debug_array[0]["failure_idx"] = idx
-                    else:
-                        failure_idx = debug_array[0]["failure_idx"]
-                        if failure_idx > idx:
-                            debug_array[0]["failure_idx"] = idx
-                    prRed("crashed at {}".format(idx))
-                    break
+                                                           freq_ctrl=200, record="pos_only", seed=seed, \
+                                                           trial_offset=idx_trial_t, flag_native=flag_native)
+            self.check_sim_collision(t_set_new, debug_array[0], plane_pos_set, \
+                                     max_col_err=max_col_err, flag_loop=flag_loop)
 
             if flag_debug:
                 self.plot_sim_result(t_set_new, d_ordered, plane_pos_set, debug_array[0])
@@ -873,6 +2148,37 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
             if failure_idx != -1:
                 return False
         return True
+    
+    def run_sim_loop_batch(self, t_sets, d_ordereds, d_ordereds_yaw, plane_pos_set, \
+                           flag_debug=False, max_pos_err=2.0, max_col_err=0.1, N_trial=3, seed=0):
+        """run_sim_loop for a list of trajectories, all N_trial flights of every trajectory
+        are flown together by the lockstep batched simulator (once if it is noise-free).
+        Flight #trial of every trajectory is seeded by (seed, trial).
+        MulticopterBatchModel has its own physics and noise streams and is not checked against
+        the pybind model, so run_sim_loop stays the simulator check of the labels.
+
+        Returns:
+            flag_success: (len(t_sets),) bool np array
+        """
+        plane_pos_set = self.get_compiled_course(plane_pos_set)
+        debug_arrays = self.sim.run_simulation_from_der_batch(t_sets, d_ordereds, d_ordereds_yaw, N_trial=N_trial, 
+                                                             max_pos_err=max_pos_err, min_pos_err=0.1, 
+                                                             max_yaw_err=120., min_yaw_err=60., 
+                                                             freq_ctrl=200, record="pos_only", seed=seed)
+        # Reused flights of a noise-free simulator share the verdict of the first one
+        N_flight = self.sim.get_N_flight(N_trial)
+        flag_success = np.ones(len(t_sets), dtype=bool)
+        for it in range(len(t_sets)):
+            flag_loop = np.int(d_ordereds[it].shape[0]/self.N_DER) == t_sets[it].shape[0]
+            for debug_value in debug_arrays[it][:N_flight]:
+                if debug_value["failure_idx"] == -1:
+                    self.check_sim_collision(t_sets[it], debug_value, plane_pos_set, \
+                                             max_col_err=max_col_err, flag_loop=flag_loop)
+                if flag_debug:
+                    self.plot_sim_result(t_sets[it], d_ordereds[it], plane_pos_set, debug_value)
+                if debug_value["failure_idx"] != -1:
+                    flag_success[it] = False
+        return flag_success
         
     def plot_sim_result(self, t_set, d_ordered, plane_pos_set, debug_value, flag_course_loop=True):
         N_POLY = t_set.shape[0]
@@ -881,8 +2187,7 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         if N_POLY != N_wp:
             flag_loop = False
         
-        V_t = self.generate_sampling_matrix(t_set, N=self.N_POINTS, der=0, endpoint=True)
-        status = V_t.dot(d_ordered)
+        status = self.get_piecewise_trajectory(t_set, d_ordered).eval_sample(self.N_POINTS)
         # Plot data
         mesh_data = []
         if flag_loop:
@@ -1062,8 +2367,7 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
             )
             mesh_data.append(mesh_t)
         
-        V_t = self.generate_sampling_matrix(t_set, N=self.N_POINTS, der=0, endpoint=True)
-        status = V_t.dot(d_ordered)
+        status = self.get_piecewise_trajectory(t_set, d_ordered).eval_sample(self.N_POINTS)
         mesh_data.append(
             go.Scatter3d(
                 x=status[:,0], 
@@ -1097,8 +2401,7 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
             )
         )
         
-        V_t = self.generate_sampling_matrix(t_set_new, N=self.N_POINTS, der=0, endpoint=True)
-        status_new = V_t.dot(d_ordered_new)
+        status_new = self.get_piecewise_trajectory(t_set_new, d_ordered_new).eval_sample(self.N_POINTS)
         mesh_data.append(
             go.Scatter3d(
                 x=status_new[:,0], 
@@ -1163,8 +2466,7 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         flag_loop = True
         if N_POLY != N_wp:
             flag_loop = False
-        V_t = self.generate_sampling_matrix(t_set, N=self.N_POINTS, der=0, endpoint=True)
-        status = V_t.dot(d_ordered)
+        status = self.get_piecewise_trajectory(t_set, d_ordered).eval_sample(self.N_POINTS)
         waypoints = np.zeros((N_wp,3))
         for i in range(N_wp):
             waypoints[i,:3] = d_ordered[i*self.N_DER,:]
@@ -1185,8 +2487,7 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         if N_POLY != N_wp:
             flag_loop = False
         
-        V_t = self.generate_sampling_matrix(t_set, N=self.N_POINTS, der=0, endpoint=True)
-        status = V_t.dot(d_ordered)
+        status = self.get_piecewise_trajectory(t_set, d_ordered).eval_sample(self.N_POINTS)
         # Plot data
         mesh_data = []
         if flag_loop:
@@ -1270,8 +2571,7 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         if N_POLY1 != N_wp1:
             flag_loop1 = False
         
-        V_t1 = self.generate_sampling_matrix(t_set1, N=self.N_POINTS, der=0, endpoint=True)
-        status1 = V_t1.dot(d_ordered1)
+        status1 = self.get_piecewise_trajectory(t_set1, d_ordered1).eval_sample(self.N_POINTS)
         
         N_POLY2 = t_set2.shape[0]
         N_wp2 = np.int(d_ordered2.shape[0]/self.N_DER)
@@ -1279,8 +2579,7 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         if N_POLY2 != N_wp2:
             flag_loop2 = False
         
-        V_t2 = self.generate_sampling_matrix(t_set2, N=self.N_POINTS, der=0, endpoint=True)
-        status2 = V_t2.dot(d_ordered2)
+        status2 = self.get_piecewise_trajectory(t_set2, d_ordered2).eval_sample(self.N_POINTS)
         
         # Plot data
         mesh_data = []
@@ -1433,8 +2732,7 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         if N_POLY1 != N_wp1:
             flag_loop1 = False
         
-        V_t1 = self.generate_sampling_matrix(t_set1, N=self.N_POINTS, der=0, endpoint=True)
-        status1 = V_t1.dot(d_ordered1)
+        status1 = self.get_piecewise_trajectory(t_set1, d_ordered1).eval_sample(self.N_POINTS)
         
         N_POLY2 = t_set2.shape[0]
         N_wp2 = np.int(d_ordered2.shape[0]/self.N_DER)
@@ -1442,8 +2740,7 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         if N_POLY2 != N_wp2:
             flag_loop2 = False
         
-        V_t2 = self.generate_sampling_matrix(t_set2, N=self.N_POINTS, der=0, endpoint=True)
-        status2 = V_t2.dot(d_ordered2)
+        status2 = self.get_piecewise_trajectory(t_set2, d_ordered2).eval_sample(self.N_POINTS)
         
         # Plot data
         mesh_data = []
@@ -1593,27 +2890,25 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         
         yaw_ref = np.zeros((N_POLY,2))
         vel = np.zeros((N_POLY,2))
-        if flag_loop:
-            V_t = self.generate_sampling_matrix_loop(t_set, N=self.N_POINTS, der=1)
-        else:
-            V_t = self.generate_sampling_matrix(t_set, N=self.N_POINTS, der=1, endpoint=True)
-        vel[:np.int(V_t.shape[0]/self.N_POINTS),:] = (V_t.dot(d_ordered[:,:2]))[::self.N_POINTS,:]
+        traj = self.get_piecewise_trajectory(t_set, d_ordered)
+        vel_t = traj.eval(traj.get_sample_time(self.N_POINTS, endpoint=not flag_loop), der=1)[:,:2]
+        vel[:np.int(vel_t.shape[0]/self.N_POINTS),:] = vel_t[::self.N_POINTS,:]
         
         if not flag_loop:
-            vel[-1,:] = (V_t.dot(d_ordered[:,:2]))[-1,:]
+            vel[-1,:] = vel_t[-1,:]
         
         for i in range(N_POLY):
             if np.linalg.norm(vel[i,:2]) < 1e-6:
                 if i < N_POLY:
                     for j in range(1,self.N_POINTS-1):
-                        vel_tmp = V_t.dot(d_ordered[:,:2])[i*self.N_POINTS+j,:]
+                        vel_tmp = vel_t[i*self.N_POINTS+j,:]
                         if np.linalg.norm(vel_tmp[:2]) > 1e-6:
                             vel_tmp2 = vel_tmp
                             break
                         vel_tmp2 = np.array([1,0])
                 else:
                     for j in range(1,self.N_POINTS-1):
-                        vel_tmp = V_t.dot(d_ordered[:,:2])[i*self.N_POINTS-j,:]
+                        vel_tmp = vel_t[i*self.N_POINTS-j,:]
                         if np.linalg.norm(vel_tmp[:2]) > 1e-6:
                             vel_tmp2 = vel_tmp
                             break
@@ -1644,9 +2939,69 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
             T_alpha_all[i*self.N_DER_YAW:(i+1)*self.N_DER_YAW,i*self.N_DER_YAW:(i+1)*self.N_DER_YAW] = T_alpha
         return T_alpha_all
     
-    def optimize_alpha(self, points, t_set, d_ordered, d_ordered_yaw, alpha_scale=1.0, sanity_check_t=None, flag_return_alpha=False):
+    def search_alpha_pool(self, t_set, d_ordered, d_ordered_yaw, sim_pool, sim_kwargs, \
+                          alpha_init=10.16, alpha_tol=1e-2, N_parallel=None, max_round=20):
+        """Parallel k-section of the minimal alpha passing run_sim_loop
+
+        Every round flies N_parallel candidate alphas at once on sim_pool (see get_sim_pool),
+        first spread geometrically until the bracket is found, then evenly inside it.
+        
+        sim_kwargs (dict): plane_pos_set and the remaining run_sim_loop arguments
+        N_parallel (int): Candidates per round, the number of sim_pool workers. Default is 8.
+        Returns:
+            alpha_hi: smallest alpha that passed, None if none passed within max_round rounds
+        """
+        if N_parallel is None:
+            N_parallel = 8
+        N_wp = np.int(d_ordered.shape[0]/self.N_DER)
+        def run_sim_alpha(alpha_set):
+            data_list = []
+            for alpha in alpha_set:
+                if np.all(d_ordered_yaw != None):
+                    d_ordered_yaw_alpha = self.get_alpha_matrix_yaw(alpha,N_wp).dot(d_ordered_yaw)
+                else:
+                    d_ordered_yaw_alpha = None
+                data_list.append((t_set*alpha, self.get_alpha_matrix(alpha,N_wp).dot(d_ordered), \
+                                  d_ordered_yaw_alpha, sim_kwargs))
+            return np.array(sim_pool.map(_run_sim_loop_worker, data_list), dtype=bool)
+        
+        alpha_lo, alpha_hi = None, None
+        for it in range(max_round):
+            if alpha_lo is not None and alpha_hi is not None:
+                if alpha_hi - alpha_lo <= alpha_tol:
+                    break
+                alpha_set = alpha_lo + (alpha_hi-alpha_lo)*np.arange(1,N_parallel+1)/(N_parallel+1)
+            elif alpha_lo is not None:
+                alpha_set = alpha_lo*np.power(2.0, np.arange(1,N_parallel+1))
+            elif alpha_hi is not None:
+                alpha_set = alpha_hi*np.power(2.0, -np.arange(1,N_parallel+1))
+            else:
+                alpha_set = alpha_init*np.power(2.0, np.arange(N_parallel)-(N_parallel-1)//2)
+            print("search_alpha_pool: {}".format(alpha_set))
+            res = run_sim_alpha(alpha_set)
+            if np.any(res):
+                alpha_hi = np.min(alpha_set[res])
+            # Infeasible candidates above the smallest success are flight noise, not the bracket
+            alpha_set_fail = alpha_set[~res]
+            if alpha_hi is not None:
+                alpha_set_fail = alpha_set_fail[alpha_set_fail < alpha_hi]
+            if alpha_set_fail.shape[0] > 0:
+                alpha_lo = np.max(alpha_set_fail)
+        return alpha_hi
+
+    def optimize_alpha(self, points, t_set, d_ordered, d_ordered_yaw, alpha_scale=1.0, sanity_check_t=None, flag_return_alpha=False, \
+                       alpha_rtol=1e-4, sim_pool=None, sim_kwargs=None, alpha_tol=1e-2, N_parallel=None):
         """Scales down obtained time allocation while ensuring feasibility.
 
+        With the default flatness sanity_check, the minimal alpha is found by a root search on the
+        motor speed margin of the rescaled samples. With sim_pool, run_sim_loop(**sim_kwargs) candidates
+        are flown in parallel by search_alpha_pool. Other sanity_check_t use the incremental search.
+        alpha_rtol (float): Relative tolerance of the margin root search. Default is 1e-4.
+        sim_pool (multiprocessing.Pool): Pool from get_sim_pool. Default is None.
+        sim_kwargs (dict): plane_pos_set and the remaining run_sim_loop arguments for sim_pool.
+        alpha_tol (float): Bracket width at which search_alpha_pool stops. Default is 1e-2.
+        N_parallel (int): Candidates per search_alpha_pool round, pass the number of sim_pool workers. Default is 8.
+
         Returns:
             t_set: np array
             d_ordered: square np array of len self.N_DER*N_wp 
@@ -1670,8 +3025,47 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         else:
             d_ordered_yaw_ret = None
         
+        flag_search = True
+        if sim_pool is not None:
+            alpha_hi = self.search_alpha_pool(t_set, d_ordered, d_ordered_yaw, sim_pool, sim_kwargs, \
+                alpha_init=alpha, alpha_tol=alpha_tol, N_parallel=N_parallel)
+            if alpha_hi is None:
+                prRed("optimize_alpha: no alpha passed the simulator in search_alpha_pool")
+            else:
+                alpha = alpha_hi
+                t_set_ret = t_set * alpha
+                d_ordered_ret = self.get_alpha_matrix(alpha,N_wp).dot(d_ordered)
+                if np.all(d_ordered_yaw != None):
+                    d_ordered_yaw_ret = self.get_alpha_matrix_yaw(alpha,N_wp).dot(d_ordered_yaw)
+                flag_search = False
+        elif sanity_check_t == self.sanity_check:
+            # Derivative k of the samples scales with alpha^-k, no need to resample the trajectory
+            status = self.get_status(t_set, d_ordered, d_ordered_yaw)
+            der_pow = self.get_status_alpha_power()
+            margin_fn = lambda alpha: np.min(self._quadModel.getWs_margin_batch(status*np.power(alpha, -der_pow)))
+            _, alpha_hi = self.search_margin_threshold(margin_fn, rtol=alpha_rtol, max_expand=20)
+            if alpha_hi is None:
+                prRed("optimize_alpha: no feasible alpha found by the margin search")
+            else:
+                # Verify on the rescaled trajectory, guards against round-off at the boundary
+                for it in range(10):
+                    t_set_opt = t_set * alpha_hi
+                    d_ordered_opt = self.get_alpha_matrix(alpha_hi,N_wp).dot(d_ordered)
+                    if np.all(d_ordered_yaw != None):
+                        d_ordered_yaw_opt = self.get_alpha_matrix_yaw(alpha_hi,N_wp).dot(d_ordered_yaw)
+                    else:
+                        d_ordered_yaw_opt = None
+                    if sanity_check_t(t_set_opt, d_ordered_opt, d_ordered_yaw_opt):
+                        alpha = alpha_hi
+                        t_set_ret = t_set_opt
+                        d_ordered_ret = d_ordered_opt
+                        d_ordered_yaw_ret = d_ordered_yaw_opt
+                        flag_search = False
+                        break
+                    alpha_hi *= 1.0 + alpha_rtol
+        
         # increase alpha until flight is successful
-        while True:
+        while flag_search:
             print("loop 1")
             print(f"alpha = {alpha}")
             t_set_opt = t_set * alpha
@@ -1689,7 +3083,7 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
                 break
             
         # decrease alpha
-        while True:
+        while flag_search:
             print("loop 2")
             print(f"alpha = {alpha - dalpha}, dalpha={dalpha}")
             alpha_tmp = alpha - dalpha
@@ -1726,6 +3120,20 @@ class MinSnapTrajectoryPolytopes(MinSnapTrajectory):
         else:
             return t_set, d_ordered, d_ordered_yaw
 
+_sim_worker_poly = None
+
+def _init_sim_worker(poly_kwargs):
+    global _sim_worker_poly
+    _sim_worker_poly = MinSnapTrajectoryPolytopes(**poly_kwargs)
+
+def _run_sim_loop_worker(args):
+    t_set, d_ordered, d_ordered_yaw, sim_kwargs = args
+    return _sim_worker_poly.run_sim_loop(t_set, d_ordered, d_ordered_yaw, **sim_kwargs)
+
+def get_sim_pool(N_worker, **poly_kwargs):
+    """Worker pool keeping one MinSnapTrajectoryPolytopes(**poly_kwargs), and its simulator, per process"""
+    return multiprocessing.Pool(N_worker, initializer=_init_sim_worker, initargs=(poly_kwargs,))
+
 def interpolate_traj(arr, t_set_1, t_set_2):
     scaling = t_set_1 / np.max([np.max(t_set_1), np.max(t_set_2)])
     scaling = (scaling * 200).astype(np.int32)
@@ -4,6 +4,7 @@
 import numpy as np
 import os
 import copy
+import time
 import yaml
 from os import path
 from pyDOE import lhs
@@ -17,7 +18,7 @@ def get_waypoints_plane(polygon_filedir, polygon_filename, sample_name, flag_t_s
     
     Returns:
         polygon_path_points: np array where each row is a [x, y, z] point including 
-        plane_pos_set: list of dict of polygons, dict includes all polygon faces and the input and/or output face
+        plane_pos_set: CompiledCourse (list of dict of polygons, dict includes all polygon faces and the input and/or output face)
         t_set: if flag_t_set, returns initial guess of time estimates
     """
     if flag_t_set:
@@ -32,6 +33,8 @@ def get_waypoints_plane(polygon_filedir, polygon_filename, sample_name, flag_t_s
         points_set, polygon_set, face_vertex, \
         polygon_path, initial_point, final_point, \
         unit_height_t, types)
+    plane_pos_set = CompiledCourse(plane_pos_set, points=polygon_path_points, \
+                                   waypoints=waypoints, name=sample_name)
     
     if flag_t_set:
         return np.array(polygon_path_points), plane_pos_set, t_set, waypoints
@@ -55,12 +58,12 @@ def meta_low_fidelity(poly, alpha_set, t_set_sta, points, plane_pos_set, waypoin
         #     data_list.append((points, plane_pos_set, t_set_sta, alpha_tmp, flag_fixed_point))
         # results = parmap(poly.wrapper_sanity_check, data_list)
     # else:
-    results = []
 
     # check that trajectory of (sum_i=it^n x_i) is valid (??)
-    for it in range(alpha_set.shape[0]):
-        alpha_tmp = lb_i + np.multiply(alpha_set[it,:t_dim],ub_i-lb_i)
-        results.append(poly.wrapper_sanity_check((points, plane_pos_set, waypoints, t_set_sta, alpha_tmp, flag_fixed_point)))
+    alpha_tmp = lb_i[None,:] + np.multiply(alpha_set[:,:t_dim],(ub_i-lb_i)[None,:])
+    results = poly.sanity_check_batch( \
+        t_set_sta, points, plane_pos_set, waypoints, alpha_tmp, \
+        yaw_mode=poly.yaw_mode, flag_fixed_end_point=True, flag_fixed_point=flag_fixed_point)
             
     for it in range(alpha_set.shape[0]):
         if results[it]:
@@ -87,10 +90,18 @@ def meta_low_fidelity_multi(poly, alpha_set1, t_set_sta1, points1, plane_pos_set
     results = []
 
     # check that trajectory of (sum_i=it^n x_i) is valid (??)
+    alpha_tmp1 = lb_i1[None,:] + np.multiply(alpha_set1[:,:t_dim1],(ub_i1-lb_i1)[None,:])
+    alpha_tmp2 = lb_i2[None,:] + np.multiply(alpha_set2[:,:t_dim2],(ub_i2-lb_i2)[None,:])
+    t_set_new1, d_ordered1, d_ordered_yaw1 = poly.update_traj_batch( \
+        t_set_sta1, points1, plane_pos_set1, waypoints1, alpha_tmp1, \
+        yaw_mode=poly.yaw_mode, flag_fixed_end_point=True, flag_fixed_point=flag_fixed_point)
+    t_set_new2, d_ordered2, d_ordered_yaw2 = poly.update_traj_batch( \
+        t_set_sta2, points2, plane_pos_set2, waypoints2, alpha_tmp2, \
+        yaw_mode=poly.yaw_mode, flag_fixed_end_point=True, flag_fixed_point=flag_fixed_point)
     for it in range(alpha_set1.shape[0]):
-        alpha_tmp1 = lb_i1 + np.multiply(alpha_set1[it,:t_dim1],ub_i1-lb_i1)
-        alpha_tmp2 = lb_i2 + np.multiply(alpha_set2[it,:t_dim2],ub_i2-lb_i2)
-        results.append(poly.wrapper_sanity_check_multi((points1, plane_pos_set1, waypoints1, t_set_sta1, alpha_tmp1, flag_fixed_point, points2, plane_pos_set2, waypoints2, t_set_sta2, alpha_tmp2)))
+        results.append(poly.sanity_check_multi( \
+            t_set_new1[it], d_ordered1[it], d_ordered_yaw1[it], \
+            t_set_new2[it], d_ordered2[it], d_ordered_yaw2[it]))
             
     for it in range(alpha_set1.shape[0]):
         if results[it]:
@@ -103,9 +114,66 @@ def meta_low_fidelity_multi(poly, alpha_set1, t_set_sta1, points1, plane_pos_set
     return label
 
 
-def meta_high_fidelity(poly, alpha_set, t_set_sim, points, plane_pos_set, \
+def benchmark_corridor_mode(poly, alpha_set, t_set_sta, points, plane_pos_set, waypoints, \
+                            corridor_mode_list=('sample', 'bernstein'), lb=0.6, ub=1.4, \
+                            flag_sim=True, max_col_err=0.1, N_trial=3):
+    """Compares corridor constraint modes on the same alpha samples
+
+    Returns:
+        result: dict per corridor mode with the corridor row count, mean update_traj time,
+            QP failure rate and run_sim_loop crash rate (over the solved samples)
+    """
+    plane_pos_set = poly.get_compiled_course(plane_pos_set)
+    corridor_mode_prev = plane_pos_set.corridor_mode
+    
+    t_dim = t_set_sta.shape[0]
+    lb_i = np.ones(t_dim)*lb
+    ub_i = np.ones(t_dim)*ub
+    result = dict()
+    try:
+        for corridor_mode in corridor_mode_list:
+            plane_pos_set.corridor_mode = corridor_mode
+            N_row = poly.get_corridor_row_count(corridor_mode) \
+                * np.sum([V_norm.shape[0] for V_norm in plane_pos_set.V_norm])
+            time_set = []
+            N_fail = 0
+            N_crash = 0
+            for it in range(alpha_set.shape[0]):
+                alpha_tmp = lb_i + np.multiply(alpha_set[it,:t_dim],ub_i-lb_i)
+                time_start = time.time()
+                t_set_new, d_ordered, d_ordered_yaw = poly.update_traj( \
+                    t_set_sta, points, plane_pos_set, waypoints, alpha_tmp, \
+                    yaw_mode=poly.yaw_mode, flag_fixed_end_point=True, flag_fixed_point=False)
+                time_set.append(time.time()-time_start)
+                if np.sum(d_ordered[1:4, :]) == 0.0:
+                    N_fail += 1
+                    continue
+                if flag_sim and not poly.run_sim_loop(t_set_new, d_ordered, d_ordered_yaw, plane_pos_set, \
+                                                      max_col_err=max_col_err, N_trial=N_trial):
+                    N_crash += 1
+            N_solved = alpha_set.shape[0]-N_fail
+            result[corridor_mode] = dict( \
+                rows=N_row, \
+                solve_time=np.mean(time_set), \
+                fail_rate=1.0*N_fail/alpha_set.shape[0], \
+                crash_rate=1.0*N_crash/N_solved if (flag_sim and N_solved > 0) else np.nan)
+            print("[{}] rows: {}, time: {:.4f}s, QP fail rate: {:.3f}, crash rate: {:.3f}".format( \
+                corridor_mode, N_row, result[corridor_mode]["solve_time"], \
+                result[corridor_mode]["fail_rate"], result[corridor_mode]["crash_rate"]))
+    finally:
+        # The course is shared with the caller
+        plane_pos_set.corridor_mode = corridor_mode_prev
+    return result
+
+def meta_high_fidelity(poly, alpha_set, t_set_sim, points, plane_pos_set, waypoints, \
                        lb=0.6, ub=1.4, multicore=False, return_snap=False, \
-                       max_col_err=0.1, N_trial=3):
+                       max_col_err=0.1, N_trial=3, flag_native=False):
+    """Simulator labels of alpha_set, 1 if the updated trajectory passes run_sim_loop
+
+    With t_set_sim = the t_set_sta of meta_low_fidelity, update_traj reuses the memoized QPs of the low fidelity labels.
+
+    flag_native (bool): Passed to run_sim_loop, True flies the native rollout (simulation_core_native). Default is False.
+    """
     flag_fixed_point = False
     # flag_fixed_end_point=True
     
@@ -161,10 +229,10 @@ def meta_high_fidelity(poly, alpha_set, t_set_sim, points, plane_pos_set, \
         #     continue
 
         t_set_tmp, d_ordered_tmp, d_ordered_yaw_tmp = poly.update_traj(
-            t_set_sim, points_t, plane_pos_set, alpha_tmp, 
-            flag_fixed_point=flag_fixed_point, flag_fixed_end_point=True)
+            t_set_sim, points_t, plane_pos_set, waypoints, alpha_set=alpha_tmp, 
+            yaw_mode=poly.yaw_mode, flag_fixed_point=flag_fixed_point, flag_fixed_end_point=True)
         if poly.run_sim_loop(t_set_tmp, d_ordered_tmp, d_ordered_yaw_tmp, plane_pos_set, \
-                    max_col_err=max_col_err, N_trial=N_trial):
+                    max_col_err=max_col_err, N_trial=N_trial, flag_native=flag_native):
             label[it] = 1
     
     # if return_snap:
@@ -1284,6 +1284,93 @@ def get_plane_pos_set(points_set, polygon_set, face_vertex, \
             prev_output_plane.reverse()
     return plane_pos_set, polygon_path_points, waypoints
 
+def get_plane_half_space(plane, flag_search=True):
+    """Half-space V_norm.dot(p) >= V_bias bounded by a plane
+
+    Args:
+        plane: list of vertices on the plane
+        flag_search: use the first vertex which is not collinear with the first two
+
+    Returns:
+        V_norm: unit normal of the plane
+        V_bias: offset of the plane
+    """
+    v0 = np.array(plane[0], dtype=np.float64)
+    v1 = np.array(plane[1], dtype=np.float64)
+    v2 = np.array(plane[2], dtype=np.float64)
+    if flag_search:
+        for k in range(2,len(plane)):
+            v2 = np.array(plane[k], dtype=np.float64)
+            res_t = np.fabs((v1-v0).dot(v2-v0)/np.linalg.norm(v1-v0)/np.linalg.norm(v2-v0))
+            if res_t < 1-1e-4:
+                break
+    V_norm = np.cross(v1-v0, v2-v0)
+    V_norm /= np.linalg.norm(V_norm)
+    return V_norm, V_norm.dot(v0)
+
+def get_half_space_array(plane_set, flag_search=True):
+    V_norm = np.zeros((len(plane_set),3))
+    V_bias = np.zeros(len(plane_set))
+    for i in range(len(plane_set)):
+        V_norm[i,:], V_bias[i] = get_plane_half_space(plane_set[i], flag_search=flag_search)
+    return V_norm, V_bias
+
+class CompiledCourse(list):
+    """plane_pos_set with the half-spaces of every polytope precomputed
+
+    It is still the list of polytope dicts returned by get_plane_pos_set, so it can
+    be passed wherever plane_pos_set is expected.
+    Per polytope (segment) p_ii:
+        face_norm[p_ii], face_bias[p_ii]: (N_face, 3), (N_face,) constraints_plane
+        corner_norm[p_ii], corner_bias[p_ii]: corner_plane
+        input_norm[p_ii], input_bias[p_ii]: input_plane (0 or 1 row)
+        output_norm[p_ii], output_bias[p_ii]: output_plane (0 or 1 row)
+        V_norm[p_ii], V_bias[p_ii]: every corridor half-space of the polytope
+    corridor_mode selects how the corridor is enforced on this course,
+    'sample' or 'bernstein', None uses the default of the trajectory generator.
+    """
+    _course_idx = 0
+
+    def __init__(self, plane_pos_set, points=None, waypoints=None, t_set=None, name=None, corridor_mode=None):
+        super().__init__(plane_pos_set)
+        self.course_id = CompiledCourse._course_idx
+        CompiledCourse._course_idx += 1
+        self.name = name
+        self.points = None if points is None else np.array(points)
+        self.waypoints = None if waypoints is None else np.array(waypoints, dtype=bool)
+        self.t_set = t_set
+        self.corridor_mode = corridor_mode
+
+        self.face_norm, self.face_bias = [], []
+        self.corner_norm, self.corner_bias = [], []
+        self.input_norm, self.input_bias = [], []
+        self.output_norm, self.output_bias = [], []
+        self.V_norm, self.V_bias = [], []
+        for plane_pos in plane_pos_set:
+            face_norm, face_bias = get_half_space_array(plane_pos["constraints_plane"], flag_search=True)
+            corner_norm, corner_bias = get_half_space_array(plane_pos["corner_plane"], flag_search=False)
+            if len(plane_pos["input_plane"]) > 0:
+                input_norm, input_bias = get_half_space_array([plane_pos["input_plane"]], flag_search=False)
+            else:
+                input_norm, input_bias = np.zeros((0,3)), np.zeros(0)
+            if len(plane_pos["output_plane"]) > 0:
+                output_norm, output_bias = get_half_space_array([plane_pos["output_plane"]], flag_search=False)
+            else:
+                output_norm, output_bias = np.zeros((0,3)), np.zeros(0)
+
+            self.face_norm.append(face_norm)
+            self.face_bias.append(face_bias)
+            self.corner_norm.append(corner_norm)
+            self.corner_bias.append(corner_bias)
+            self.input_norm.append(input_norm)
+            self.input_bias.append(input_bias)
+            self.output_norm.append(output_norm)
+            self.output_bias.append(output_bias)
+            self.V_norm.append(np.ascontiguousarray( \
+                np.concatenate((face_norm, corner_norm, input_norm, output_norm), axis=0)))
+            self.V_bias.append(np.ascontiguousarray( \
+                np.concatenate((face_bias, corner_bias, input_bias, output_bias), axis=0)))
+
 
 #########################
 # Plot
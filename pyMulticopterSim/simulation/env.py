@@ -64,8 +64,8 @@ class simulation_env():
     
     def manual_seed(self, seed):
         for vehicle_key in self.vehicle_set.keys():
-            if self.vehicle_set[vehicle_id]["type"] == "drone":
-                self.vehicle_set[vehicle_id]["model"].setRandomSeed(seed, seed)
+            if self.vehicle_set[vehicle_key]["type"] == "uav":
+                self.vehicle_set[vehicle_key]["model"].manual_seed(seed)
         return
 
     def set_state_vehicle(self, vehicle_id, **kwargs):
@@ -108,6 +108,15 @@ class simulation_env():
         self._update_state(vehicle_id, duration)
         return
 
+    def rollout_tracking(self, vehicle_id, reference, controller_gains, freq_ctrl, abort_thresholds, buffers, monitor, N_step=None):
+        # Native closed-loop flight, see MulticopterModel.rollout_tracking. Logs only the final state.
+        if self.vehicle_set[vehicle_id]["type"] != "uav":
+            return 0, -1
+        res = self.vehicle_set[vehicle_id]["model"].rollout_tracking(
+            reference, controller_gains, freq_ctrl, abort_thresholds, buffers, monitor, N_step=N_step)
+        self._update_state(vehicle_id, 1.0*res[0]/freq_ctrl)
+        return res
+
     def save_logs(self, vehicle_id=None, save_dir="data/"):
         # Save IMU and Camera data
         if not os.path.exists(save_dir):
@@ -8,6 +8,23 @@ from .controller import UAV_pid_angular_rate, UAV_pid_waypoint
 from .filter import LowPassFilter
 from .utils import *
 
+def check_noise_free(cfg, max_bias_process=0.):
+    # True if the config has no process, IMU or bias noise, so repeated flights are identical.
+    # max_bias_process > 0 opts in to ignoring IMU bias random walks up to that autocorrelation.
+    cfg_uav = cfg['flightgoggles_uav_dynamics']
+    cfg_imu = cfg['flightgoggles_imu']
+    noise_set = [cfg_uav['moment_process_noise'], cfg_uav['force_process_noise'], \
+                 cfg_imu['accelerometer_variance'], cfg_imu['gyroscope_variance'], \
+                 cfg_imu['accelerometer_biasinitvar'], cfg_imu['gyroscope_biasinitvar']]
+    bias_process_set = [cfg_imu['accelerometer_biasprocess'], cfg_imu['gyroscope_biasprocess']]
+    return np.all(np.array(noise_set, dtype=np.float64) == 0) and \
+        np.all(np.array(bias_process_set, dtype=np.float64) <= max_bias_process)
+
+def get_seed_sequence(seed):
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
 class VehicleModel():
     def __init__(self, *args, **kwargs):
         if 'init_pose' in kwargs:
@@ -126,6 +143,7 @@ class MulticopterModel(VehicleModel):
 
                 # Simulation Frequency
                 self.sim_freq = np.double(cfg["sim_freq"])
+                self.flag_noise_free = check_noise_free(cfg, max_bias_process=kwargs.get('max_bias_process', 0.))
 
             except yaml.YAMLError as exc:
                 print(exc)
@@ -146,6 +164,12 @@ class MulticopterModel(VehicleModel):
         self.initialize_state()
         return
 
+    def manual_seed(self, seed):
+        # Independent streams for the rigid body process noise and the IMU
+        multicopter_seed, imu_seed = get_seed_sequence(seed).generate_state(2)
+        self.uav_sim.setRandomSeed(int(multicopter_seed), int(imu_seed))
+        return
+
     def initialize_state(self):
         self.pos = self.init_position
         self.vel = np.zeros(3)
@@ -321,8 +345,414 @@ class MulticopterModel(VehicleModel):
         self.angA = self.lpf_gyro.filterStateDer_
         return
 
+    def rollout_tracking(self, reference, controller_gains, freq_ctrl, abort_thresholds, buffers, monitor, N_step=None):
+        """Closed-loop flight over reference rows inside the pybind module
+
+        Same steps as controller.control_update and proceed_motor_speed once per 1/freq_ctrl,
+        without returning to Python between dynamics steps.
+        reference: (N_step or N_step+1, 18) np array of status_ref[:,2:] rows, the extra row
+            gives the tracking errors of the last step
+        controller_gains (dict): UAV_pid_tracking.get_rollout_gains(), integrator states are updated
+        abort_thresholds (dict): max_pos_err, min_pos_err, max_yaw_err, min_yaw_err
+            (yaw bounds as cosines, as in simulation_core)
+        buffers (dict): trace name (pos, vel, acc, att, att_q, acc_raw, gyro_raw, acc_lpf, gyro_lpf, ms, ms_c,
+            pos_err, yaw_err) -> float64 np array (row views of a record are fine), written in place
+        monitor (dict): pos_err, yaw_err, pos_err_max, yaw_err_max, failure_start_idx, idx_offset
+            carried between calls, updated in place
+        Returns:
+            N_run: number of control steps flown
+            failure_idx: step of the abort within this call, -1 if none
+        """
+        if N_step is None:
+            N_step = reference.shape[0]
+        state = self.get_state()
+        state["simFreq"] = self.sim_freq
+        state["imuFreq"] = self.imu_freq
+        state["simTime"] = self.sim_time
+        state["simTimeDynamics"] = self.sim_time_dynamics
+        state["imuTime"] = self.imu_time
+        state["lpfGainP"] = self.lpf_acc.gainP_
+        state["lpfGainQ"] = self.lpf_acc.gainQ_
+        state["acceleration"] = self.lpf_acc.filterState_
+        state["accelerationDer"] = self.lpf_acc.filterStateDer_
+        state["angular_velocity"] = self.lpf_gyro.filterState_
+        state["angular_acceleration"] = self.lpf_gyro.filterStateDer_
+        state["motor_speed"] = self.lpf_ms.filterState_
+        state["motor_acceleration"] = self.lpf_ms.filterStateDer_
+        state["posErr"] = monitor["pos_err"]
+        state["yawErr"] = monitor["yaw_err"]
+        state["posErrMax"] = monitor["pos_err_max"]
+        state["yawErrMax"] = monitor["yaw_err_max"]
+        state["failureStartIdx"] = monitor["failure_start_idx"]
+        state["idxOffset"] = monitor["idx_offset"]
+
+        thresholds = dict(
+            maxPosErr=abort_thresholds["max_pos_err"], minPosErr=abort_thresholds["min_pos_err"],
+            maxYawErr=abort_thresholds["max_yaw_err"], minYawErr=abort_thresholds["min_yaw_err"])
+        N_run, failure_idx = self.uav_sim.rollout(
+            np.ascontiguousarray(reference, dtype=np.float64), controller_gains, freq_ctrl,
+            thresholds, state, buffers, N_step)
+
+        self.sim_time = state["simTime"]
+        self.sim_time_dynamics = state["simTimeDynamics"]
+        self.imu_time = state["imuTime"]
+        self.pos = state["position"]
+        self.vel = state["velocity"]
+        self.att_q = state["attitude"]
+        self.att = state["attitude_euler_angle"]
+        self.acc_raw = state["acceleration_raw"]
+        self.gyro_raw = state["gyroscope_raw"]
+        self.ms_raw = state["motor_speed_raw"]
+        self.angV_raw = self.uav_sim.getVehicleState()["angularVelocity"]
+        self.lpf_acc.reset_state(state["acceleration"], state["accelerationDer"])
+        self.lpf_gyro.reset_state(state["angular_velocity"], state["angular_acceleration"])
+        self.lpf_ms.reset_state(state["motor_speed"], state["motor_acceleration"])
+        self.acc = self.lpf_acc.filterState_
+        self.angV = self.lpf_gyro.filterState_
+        self.angA = self.lpf_gyro.filterStateDer_
+        self.ms = self.lpf_ms.filterState_
+        self.ma = self.lpf_ms.filterStateDer_
+
+        monitor["pos_err"] = state["posErr"]
+        monitor["yaw_err"] = state["yawErr"]
+        monitor["pos_err_max"] = state["posErrMax"]
+        monitor["yaw_err_max"] = state["yawErrMax"]
+        monitor["failure_start_idx"] = state["failureStartIdx"]
+        return N_run, failure_idx
+
     def update_state_camera(self):
         for cam_key in self.camera_info.keys():
             self.camera_pose[cam_key]["position"] = self.pos + self.camera_info[cam_key]['relativePose'][:3]
             self.camera_pose[cam_key]["attitude"] = mul_quat(self.att_q, self.camera_info[cam_key]['relativePose'][3:7])
-            self.camera_pose[cam_key]["flag_update"] = True
\ No newline at end of file
+            self.camera_pose[cam_key]["flag_update"] = True
+
+
+# NumPy counterpart of MulticopterModel advancing N_vehicle vehicles in lockstep.
+# Same rigid body, motor and IMU model as multicopterDynamicsSim::proceedState_RK4, states are (N_vehicle, .) arrays.
+class MulticopterBatchModel():
+    def __init__(self, *args, **kwargs):
+        if 'N_vehicle' in kwargs:
+            self.N_vehicle = kwargs['N_vehicle']
+        else:
+            self.N_vehicle = 1
+
+        if 'init_pose' in kwargs:
+            self.init_pose = np.array(kwargs["init_pose"])
+        else:
+            self.init_pose = np.array([0,0,0,1,0,0,0])
+
+        if 'imu_freq' in kwargs:
+            self.imu_freq = np.double(kwargs['imu_freq'])
+        else:
+            self.imu_freq = 960.0
+
+        if 'cfg_path' in kwargs:
+            cfg_path = kwargs['cfg_path']
+        else:
+            curr_path = os.path.dirname(os.path.abspath(__file__))
+            cfg_path = curr_path+"/../config/multicopterDynamicsSim.yaml"
+
+        with open(cfg_path, 'r') as stream:
+            cfg = yaml.safe_load(stream)
+        cfg_uav = cfg['flightgoggles_uav_dynamics']
+        cfg_imu = cfg['flightgoggles_imu']
+
+        self.gravity = 9.81
+        self.gravity_vec = np.array([0,0,self.gravity])
+        self.vehicle_mass = np.double(cfg_uav['vehicle_mass'])
+        self.vehicle_inertia = np.array([
+            np.double(cfg_uav['vehicle_inertia_xx']),
+            np.double(cfg_uav['vehicle_inertia_yy']),
+            np.double(cfg_uav['vehicle_inertia_zz'])])
+        self.aero_moment_coeff = np.array([
+            np.double(cfg_uav['aeromoment_coefficient_xx']),
+            np.double(cfg_uav['aeromoment_coefficient_yy']),
+            np.double(cfg_uav['aeromoment_coefficient_zz'])])
+        self.drag_coeff = np.double(cfg_uav['drag_coefficient'])
+        self.moment_noise = np.double(cfg_uav['moment_process_noise'])
+        self.force_noise = np.double(cfg_uav['force_process_noise'])
+
+        self.thrust_coeff = np.double(cfg_uav['thrust_coefficient'])
+        self.torque_coeff = np.double(cfg_uav['torque_coefficient'])
+        self.motor_time_constant = np.double(cfg_uav['motor_time_constant'])
+        self.motor_inertia = np.double(cfg_uav['motor_rotational_inertia'])
+        self.min_motor_speed = 0.
+        self.max_motor_speed = np.double(cfg_uav['max_prop_speed'])
+
+        # Motor frames of MulticopterModel, the rotation diag(1,-1,-1) turns every motor axis to -z
+        momentArm_ = np.double(cfg_uav['moment_arm'])
+        self.motor_pos = momentArm_*np.array([[1.,-1.,0.],[1.,1.,0.],[-1.,1.,0.],[-1.,-1.,0.]])
+        self.motor_dir = np.array([1.,-1.,1.,-1.])
+        self.propSpeed_sta = np.sqrt(self.vehicle_mass*self.gravity/self.thrust_coeff/4)
+
+        # Moments of the squared motor speeds and of the motor accelerations
+        self.moment_ms_sq = np.zeros((4,3))
+        self.moment_ms_sq[:,:] = self.thrust_coeff*np.cross(self.motor_pos, np.array([0.,0.,-1.]))
+        self.moment_ms_sq[:,2] -= self.torque_coeff*self.motor_dir
+        self.moment_ma = np.zeros((4,3))
+        self.moment_ma[:,2] = -self.motor_inertia*self.motor_dir
+
+        # Bilinear terms of the attitude q with (angV, q), contracted by get_state_derivative:
+        # the last column of the attitude matrix minus e_z, and 0.5 * q * (0, angV)
+        T = np.zeros((4,7,7))
+        T[1,6,0], T[0,5,0] = 2., 2.
+        T[2,6,1], T[0,4,1] = 2., -2.
+        T[1,4,2], T[2,5,2] = -2., -2.
+        T[1,0,3], T[2,1,3], T[3,2,3] = -.5, -.5, -.5
+        T[0,0,4], T[2,2,4], T[3,1,4] = .5, .5, -.5
+        T[0,1,5], T[1,2,5], T[3,0,5] = .5, -.5, .5
+        T[0,2,6], T[1,1,6], T[2,0,6] = .5, .5, -.5
+        self.att_bilinear = T.reshape(28,7)
+        # Cross product, (a x b)_k = sum_ij eps[i,j,k] a_i b_j
+        eps = np.zeros((3,3,3))
+        eps[0,1,2], eps[1,2,0], eps[2,0,1] = 1., 1., 1.
+        eps[0,2,1], eps[2,1,0], eps[1,0,2] = -1., -1., -1.
+        self.cross_bilinear = eps.reshape(9,3)
+
+        # IMU
+        self.acc_bias_var = np.double(cfg_imu["accelerometer_biasinitvar"])
+        self.gyro_bias_var = np.double(cfg_imu["gyroscope_biasinitvar"])
+        self.acc_bias_process = np.double(cfg_imu["accelerometer_biasprocess"])
+        self.gyro_bias_process = np.double(cfg_imu["gyroscope_biasprocess"])
+        self.acc_var = np.double(cfg_imu["accelerometer_variance"])
+        self.gyro_var = np.double(cfg_imu["gyroscope_variance"])
+
+        # Simulation Frequency
+        self.sim_freq = np.double(cfg["sim_freq"])
+        self.flag_noise_free = check_noise_free(cfg, max_bias_process=kwargs.get('max_bias_process', 0.))
+        self.rng = None
+
+        self.lpf_acc = LowPassFilter(dim=3,
+            gainP=np.double(cfg["flightgoggles_lpf"]["gain_p"]),
+            gainQ=np.double(cfg["flightgoggles_lpf"]["gain_q"]))
+        self.lpf_gyro = LowPassFilter(dim=3,
+            gainP=np.double(cfg["flightgoggles_lpf"]["gain_p"]),
+            gainQ=np.double(cfg["flightgoggles_lpf"]["gain_q"]))
+        self.lpf_ms = LowPassFilter(dim=4,
+            gainP=np.double(cfg["flightgoggles_lpf"]["gain_p"]),
+            gainQ=np.double(cfg["flightgoggles_lpf"]["gain_q"]))
+
+        self.initialize_state()
+        return
+
+    # Dynamics state x_dyn (N_vehicle, 17): position, velocity, angular velocity, attitude (w,x,y,z), motor speed
+    @property
+    def pos(self):
+        return self.x_dyn[:,0:3]
+
+    @property
+    def vel(self):
+        return self.x_dyn[:,3:6]
+
+    @property
+    def angV_raw(self):
+        return self.x_dyn[:,6:9]
+
+    @property
+    def att_q(self):
+        return self.x_dyn[:,9:13]
+
+    @property
+    def ms_raw(self):
+        return self.x_dyn[:,13:17]
+
+    def get_noise(self, var, dim):
+        if var == 0:
+            return np.zeros((self.N_vehicle,dim))
+        if self.rng is None:
+            return np.sqrt(var)*np.random.randn(self.N_vehicle,dim)
+        return np.sqrt(var)*np.array([rng.standard_normal(dim) for rng in self.rng])
+
+    def manual_seed(self, seeds):
+        # One independent generator per vehicle, the initial IMU biases are drawn again from them
+        self.rng = [np.random.default_rng(get_seed_sequence(seed)) for seed in seeds]
+        self.acc_bias = self.get_noise(self.acc_bias_var, 3)
+        self.gyro_bias = self.get_noise(self.gyro_bias_var, 3)
+        return
+
+    def initialize_state(self, N_vehicle=None):
+        if N_vehicle is not None:
+            self.N_vehicle = N_vehicle
+        M = self.N_vehicle
+        self.rng = None
+        self.x_dyn = np.zeros((M,17))
+        self.x_dyn[:,0:3] = self.init_pose[:3]
+        self.x_dyn[:,9:13] = self.init_pose[3:7]
+        self.acc = np.zeros((M,3))
+        self.att = quat2Euler_batch(self.att_q)
+        self.angV = np.zeros((M,3))
+        self.angA = np.zeros((M,3))
+        self.ms = np.ones((M,4))*self.propSpeed_sta
+        self.ma = np.zeros((M,4))
+
+        self.acc_raw = copy.deepcopy(self.acc)
+        self.gyro_raw = np.zeros((M,3))
+        self.force_stoch = np.zeros((M,3))
+        self.acc_bias = self.get_noise(self.acc_bias_var, 3)
+        self.gyro_bias = self.get_noise(self.gyro_bias_var, 3)
+
+        self.lpf_acc.reset_state(self.acc, np.zeros((M,3)))
+        self.lpf_gyro.reset_state(self.angV, self.angA)
+        self.lpf_ms.reset_state(self.ms, self.ma)
+
+        self.sim_time = 0
+        self.sim_time_dynamics = 0
+        self.imu_time = 0
+        return
+
+    def get_state(self):
+        state = dict()
+        state["timestamp"] = self.sim_time
+        state["position"] = self.pos
+        state["velocity"] = self.vel
+        state["acceleration_raw"] = self.acc_raw
+        state["acceleration"] = self.acc
+        state["attitude_euler_angle"] = self.att
+        state["attitude"] = self.att_q
+        state["gyroscope_raw"] = self.gyro_raw
+        state["angular_velocity"] = self.angV
+        state["angular_acceleration"] = self.angA
+        state["motor_speed_raw"] = self.ms_raw
+        state["motor_speed"] = self.ms
+        state["motor_acceleration"] = self.ma
+        return state
+
+    def set_state(self, **kwargs):
+        # Same keys as MulticopterModel.set_state, values are broadcast to (N_vehicle, .)
+        def get_arr(key, dim):
+            return np.array(np.broadcast_to(np.asarray(kwargs[key], dtype=np.float64), (self.N_vehicle,dim)))
+
+        if "position" in kwargs:
+            self.x_dyn[:,0:3] = get_arr("position", 3)
+        if "velocity" in kwargs:
+            self.x_dyn[:,3:6] = get_arr("velocity", 3)
+        if "acceleration_raw" in kwargs:
+            self.acc_raw = get_arr("acceleration_raw", 3)
+        if "acceleration" in kwargs:
+            self.acc = get_arr("acceleration", 3)
+        if "attitude_euler_angle" in kwargs:
+            self.att = get_arr("attitude_euler_angle", 3)
+            self.x_dyn[:,9:13] = Euler2quat_batch(self.att)
+        if "attitude" in kwargs:
+            self.x_dyn[:,9:13] = get_arr("attitude", 4)
+            self.att = quat2Euler_batch(self.att_q)
+        if "gyroscope_raw" in kwargs:
+            self.gyro_raw = get_arr("gyroscope_raw", 3)
+        if "angular_velocity" in kwargs:
+            self.angV = get_arr("angular_velocity", 3)
+        if "angular_acceleration" in kwargs:
+            self.angA = get_arr("angular_acceleration", 3)
+        if "motor_speed" in kwargs:
+            self.ms = get_arr("motor_speed", 4)
+        if "motor_acceleration" in kwargs:
+            self.ma = get_arr("motor_acceleration", 4)
+
+        # setVehicleState(pos, vel, angV, att_q, ms)
+        self.x_dyn[:,6:9] = self.angV
+        self.x_dyn[:,13:17] = self.ms
+
+        self.lpf_acc.reset_state(self.acc, np.zeros((self.N_vehicle,3)))
+        self.lpf_gyro.reset_state(self.angV, self.angA)
+        self.lpf_ms.reset_state(self.ms, self.ma)
+        return
+
+    def select(self, idx):
+        # Keep the vehicles in idx (index or boolean mask)
+        for key in ["x_dyn", "acc", "att", "angV", "angA", "ms", "ma", \
+                    "acc_raw", "gyro_raw", "force_stoch", "acc_bias", "gyro_bias"]:
+            setattr(self, key, getattr(self, key)[idx])
+        for lpf in [self.lpf_acc, self.lpf_gyro, self.lpf_ms]:
+            lpf.reset_state(lpf.filterState_[idx], lpf.filterStateDer_[idx])
+        if self.rng is not None:
+            self.rng = [self.rng[i] for i in np.arange(len(self.rng))[idx]]
+        self.N_vehicle = self.x_dyn.shape[0]
+        return
+
+    def get_state_derivative(self, x, motor_command, force_stoch, moment_stoch):
+        M = x.shape[0]
+        vel = x[:,3:6]
+        angV = x[:,6:9]
+        ms = x[:,13:17]
+        x_der = np.empty_like(x)
+        x_der[:,0:3] = vel
+
+        ms_der = (motor_command - ms)*(1./self.motor_time_constant)
+        x_der[:,13:17] = ms_der
+
+        att_bl = (x[:,9:13,np.newaxis]*x[:,np.newaxis,6:13]).reshape(M,28).dot(self.att_bilinear)
+        x_der[:,9:13] = att_bl[:,3:7]
+
+        # Thrust along -z body, drag and process noise
+        ms_sq = np.fabs(ms)*ms
+        thrust_dir = att_bl[:,0:3]
+        thrust_dir[:,2] += 1.
+        x_der[:,3:6] = (force_stoch - thrust_dir*(self.thrust_coeff*ms_sq.sum(axis=1))[:,np.newaxis] \
+            - self.drag_coeff*np.sqrt((vel*vel).sum(axis=1))[:,np.newaxis]*vel)*(1./self.vehicle_mass) \
+            + self.gravity_vec
+
+        # Thrust, motor torque, aerodynamic and gyroscopic moments
+        ang_momentum = self.vehicle_inertia*angV
+        ang_momentum[:,2] -= self.motor_inertia*ms.dot(self.motor_dir)
+        moment = ms_sq.dot(self.moment_ms_sq) + ms_der.dot(self.moment_ma) + moment_stoch \
+            - np.sqrt((angV*angV).sum(axis=1))[:,np.newaxis]*self.aero_moment_coeff*angV \
+            - (angV[:,:,np.newaxis]*ang_momentum[:,np.newaxis,:]).reshape(M,9).dot(self.cross_bilinear)
+        x_der[:,6:9] = moment/self.vehicle_inertia
+        return x_der
+
+    def proceed_state(self, dt, motor_command):
+        motor_command = np.clip(motor_command, self.min_motor_speed, self.max_motor_speed)
+        self.force_stoch = self.get_noise(self.force_noise/dt, 3)
+        moment_stoch = self.get_noise(self.moment_noise/dt, 3)
+
+        f = lambda x: self.get_state_derivative(x, motor_command, self.force_stoch, moment_stoch)
+        x = self.x_dyn
+        k1 = f(x)
+        k2 = f(x+0.5*dt*k1)
+        k3 = f(x+0.5*dt*k2)
+        k4 = f(x+dt*k3)
+        x = x + dt/6.*(k1+2.*k2+2.*k3+k4)
+        x[:,9:13] /= np.sqrt((x[:,9:13]**2).sum(axis=1))[:,np.newaxis]
+        x[:,13:17] = np.clip(x[:,13:17], self.min_motor_speed, self.max_motor_speed)
+        self.x_dyn = x
+
+        # IMU bias random walk
+        self.acc_bias += self.get_noise(self.acc_bias_process*dt, 3)
+        self.gyro_bias += self.get_noise(self.gyro_bias_process*dt, 3)
+        return
+
+    def proceed_motor_speed(self, motor_command, dt):
+        self.sim_time += dt
+        while self.sim_time > self.sim_time_dynamics + 1./self.sim_freq:
+            self.proceed_state(1./self.sim_freq, motor_command)
+            self.sim_time_dynamics += 1./self.sim_freq
+            if self.sim_time_dynamics >= self.imu_time:
+                self.update_state_imu(1./self.imu_freq)
+                self.imu_time += 1./self.imu_freq
+            self.update_state_vehicle(1./self.sim_freq)
+        # Euler angles are only read between control steps
+        self.att = quat2Euler_batch(self.att_q)
+        return
+
+    def update_state_vehicle(self, dt):
+        self.lpf_ms.proceed_state(self.ms_raw, dt)
+        self.ms = self.lpf_ms.filterState_
+        self.ma = self.lpf_ms.filterStateDer_
+        return
+
+    def update_state_imu(self, dt):
+        # Specific force in body frame
+        force_world = self.force_stoch - self.drag_coeff*np.sqrt((self.vel*self.vel).sum(axis=1))[:,np.newaxis]*self.vel
+        specific_force = np.einsum('nji,nj->ni', quat2rotm_batch(self.att_q), force_world)
+        specific_force[:,2] -= self.thrust_coeff*(np.fabs(self.ms_raw)*self.ms_raw).sum(axis=1)
+        specific_force /= self.vehicle_mass
+        self.acc_raw = specific_force + self.acc_bias + self.get_noise(self.acc_var, 3)
+        self.gyro_raw = self.angV_raw + self.gyro_bias + self.get_noise(self.gyro_var, 3)
+
+        # filtered state
+        self.lpf_acc.proceed_state(self.acc_raw, dt)
+        self.lpf_gyro.proceed_state(self.gyro_raw, dt)
+
+        self.acc = self.lpf_acc.filterState_
+        self.angV = self.lpf_gyro.filterState_
+        self.angA = self.lpf_gyro.filterStateDer_
+        return
@@ -103,6 +103,42 @@ def Euler2quat(att):
     
     return q
 
+# Batched variants over the leading axes of (...,4) / (...,3) arrays
+def quat2rotm_batch(q):
+    # Rotation matrices (...,3,3) of unit quaternions, body to world
+    w, x, y, z = q[...,0], q[...,1], q[...,2], q[...,3]
+    rotm = np.empty(q.shape[:-1]+(3,3))
+    rotm[...,0,0] = 1.-2.*(y*y+z*z)
+    rotm[...,0,1] = 2.*(x*y-w*z)
+    rotm[...,0,2] = 2.*(x*z+w*y)
+    rotm[...,1,0] = 2.*(x*y+w*z)
+    rotm[...,1,1] = 1.-2.*(x*x+z*z)
+    rotm[...,1,2] = 2.*(y*z-w*x)
+    rotm[...,2,0] = 2.*(x*z-w*y)
+    rotm[...,2,1] = 2.*(y*z+w*x)
+    rotm[...,2,2] = 1.-2.*(x*x+y*y)
+    return rotm
+
+def quat2Euler_batch(q):
+    q0, q1, q2, q3 = q[...,0], q[...,1], q[...,2], q[...,3]
+    att = np.empty(q.shape[:-1]+(3,))
+    att[...,0] = np.arctan2(2*(q0*q1+q2*q3), (1.-2.*(q1**2+q2**2)))
+    att[...,1] = np.arcsin(np.clip(2.*(q0*q2-q3*q1), -1., 1.))
+    att[...,2] = np.arctan2(2.*(q0*q3+q1*q2), (1.-2.*(q2**2+q3**2)))
+    return att
+
+def Euler2quat_batch(att):
+    c = np.cos(att/2)
+    s = np.sin(att/2)
+    cr, cp, cy = c[...,0], c[...,1], c[...,2]
+    sr, sp, sy = s[...,0], s[...,1], s[...,2]
+    q = np.empty(att.shape[:-1]+(4,))
+    q[...,0] = cy * cp * cr + sy * sp * sr
+    q[...,1] = sr * cp * cy - cr * sp * sy
+    q[...,2] = cr * sp * cy + sr * cp * sy
+    q[...,3] = cr * cp * sy - sr * sp * cy
+    return q
+
 # body->unity
 def ned2enu(pos, att):
     r_bias2 = R.from_euler('x', 180, degrees=True)
@@ -502,6 +502,140 @@ class UAV_pid_tracking(UAV_pid_angular_rate):
         self.position_error_integrator = np.zeros(3)
         return
 
+    def get_rollout_gains(self):
+        """Gains and integrator states in the layout of the native rollout (MulticopterModel.rollout_tracking)"""
+        gains = dict()
+        gains["vehicleMass"] = np.double(self.vehicleMass_)
+        gains["vehicleInertia"] = np.ones(3)*self.vehicleInertia_
+        gains["momentArm"] = np.double(self.momentArm_)
+        gains["thrustCoeff"] = np.double(self.thrustCoeff_)
+        gains["torqueCoeff"] = np.double(self.torqueCoeff_)
+        gains["positionPGain"] = np.ones(3)*self.position_p_gain
+        gains["positionDGain"] = np.ones(3)*self.position_d_gain
+        gains["positionIGain"] = np.ones(3)*self.position_i_gain
+        gains["velocityPGain"] = np.ones(3)*self.velocity_p_gain
+        gains["velocityDGain"] = np.ones(3)*self.velocity_d_gain
+        gains["maxVelocityPosError"] = np.ones(3)*self.max_velocity_poserror
+        gains["maxVelocityCommand"] = np.ones(3)*self.maxVelocityCommand
+        gains["maxAccelerationCommand"] = np.ones(3)*self.maxAccelerationCommand
+        gains["maxAngrate"] = np.ones(3)*self.max_angrate
+        gains["attitudeGain"] = np.ones(3)*self.attitude_gain
+        gains["thrustDirection"] = np.ones(3)*self.thrust_dir
+        gains["propGain"] = np.ones(3)*self.propGain_
+        gains["intGain"] = np.ones(3)*self.intGain_
+        gains["derGain"] = np.ones(3)*self.derGain_
+        gains["intBound"] = np.ones(3)*self.intBound_
+        gains["intState"] = np.ones(3)*self.intState_
+        gains["positionErrorIntegrator"] = np.ones(3)*self.position_error_integrator
+        return gains
+
+    def set_rollout_state(self, gains):
+        """Integrator states back from the native rollout"""
+        self.intState_ = np.array(gains["intState"], dtype=np.float64)
+        self.position_error_integrator = np.array(gains["positionErrorIntegrator"], dtype=np.float64)
+        return
+
+# UAV_pid_tracking for N_vehicle vehicles, states are (N_vehicle, .) arrays
+class UAV_pid_tracking_batch(UAV_pid_tracking):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if 'N_vehicle' in kwargs:
+            self.N_vehicle = kwargs['N_vehicle']
+        else:
+            self.N_vehicle = 1
+
+        G1xy = self.thrustCoeff_ * self.momentArm_
+        invG1xy = 1./(4.*G1xy)
+        invG1z = 1./(4.*self.torqueCoeff_)
+        invG1t = 1./(4.*self.thrustCoeff_)
+        self.invG1 = np.array([
+            [ invG1xy,  invG1xy, -invG1z, -invG1t],
+            [-invG1xy,  invG1xy,  invG1z, -invG1t],
+            [-invG1xy, -invG1xy, -invG1z, -invG1t],
+            [ invG1xy, -invG1xy,  invG1z, -invG1t]
+        ])
+
+        self.reset_state()
+        return
+
+    def saturateVector(self, vec, bound):
+        return np.fmax(-bound, np.fmin(vec, bound))
+
+    def thrust_mixing(self, angAccCommand, thrustCommand):
+        momentThrust = np.zeros((angAccCommand.shape[0],4))
+        momentThrust[:,:3] = self.vehicleInertia_*angAccCommand
+        momentThrust[:,3] = -thrustCommand
+        motorSpeedsSquared = momentThrust.dot(self.invG1.T)
+        return np.copysign(np.sqrt(np.fabs(motorSpeedsSquared)), motorSpeedsSquared)
+
+    def control_update(self, traj_ref, curpos, curvel, curacc, curatt, curattVel, curattAcc, dt):
+        """Same as UAV_pid_tracking.control_update with (N_vehicle, .) arguments
+
+        Returns:
+            propSpeedCommand: (N_vehicle, 4) np array
+        """
+        pos_err = traj_ref[:,0:3] - curpos
+        self.position_error_integrator += dt*pos_err
+        vel_err = traj_ref[:,3:6] - curvel
+
+        # getVelocityCommand
+        sat_pos_err = self.saturateVector(pos_err, self.max_velocity_poserror)
+        vel_cmd = self.position_p_gain*sat_pos_err \
+                  + self.position_d_gain*vel_err \
+                  + self.position_i_gain*self.position_error_integrator
+        sat_vel_cmd = self.saturateVector(vel_cmd, self.maxVelocityCommand)
+
+        # getAccelerationCommand
+        vel_err += sat_vel_cmd
+        acc_err = traj_ref[:,6:9] - curacc
+        acc_cmd = self.velocity_p_gain*vel_err \
+                  + self.velocity_d_gain*acc_err
+        acc_cmd = self.saturateVector(acc_cmd, self.maxAccelerationCommand)
+        acc_cmd[:,2] -= 9.81
+        thrust_cmd = self.vehicleMass_*acc_cmd
+
+        # getAttitudeCommand
+        att_ref = np.zeros((traj_ref.shape[0],3))
+        att_ref[:,2] = traj_ref[:,15]
+        att_ref = Euler2quat_batch(att_ref)
+        att_cur = Euler2quat_batch(curatt)
+
+        thrustcmd_yawframe = quat_rotate_batch(att_ref, thrust_cmd)
+        thrust_rot = vecvec2quat_batch(self.thrust_dir, thrustcmd_yawframe)
+        att_cmd = mul_quat_batch(att_ref, thrust_rot)
+
+        # getAngularRateCommand
+        att_error = mul_quat_batch(inv_quat_batch(att_cur), att_cmd)
+        att_error *= np.where(att_error[:,0:1] < 0., -1., 1.)
+        angle_error = quat2Euler_batch(att_error)
+        angrate_cmd = angle_error*self.attitude_gain
+
+        thrustCommand = np.linalg.norm(thrust_cmd, axis=1)
+        attVelCommand = self.saturateVector(angrate_cmd, self.max_angrate)
+
+        stateDev = attVelCommand - curattVel
+        self.intState_ += dt*stateDev
+        self.intState_ = np.fmin(np.fmax(-self.intBound_,self.intState_),self.intBound_)
+        angAccCommand = self.propGain_*stateDev + \
+            self.intGain_*self.intState_ - self.derGain_*curattAcc
+
+        return self.thrust_mixing(angAccCommand, thrustCommand)
+
+    def select(self, idx):
+        # Keep the vehicles in idx (index or boolean mask)
+        self.intState_ = self.intState_[idx]
+        self.position_error_integrator = self.position_error_integrator[idx]
+        self.N_vehicle = self.intState_.shape[0]
+        return
+
+    def reset_state(self, N_vehicle=None):
+        if N_vehicle is not None:
+            self.N_vehicle = N_vehicle
+        self.intState_ = np.zeros((self.N_vehicle,3))
+        self.position_error_integrator = np.zeros((self.N_vehicle,3))
+        return
+
 if __name__ == "__main__":
     # execute only if run as a script
     print("test")
\ No newline at end of file
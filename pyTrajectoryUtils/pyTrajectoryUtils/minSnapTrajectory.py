@@ -157,36 +157,16 @@ class MinSnapTrajectory(BaseTrajFunc):
     ###############################################################################
     def sanity_check(self, t_set, d_ordered, d_ordered_yaw=None, flag_parallel=False):
         flag_loop = self.check_flag_loop(t_set,d_ordered)
-        N_POLY = t_set.shape[0]
-        
-        status = np.zeros((self.N_POINTS*N_POLY,18))
-
-        for der in range(5):
-            if flag_loop:
-                V_t = self.generate_sampling_matrix_loop(t_set, N=self.N_POINTS, der=der)
-            else:
-                V_t = self.generate_sampling_matrix(t_set, N=self.N_POINTS, der=der, endpoint=True)
-            status[:,3*der:3*(der+1)] = V_t.dot(d_ordered)
-        
-        if np.all(d_ordered_yaw != None):
-            status_yaw_xy = np.zeros((self.N_POINTS*N_POLY,3,2))
-            for der in range(3):
-                if flag_loop:
-                    V_t = self.generate_sampling_matrix_loop_yaw(t_set, N=self.N_POINTS, der=der)
-                else:
-                    V_t = self.generate_sampling_matrix_yaw(t_set, N=self.N_POINTS, der=der, endpoint=True)
-                status_yaw_xy[:,der,:] = V_t.dot(d_ordered_yaw)
-            status[:,15:] = self.get_yaw_der(status_yaw_xy)
+        traj = self.get_piecewise_trajectory(t_set, d_ordered, d_ordered_yaw)
+        status = traj.get_status(traj.get_sample_time(self.N_POINTS, endpoint=not flag_loop))
 
         if flag_parallel:
             ws, ctrl = self._quadModel.getWs_vector(status)
             if np.any(ws < self._quadModel.w_min) or np.any(ws > self._quadModel.w_max):
                 return False
         else:
-            for j in range(self.N_POINTS*N_POLY):
-                ws, ctrl = self._quadModel.getWs(status[j,:])
-                if np.any(ws < self._quadModel.w_min) or np.any(ws > self._quadModel.w_max):
-                    return False
+            flag_feasible, _ = self._quadModel.check_Ws_batch(status[np.newaxis,:,:])
+            return flag_feasible[0]
 
         return True
     
@@ -308,27 +288,25 @@ class MinSnapTrajectory(BaseTrajFunc):
         
         yaw_ref = np.zeros((N_POLY,2))
         vel = np.zeros((N_POLY,2))
-        if flag_loop:
-            V_t = self.generate_sampling_matrix_loop(t_set, N=self.N_POINTS, der=1)
-        else:
-            V_t = self.generate_sampling_matrix(t_set, N=self.N_POINTS, der=1, endpoint=True)
-        vel[:np.int(V_t.shape[0]/self.N_POINTS),:] = (V_t.dot(d_ordered[:,:2]))[::self.N_POINTS,:]
+        traj = self.get_piecewise_trajectory(t_set, d_ordered)
+        vel_t = traj.eval(traj.get_sample_time(self.N_POINTS, endpoint=not flag_loop), der=1)[:,:2]
+        vel[:np.int(vel_t.shape[0]/self.N_POINTS),:] = vel_t[::self.N_POINTS,:]
         
         if not flag_loop:
-            vel[-1,:] = (V_t.dot(d_ordered[:,:2]))[-1,:]
+            vel[-1,:] = vel_t[-1,:]
         
         for i in range(N_POLY):
             if np.linalg.norm(vel[i,:2]) < 1e-6:
                 if i < N_POLY:
                     for j in range(1,self.N_POINTS):
-                        vel_tmp = V_t.dot(d_ordered[:,:2])[i*self.N_POINTS+j,:]
+                        vel_tmp = vel_t[i*self.N_POINTS+j,:]
                         if np.linalg.norm(vel_tmp[:2]) > 1e-6:
                             vel_tmp2 = vel_tmp
                             break
                         vel_tmp2 = np.array([1,0])
                 else:
                     for j in range(1,self.N_POINTS):
-                        vel_tmp = V_t.dot(d_ordered[:,:2])[i*self.N_POINTS-j,:]
+                        vel_tmp = vel_t[i*self.N_POINTS-j,:]
                         if np.linalg.norm(vel_tmp[:2]) > 1e-6:
                             vel_tmp2 = vel_tmp
                             break
@@ -42,6 +42,7 @@ class QuadModel:
                            [-k1,-k1,-k1,-k1]])
 
         self.J = np.diag(np.array([self.Ixx,self.Iyy,self.Izz]))
+        self.G1_inv = np.linalg.inv(self.G1)
         
         return
 
@@ -239,6 +240,110 @@ class QuadModel:
 
         return Ws, state
 
+    def getWs_batch(self, status):
+        """Batched getWs over the leading axes of status (..., 18)
+        
+        Same flatness map as getWs_vector, written per component
+        with G1_inv and J taken from the constructor.
+        
+        Returns:
+            Ws: (..., 4) np array
+        """
+        status = np.asarray(status)
+        acc = status[...,6:9]
+        jer = status[...,9:12]
+        sna = status[...,12:15]
+        yaw = status[...,15]
+        dyaw = status[...,16]
+        ddyaw = status[...,17]
+        
+        # Total thrust
+        tau_v = np.array(acc)
+        tau_v[...,2] -= self.gravity
+        tau = -np.linalg.norm(tau_v,axis=-1)
+        bz = tau_v/tau[...,np.newaxis]
+        
+        # roll & pitch
+        sy = np.sin(yaw)
+        cy = np.cos(yaw)
+        roll = np.arcsin(bz[...,0]*sy-bz[...,1]*cy)
+        pitch = np.arctan((bz[...,0]*cy+bz[...,1]*sy)/bz[...,2])
+        sr = np.sin(roll)
+        cr = np.cos(roll)
+        sp = np.sin(pitch)
+        cp = np.cos(pitch)
+        tp = sp/cp
+        bx = np.stack((cy*cp, sy*cp, -sp),axis=-1)
+        by = np.stack((-sy*cr+cy*sp*sr, cy*cr+sy*sp*sr, cp*sr),axis=-1)
+        
+        # dzhi & Omega
+        dzhi0 = -np.sum(by*jer,axis=-1)/tau+sp*dyaw
+        dzhi1 = np.sum(bx*jer,axis=-1)/(cr*tau)-cp*sr/cr*dyaw
+        Omega0 = dzhi0-sp*dyaw
+        Omega1 = cr*dzhi1+cp*sr*dyaw
+        Omega2 = -sr*dzhi1+cp*cr*dyaw
+        
+        d = np.stack((cy*sr-cr*sy*sp, sy*sr+cr*cy*sp, np.zeros_like(yaw)),axis=-1)*tau[...,np.newaxis]
+        dtau = np.sum(bz*(jer-d*dyaw[...,np.newaxis]),axis=-1)
+        
+        # ddzhi & dOmega, dS has a zero first column
+        dSO0 = (cr*tp*dzhi0+sr/cp/cp*dzhi1)*Omega1+(-sr*tp*dzhi0+cr/cp/cp*dzhi1)*Omega2
+        dSO1 = -dzhi0*(sr*Omega1+cr*Omega2)
+        dSO2 = (cr*dzhi0+sr*tp*dzhi1)/cp*Omega1+(-sr*dzhi0+cr*tp*dzhi1)/cp*Omega2
+        SdSO0 = dSO0-sp*dSO2
+        SdSO1 = cr*dSO1+cp*sr*dSO2
+        SdSO2 = -sr*dSO1+cp*cr*dSO2
+        
+        e = (2*dtau*Omega0-tau*SdSO0)[...,np.newaxis]*(-by) \
+            +(2*dtau*Omega1-tau*SdSO1)[...,np.newaxis]*bx \
+            +tau[...,np.newaxis]*(bx*(Omega0*Omega2)[...,np.newaxis] \
+                                  +by*(Omega1*Omega2)[...,np.newaxis] \
+                                  -bz*(Omega0*Omega0+Omega1*Omega1)[...,np.newaxis])
+        r = sna-d*ddyaw[...,np.newaxis]-e
+        ddzhi0 = -np.sum(by*r,axis=-1)/tau
+        ddzhi1 = np.sum(bx*r,axis=-1)/(cr*tau)
+        
+        Omega = np.stack((Omega0, Omega1, Omega2),axis=-1)
+        dOmega = np.stack((
+            ddzhi0-sp*ddyaw-SdSO0,
+            cr*ddzhi1+cp*sr*ddyaw-SdSO1,
+            -sr*ddzhi1+cp*cr*ddyaw-SdSO2),axis=-1)
+        
+        MT = np.empty(status.shape[:-1]+(4,))
+        MT[...,:3] = np.matmul(dOmega,self.J.T)+np.cross(Omega,np.matmul(Omega,self.J.T))
+        MT[...,3] = self.mass*tau
+        Ws2 = np.matmul(MT,self.G1_inv.T)
+        Ws = np.copysign(np.sqrt(np.abs(Ws2)),Ws2)
+        
+        return Ws
+    
+    def getWs_margin_batch(self, status):
+        """Signed motor speed margin of status (..., 18) in units of w_max-w_min
+        
+        Positive inside [w_min, w_max], the worst motor of every sample.
+        
+        Returns:
+            margin: (...) np array
+        """
+        Ws = self.getWs_batch(status)
+        margin = np.minimum(Ws-self.w_min, self.w_max-Ws)/(self.w_max-self.w_min)
+        
+        return np.min(margin,axis=-1)
+    
+    def check_Ws_batch(self, status):
+        """Motor speed feasibility of status (B, S, 18), B trajectories of S samples
+        
+        Returns:
+            flag_feasible: (B,) bool np array
+            idx_violation: (B,) int np array, first infeasible sample, -1 if feasible
+        """
+        Ws = self.getWs_batch(status)
+        flag_violation = np.any((Ws < self.w_min) | (Ws > self.w_max),axis=-1)
+        flag_feasible = ~np.any(flag_violation,axis=-1)
+        idx_violation = np.where(flag_feasible, -1, np.argmax(flag_violation,axis=-1))
+        
+        return flag_feasible, idx_violation
+    
 #     def getWs_vector_cupy(self, status):
 #         pos = cp.array(status[:,0:3])
 #         vel = cp.array(status[:,3:6])
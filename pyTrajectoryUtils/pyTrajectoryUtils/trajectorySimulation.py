@@ -17,6 +17,170 @@ from .PIDcontroller import *
 plt.switch_backend('agg')
 
 
+class StatusReference(object):
+    def __init__(self, t_array, traj=None, chunk_size=200):
+        """Reference status rows (time, 1, pos, vel, acc, jerk, snap, yaw, dyaw, ddyaw)
+        
+        traj (PiecewiseTrajectory): rows are evaluated lazily in chunks of chunk_size,
+            so a flight aborted early only pays for the reference up to the failure point.
+        """
+        self.N = t_array.shape[0]
+        self.status = np.zeros((self.N,20))
+        self.status[:,0] = t_array
+        self.status[:,1] = 1
+        self.traj = traj
+        self.chunk_size = max(np.int(chunk_size),1)
+        self.N_filled = 0
+        return
+    
+    @classmethod
+    def from_array(cls, status_ref):
+        ref = cls(status_ref[:,0])
+        ref.status = np.array(status_ref, dtype=np.float64)
+        ref.N_filled = ref.N
+        return ref
+    
+    def fill(self, idx):
+        # Evaluate chunks until row idx is available
+        idx = min(idx, self.N-1)
+        while self.N_filled <= idx:
+            idx_end = min(self.N_filled+self.chunk_size, self.N)
+            self.status[self.N_filled:idx_end,2:] = \
+                self.traj.get_status(self.status[self.N_filled:idx_end,0])
+            self.N_filled = idx_end
+        return
+    
+    def row(self, it):
+        self.fill(it)
+        return self.status[it,:]
+    
+    def get_array(self):
+        """Rows evaluated so far"""
+        return self.status[:self.N_filled,:]
+    
+    def get_total_time(self):
+        return self.status[-1,0]
+
+
+class SimulationRecord(object):
+    """Per-tick traces of a simulation core in one structured array, rows written in place
+
+    record: "full" keeps every trace, "pos_only" time and pos (enough for the corridor check),
+        "verdict_only" no traces. The max tracking errors are kept in every mode.
+    N_vehicle: (N_vehicle, N) record for simulation_core_batch, (N,) if None
+    """
+    __slots__ = ("record", "data", "pos_err", "yaw_err", "pos_err_max", "yaw_err_max")
+
+    FIELDS = [("time",()), ("pos",(3,)), ("vel",(3,)), ("acc",(3,)), ("att",(3,)), ("att_q",(4,)), \
+              ("acc_raw",(3,)), ("gyro_raw",(3,)), ("acc_lpf",(3,)), ("gyro_lpf",(3,)), ("ms",(4,)), ("ms_c",(4,))]
+    MODES = {
+        "full": [name for name, shape in FIELDS],
+        "pos_only": ["time", "pos"],
+        "verdict_only": []}
+
+    def __init__(self, N, record="full", N_vehicle=None):
+        if record not in self.MODES:
+            raise ValueError("Unknown record mode {}, use one of {}".format(record, list(self.MODES.keys())))
+        self.record = record
+        if N_vehicle is None:
+            shape = (N,)
+        else:
+            shape = (N_vehicle, N)
+        dtype = [(name, np.float64, sub_shape) for name, sub_shape in self.FIELDS if name in self.MODES[record]]
+        if len(dtype) > 0:
+            self.data = np.zeros(shape, dtype=dtype)
+        else:
+            self.data = None
+        if record == "full":
+            self.pos_err = np.zeros(shape)
+            self.yaw_err = np.zeros(shape)
+        else:
+            self.pos_err = None
+            self.yaw_err = None
+        self.pos_err_max = np.zeros(shape[:-1])
+        self.yaw_err_max = np.zeros(shape[:-1])
+        return
+
+    def set_row(self, it, model, ms_c, freq_ctrl):
+        # Tuple order follows FIELDS
+        if self.record == "full":
+            self.data[it] = (1.0*(it+1)/freq_ctrl, model.pos, model.vel, model.acc, model.att, model.att_q, \
+                             model.acc_raw, model.gyro_raw, model.acc, model.angV, model.ms, ms_c)
+        elif self.record == "pos_only":
+            self.data[it] = (1.0*(it+1)/freq_ctrl, model.pos)
+        return
+
+    def set_rows(self, idx, it, model, ms_c, freq_ctrl):
+        # Batched set_row for the vehicles idx of a (N_vehicle, N) record
+        if self.data is None:
+            return
+        self.data["time"][idx,it] = 1.0*(it+1)/freq_ctrl
+        self.data["pos"][idx,it,:] = model.pos
+        if self.record == "full":
+            self.data["vel"][idx,it,:] = model.vel
+            self.data["acc"][idx,it,:] = model.acc
+            self.data["att"][idx,it,:] = model.att
+            self.data["att_q"][idx,it,:] = model.att_q
+            self.data["acc_raw"][idx,it,:] = model.acc_raw
+            self.data["gyro_raw"][idx,it,:] = model.gyro_raw
+            self.data["acc_lpf"][idx,it,:] = model.acc
+            self.data["gyro_lpf"][idx,it,:] = model.angV
+            self.data["ms"][idx,it,:] = model.ms
+            self.data["ms_c"][idx,it,:] = ms_c
+        return
+
+    def set_error(self, idx, pos_err, yaw_err):
+        """Tracking errors of row idx (index tuple for batched records), yaw_err in radians"""
+        if self.pos_err is not None:
+            self.pos_err[idx] = pos_err
+            self.yaw_err[idx] = yaw_err
+        idx_vehicle = idx[:-1] if isinstance(idx, tuple) else ()
+        self.pos_err_max[idx_vehicle] = np.fmax(self.pos_err_max[idx_vehicle], pos_err)
+        self.yaw_err_max[idx_vehicle] = np.fmax(self.yaw_err_max[idx_vehicle], yaw_err)
+        return
+
+    def get_buffers(self, idx_st, idx_end, idx_ref_end):
+        """Row views of the ticks idx_st:idx_end for the native rollout"""
+        buffers = dict()
+        if self.data is not None:
+            for name in self.data.dtype.names:
+                if name != "time":
+                    buffers[name] = self.data[name][idx_st:idx_end]
+        if self.pos_err is not None:
+            buffers["pos_err"] = self.pos_err[idx_st:idx_ref_end]
+            buffers["yaw_err"] = self.yaw_err[idx_st:idx_ref_end]
+        return buffers
+
+    def get_debug_value(self, m=None, N_m=None):
+        """Traces of the debug dict (views into the record), vehicle m up to N_m for batched records"""
+        debug_value = dict()
+        if self.data is not None:
+            for name in self.data.dtype.names:
+                if m is None:
+                    debug_value[name] = self.data[name]
+                else:
+                    debug_value[name] = self.data[name][m,:N_m]
+        if self.pos_err is not None:
+            if m is None:
+                debug_value["pos_err"] = self.pos_err
+                debug_value["yaw_err"] = self.yaw_err
+            else:
+                debug_value["pos_err"] = self.pos_err[m,:N_m]
+                debug_value["yaw_err"] = self.yaw_err[m,:N_m]
+        if m is None:
+            debug_value["pos_err_max"] = np.float64(self.pos_err_max)
+            debug_value["yaw_err_max"] = np.float64(self.yaw_err_max)
+        else:
+            debug_value["pos_err_max"] = self.pos_err_max[m]
+            debug_value["yaw_err_max"] = self.yaw_err_max[m]
+        return debug_value
+
+
+def get_trial_seed(seed, trial):
+    # Stream of flight #trial, the same for every trajectory so candidates share their noise
+    return np.random.SeedSequence([seed, trial])
+
+
 class TrajectorySimulation(BaseTrajFunc):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -24,109 +188,88 @@ class TrajectorySimulation(BaseTrajFunc):
         self.env = simulation_env()
         self.controller = UAV_pid_tracking()
         self.vehicle_id = "uav1"
+        self.model_batch = None
 
         return
     
+    def is_noise_free(self):
+        """True if the simulator config has no process or IMU noise, see check_noise_free"""
+        return self.env.vehicle_set[self.vehicle_id]["model"].flag_noise_free
+    
+    def get_N_flight(self, N_trial):
+        # Repeated flights of a noise-free simulator are identical, only the first one is flown
+        if self.is_noise_free():
+            return min(N_trial, 1)
+        return N_trial
+    
+    def reset_flight(self, trial, seed=None):
+        # Every flight starts from the same model, clock and integrator state
+        self.env.vehicle_set[self.vehicle_id]["model"].initialize_state()
+        self.controller.reset_state()
+        if seed is not None:
+            self.env.vehicle_set[self.vehicle_id]["model"].manual_seed(get_trial_seed(seed, trial))
+        return
+    
     def simulation_core(self, status_ref, N_trial = 1,
                        max_pos_err=5.0, min_pos_err=0.5, 
                        max_yaw_err=15.0, min_yaw_err=5.0, 
-                       freq_ctrl=200, traj_ref_path=None):
+                       freq_ctrl=200, traj_ref_path=None, record="full", seed=None, trial_offset=0):
+        """Fly status_ref (np array or StatusReference) N_trial times
+        
+        Each flight starts from a reset model and controller. With a noise-free simulator
+        the first flight is reused for the other trials.
+        record: traces kept in the debug dicts, see SimulationRecord. Only "full" keeps the
+            reference and the env logs, the lean modes step the vehicle model directly.
+        seed: flight #trial draws its noise from get_trial_seed(seed, trial_offset+trial), reproducible if given
+        trial_offset: trial number of the first flight, to fly the trials of a seed one call at a time
+        """
+        if not isinstance(status_ref, StatusReference):
+            status_ref = StatusReference.from_array(status_ref)
+        
         # Convert to cos value
         max_yaw_err = np.cos(max_yaw_err*np.pi/180.0)
         min_yaw_err = np.cos(min_yaw_err*np.pi/180.0)
         
         max_time = 100
-        dt_micro_ctrl = np.int(1e6/freq_ctrl)
-        N = min(status_ref.shape[0], max_time*freq_ctrl)
+        N = min(status_ref.N, max_time*freq_ctrl)
+        model = self.env.vehicle_set[self.vehicle_id]["model"]
+        flag_log = (record == "full")
+        N_flight = self.get_N_flight(N_trial)
 
         debug_array = [dict() for i in range(N_trial)]
 
-        for trial in range(N_trial):
+        for trial in range(N_flight):
             print("Flight #{}".format(trial))
             pos_err = 0
             
-            traj_ref = status_ref[0,:]
+            self.reset_flight(trial_offset+trial, seed)
+            traj_ref = status_ref.row(0)
             self.env.set_state_vehicle(
                 self.vehicle_id, 
-                position=status_ref[0,2:5], 
-                velocity=status_ref[0,5:8],
-                attitude_euler_angle=np.array([0,0,status_ref[0,17]]))
-            state_t = self.env.get_state(self.vehicle_id)
-
-            pos = state_t["position"]
-            vel = state_t["velocity"]
-            acc = state_t["acceleration"]
-            att_q = state_t["attitude"]
-            att = state_t["attitude_euler_angle"]
-
-            angV = state_t["angular_velocity"]
-            angA = state_t["angular_acceleration"]
-            ms = state_t["motor_speed"]
-            ma = state_t["motor_acceleration"]
-
-            raw_acc = state_t["acceleration_raw"]
-            raw_gyro = state_t["gyroscope_raw"]
-            raw_ms = state_t["motor_speed_raw"]
-
-            pos_array = np.zeros((N,3))
-            vel_array = np.zeros((N,3))
-            acc_array = np.zeros((N,3))
-            att_array = np.zeros((N,3))
-            att_q_array = np.zeros((N,4))
-            raw_acc_array = np.zeros((N,3))
-            raw_gyro_array = np.zeros((N,3))
-            filtered_acc_array = np.zeros((N,3))
-            filtered_gyro_array = np.zeros((N,3))
-            ms_array = np.zeros((N,4))
-            ms_c_array = np.zeros((N,4))
-            time_array = np.zeros(N)
-            pos_err_array = np.zeros(N)
-            yaw_err_array = np.zeros(N)
+                position=traj_ref[2:5], 
+                velocity=traj_ref[5:8],
+                attitude_euler_angle=np.array([0,0,traj_ref[17]]))
+
+            rec = SimulationRecord(N, record=record)
             failure_idx = -1
             failure_start_idx = -1
             failure_end_idx = -1
 
             for it in range(N):
-                curr_time = np.int(1.0*(it+1)/freq_ctrl*1e6)
-
-                traj_ref = status_ref[it,2:]
-                ms_c = self.controller.control_update(traj_ref, pos, vel, acc, att, angV, angA, 1.0/freq_ctrl)
-                self.env.proceed_motor_speed(self.vehicle_id, ms_c, 1.0/freq_ctrl)
-
-                state_t = self.env.get_state(self.vehicle_id)
-
-                pos = state_t["position"]
-                vel = state_t["velocity"]
-                acc = state_t["acceleration"]
-                att_q = state_t["attitude"]
-                att = state_t["attitude_euler_angle"]
-                angV = state_t["angular_velocity"]
-                angA = state_t["angular_acceleration"]
-                ms = state_t["motor_speed"]
-                ma = state_t["motor_acceleration"]
-
-                raw_acc = state_t["acceleration_raw"]
-                raw_gyro = state_t["gyroscope_raw"]
-                raw_ms = state_t["motor_speed"]
-
-                time_array[it] = 1.0*(it+1)/freq_ctrl
-                pos_array[it,:] = pos
-                vel_array[it,:] = vel
-                acc_array[it,:] = acc
-                att_array[it,:] = att
-                att_q_array[it,:] = att_q
-                raw_acc_array[it,:] = raw_acc
-                raw_gyro_array[it,:] = raw_gyro
-                filtered_acc_array[it,:] = acc
-                filtered_gyro_array[it,:] = angV
-                ms_array[it,:] = ms
-                ms_c_array[it,:] = ms_c
+                traj_ref = status_ref.row(it)[2:]
+                ms_c = self.controller.control_update(traj_ref, model.pos, model.vel, model.acc, model.att, \
+                                                      model.angV, model.angA, 1.0/freq_ctrl)
+                if flag_log:
+                    self.env.proceed_motor_speed(self.vehicle_id, ms_c, 1.0/freq_ctrl)
+                else:
+                    model.proceed_motor_speed(ms_c, 1.0/freq_ctrl)
+                rec.set_row(it, model, ms_c, freq_ctrl)
                 
                 if it < N-1:
-                    pos_err = np.linalg.norm(status_ref[it+1,2:5]-pos)
-                    yaw_err = max(np.cos(status_ref[it+1,17]-att[2]), np.cos(np.pi-status_ref[it+1,17]+att[2]))
-                    pos_err_array[it+1] = pos_err
-                    yaw_err_array[it+1] = np.arccos(yaw_err)
+                    traj_ref_next = status_ref.row(it+1)
+                    pos_err = np.linalg.norm(traj_ref_next[2:5]-model.pos)
+                    yaw_err = max(np.cos(traj_ref_next[17]-model.att[2]), np.cos(np.pi-traj_ref_next[17]+model.att[2]))
+                    rec.set_error(it+1, pos_err, np.arccos(yaw_err))
                 
                 if (pos_err > min_pos_err or yaw_err < min_yaw_err) and failure_start_idx == -1:
                     failure_start_idx = it
@@ -135,37 +278,110 @@ class TrajectorySimulation(BaseTrajFunc):
                     failure_start_idx = -1
 
                 if pos_err > max_pos_err or yaw_err < max_yaw_err:
-                    print("Failed. Progress: {}%, Ref total time: {}".format(100.0*it/N, status_ref[-1,0]))
+                    print("Failed. Progress: {}%, Ref total time: {}".format(100.0*it/N, status_ref.get_total_time()))
                     failure_idx = it
                     break
             
-            debug_array[trial]["ref"] = status_ref
-            debug_array[trial]["time"] = time_array
-            debug_array[trial]["pos"] = pos_array
-            debug_array[trial]["vel"] = vel_array
-            debug_array[trial]["acc"] = acc_array
-            debug_array[trial]["att"] = att_array
-            debug_array[trial]["att_q"] = att_q_array
-            debug_array[trial]["acc_raw"] = raw_acc_array
-            debug_array[trial]["acc_lpf"] = filtered_acc_array
-            debug_array[trial]["gyro_raw"] = raw_gyro_array
-            debug_array[trial]["gyro_lpf"] = filtered_gyro_array
-            debug_array[trial]["ms"] = ms_array
-            debug_array[trial]["ms_c"] = ms_c_array
+            debug_array[trial] = rec.get_debug_value()
+            if flag_log:
+                debug_array[trial]["ref"] = status_ref.get_array()
             debug_array[trial]["failure_idx"] = failure_idx
             debug_array[trial]["failure_start_idx"] = failure_start_idx
             debug_array[trial]["failure_end_idx"] = failure_end_idx
-            debug_array[trial]["pos_err"] = pos_err_array
-            debug_array[trial]["yaw_err"] = yaw_err_array
             
             if pos_err < max_pos_err and yaw_err > max_yaw_err:
                 if traj_ref_path is not None:
-                    print("Succeeded. Total time: {}.\n - Traj path: {}".format(time_array[-1], traj_ref_path))
+                    print("Succeeded. Total time: {}.\n - Traj path: {}".format(1.0*N/freq_ctrl, traj_ref_path))
                 else:
-                    print("Succeeded. Total time: {}.".format(time_array[-1]))        
+                    print("Succeeded. Total time: {}.".format(1.0*N/freq_ctrl))        
             print("Position error: {}/{}, Yaw error: {}/{}". \
-                  format(str(round(max(pos_err_array),2)),max_pos_err, \
-                         str(round(max(yaw_err_array),2)),str(round(np.arccos(max_yaw_err),2))))
+                  format(str(round(float(rec.pos_err_max),2)),max_pos_err, \
+                         str(round(float(rec.yaw_err_max),2)),str(round(np.arccos(max_yaw_err),2))))
+        for trial in range(N_flight, N_trial):
+            debug_array[trial] = dict(debug_array[0])
+        return debug_array
+
+    def simulation_core_native(self, status_ref, N_trial = 1,
+                               max_pos_err=5.0, min_pos_err=0.5,
+                               max_yaw_err=15.0, min_yaw_err=5.0,
+                               freq_ctrl=200, traj_ref_path=None, record="full", seed=None, trial_offset=0):
+        """simulation_core with the control loop run by the native rollout of the pybind module
+
+        The reference is handed over chunk by chunk (status_ref.chunk_size rows), the traces are
+        written by the binding into the SimulationRecord. simulation_core stays the reference implementation.
+        """
+        if not isinstance(status_ref, StatusReference):
+            status_ref = StatusReference.from_array(status_ref)
+
+        # Convert to cos value
+        max_yaw_err = np.cos(max_yaw_err*np.pi/180.0)
+        min_yaw_err = np.cos(min_yaw_err*np.pi/180.0)
+        abort_thresholds = dict(max_pos_err=max_pos_err, min_pos_err=min_pos_err,
+                                max_yaw_err=max_yaw_err, min_yaw_err=min_yaw_err)
+
+        max_time = 100
+        N = min(status_ref.N, max_time*freq_ctrl)
+        N_flight = self.get_N_flight(N_trial)
+
+        debug_array = [dict() for i in range(N_trial)]
+
+        for trial in range(N_flight):
+            print("Flight #{}".format(trial))
+            self.reset_flight(trial_offset+trial, seed)
+            traj_ref = status_ref.row(0)
+            self.env.set_state_vehicle(
+                self.vehicle_id,
+                position=traj_ref[2:5],
+                velocity=traj_ref[5:8],
+                attitude_euler_angle=np.array([0,0,traj_ref[17]]))
+
+            rec = SimulationRecord(N, record=record)
+            failure_idx = -1
+            failure_end_idx = -1
+            monitor = dict(pos_err=0., yaw_err=1., pos_err_max=0., yaw_err_max=0., failure_start_idx=-1, idx_offset=0)
+            controller_gains = self.controller.get_rollout_gains()
+
+            idx_st = 0
+            while idx_st < N:
+                idx_end = min(idx_st+status_ref.chunk_size, N)
+                # One row of lookahead for the tracking errors of the last step
+                idx_ref_end = min(idx_end+1, N)
+                status_ref.fill(idx_ref_end-1)
+                monitor["idx_offset"] = idx_st
+                N_run, failure_idx_t = self.env.rollout_tracking(
+                    self.vehicle_id, status_ref.status[idx_st:idx_ref_end,2:], controller_gains,
+                    freq_ctrl, abort_thresholds, rec.get_buffers(idx_st, idx_end, idx_ref_end), monitor,
+                    N_step=idx_end-idx_st)
+                if rec.data is not None:
+                    rec.data["time"][idx_st:idx_st+N_run] = 1.0*np.arange(idx_st+1,idx_st+N_run+1)/freq_ctrl
+                if failure_idx_t != -1:
+                    failure_idx = idx_st+failure_idx_t
+                    print("Failed. Progress: {}%, Ref total time: {}".format(100.0*failure_idx/N, status_ref.get_total_time()))
+                    break
+                idx_st = idx_end
+            self.controller.set_rollout_state(controller_gains)
+            pos_err = monitor["pos_err"]
+            yaw_err = monitor["yaw_err"]
+            rec.pos_err_max[()] = monitor["pos_err_max"]
+            rec.yaw_err_max[()] = monitor["yaw_err_max"]
+
+            debug_array[trial] = rec.get_debug_value()
+            if record == "full":
+                debug_array[trial]["ref"] = status_ref.get_array()
+            debug_array[trial]["failure_idx"] = failure_idx
+            debug_array[trial]["failure_start_idx"] = monitor["failure_start_idx"]
+            debug_array[trial]["failure_end_idx"] = failure_end_idx
+
+            if pos_err < max_pos_err and yaw_err > max_yaw_err:
+                if traj_ref_path is not None:
+                    print("Succeeded. Total time: {}.\n - Traj path: {}".format(1.0*N/freq_ctrl, traj_ref_path))
+                else:
+                    print("Succeeded. Total time: {}.".format(1.0*N/freq_ctrl))
+            print("Position error: {}/{}, Yaw error: {}/{}". \
+                  format(str(round(float(rec.pos_err_max),2)),max_pos_err, \
+                         str(round(float(rec.yaw_err_max),2)),str(round(np.arccos(max_yaw_err),2))))
+        for trial in range(N_flight, N_trial):
+            debug_array[trial] = dict(debug_array[0])
         return debug_array
 
     def run_simulation(self, traj_ref_path='trajectory/test.csv', N_trial=1, 
@@ -185,69 +401,181 @@ class TrajectorySimulation(BaseTrajFunc):
     def run_simulation_from_der(self, t_set, d_ordered, d_ordered_yaw=None,
                        N_trial=1, max_pos_err=5.0, min_pos_err=0.5, 
                        max_yaw_err=15.0, min_yaw_err=5.0, 
-                       freq_ctrl=200):
-    
-        flag_loop = self.check_flag_loop(t_set,d_ordered)
-                
+                       freq_ctrl=200, ref_chunk_size=None, flag_native=False, record="full", seed=None, \
+                       trial_offset=0):
+        """Simulate the trajectory, the reference is generated chunk by chunk while flying
+        
+        ref_chunk_size: number of control ticks evaluated at once, freq_ctrl (1s) by default
+        flag_native: fly with simulation_core_native instead of simulation_core
+        record: traces kept in the debug dicts, see SimulationRecord
+        seed, trial_offset: per-flight noise streams, see simulation_core
+        """
         dt = 1./freq_ctrl
         total_time = np.sum(t_set)
-        cum_time = np.zeros(t_set.shape[0]+1)
-        cum_time[1:] = np.cumsum(t_set)
-        cum_time[0] = 0
         
         N = np.int(np.floor(total_time/dt))
-        poly_idx = 0
         
         t_array = total_time*np.array(range(N))/N
-        status_ref = np.zeros((N,20))
-        status_ref[:,0] = t_array
-        status_ref[:,1] = 1
+        if ref_chunk_size is None:
+            ref_chunk_size = freq_ctrl
+        traj = self.get_piecewise_trajectory(t_set, d_ordered, d_ordered_yaw)
+        status_ref = StatusReference(t_array, traj=traj, chunk_size=ref_chunk_size)
         
-        T2_mat = np.diag(self.generate_basis(t_set[poly_idx],self.N_DER-1,0))
-        der0 = T2_mat.dot(d_ordered[poly_idx*self.N_DER:(poly_idx+1)*self.N_DER,:])
-        der1 = T2_mat.dot(d_ordered[(poly_idx+1)*self.N_DER:(poly_idx+2)*self.N_DER,:])
-                
-        if np.all(d_ordered_yaw != None):
-            T2_mat_yaw = np.diag(self.generate_basis(t_set[poly_idx],self.N_DER_YAW-1,0))
-            der0_yaw = T2_mat_yaw.dot(d_ordered_yaw[poly_idx*self.N_DER_YAW:(poly_idx+1)*self.N_DER_YAW,:])
-            der1_yaw = T2_mat_yaw.dot(d_ordered_yaw[(poly_idx+1)*self.N_DER_YAW:(poly_idx+2)*self.N_DER_YAW,:])
-        
-        for i in range(N):
-            if t_array[i] > cum_time[poly_idx+1]:
-                poly_idx += 1
-                T2_mat = np.diag(self.generate_basis(t_set[poly_idx],self.N_DER-1,0))
-                der0 = T2_mat.dot(d_ordered[poly_idx*self.N_DER:(poly_idx+1)*self.N_DER,:])
-                if flag_loop:
-                    poly_idx_next = (poly_idx+1)%(t_set.shape[0])
-                else:
-                    poly_idx_next = poly_idx+1
-                
-                der1 = T2_mat.dot(d_ordered[poly_idx_next*self.N_DER:(poly_idx_next+1)*self.N_DER,:])
-                if np.all(d_ordered_yaw != None):
-                    T2_mat_yaw = np.diag(self.generate_basis(t_set[poly_idx],self.N_DER_YAW-1,0))
-                    der0_yaw = T2_mat_yaw.dot(d_ordered_yaw[poly_idx*self.N_DER_YAW:(poly_idx+1)*self.N_DER_YAW,:])
-                    der1_yaw = T2_mat_yaw.dot(d_ordered_yaw[poly_idx_next*self.N_DER_YAW:(poly_idx_next+1)*self.N_DER_YAW,:])
-            
-            t_step = (t_array[i] - cum_time[poly_idx])/t_set[poly_idx]
-            
-            for der in range(5):
-                v0, v1 = self.generate_single_point_matrix(t_step, der=der)
-                status_ref[i,2+3*der:2+3*(der+1)] = (v0.dot(der0)+v1.dot(der1))/(t_set[poly_idx]**der)
-            
-            if np.all(d_ordered_yaw != None):
-                status_yaw_xy = np.zeros((1,3,2))
-                for der in range(3):
-                    v0, v1 = self.generate_single_point_matrix_yaw(t_step, der=der)
-                    status_yaw_xy[:,der,:] = (v0.dot(der0_yaw)+v1.dot(der1_yaw))/(t_set[poly_idx]**der)
-                status_ref[i,17:] = self.get_yaw_der(status_yaw_xy)[0,:]
-        
-        debug_array = self.simulation_core(status_ref, N_trial=N_trial, 
+        if flag_native:
+            simulation_core = self.simulation_core_native
+        else:
+            simulation_core = self.simulation_core
+        debug_array = simulation_core(status_ref, N_trial=N_trial, 
                                            max_pos_err=max_pos_err, min_pos_err=min_pos_err, 
                                            max_yaw_err=max_yaw_err, min_yaw_err=min_yaw_err, 
-                                           freq_ctrl=freq_ctrl)
+                                           freq_ctrl=freq_ctrl, record=record, seed=seed, trial_offset=trial_offset)
         
         return debug_array
 
+    def get_model_batch(self, N_vehicle):
+        if self.model_batch is None:
+            self.model_batch = MulticopterBatchModel(
+                N_vehicle=N_vehicle,
+                imu_freq=self.env.vehicle_set[self.vehicle_id]["model"].imu_freq)
+        else:
+            self.model_batch.initialize_state(N_vehicle)
+        return self.model_batch
+
+    def simulation_core_batch(self, status_refs, N_trial=1,
+                              max_pos_err=5.0, min_pos_err=0.5, 
+                              max_yaw_err=15.0, min_yaw_err=5.0, 
+                              freq_ctrl=200, record="full", seed=None):
+        """Fly every status_ref N_trial times in lockstep on MulticopterBatchModel
+        
+        status_refs: list of np array or StatusReference, references may differ in length.
+            Failed and finished flights are dropped from the batch. With a noise-free simulator
+            each status_ref is flown once and the flight is reused for the other trials.
+        record: traces kept in the debug dicts, see SimulationRecord
+        seed: flight #trial of every status_ref draws its noise from get_trial_seed(seed, trial)
+        Returns:
+            debug_arrays: list of the simulation_core output (N_trial debug dicts) per status_ref
+        """
+        status_refs = [ref if isinstance(ref, StatusReference) else StatusReference.from_array(ref) \
+                       for ref in status_refs]
+        max_yaw_err = np.cos(max_yaw_err*np.pi/180.0)
+        min_yaw_err = np.cos(min_yaw_err*np.pi/180.0)
+        
+        max_time = 100
+        dt = 1.0/freq_ctrl
+        N_ref = len(status_refs)
+        N_flight = self.get_N_flight(N_trial)
+        M = N_ref*N_flight
+        ref_idx = np.repeat(np.arange(N_ref), N_flight)
+        N_set = np.array([min(ref.N, max_time*freq_ctrl) for ref in status_refs])[ref_idx]
+        N = np.max(N_set)
+
+        # Rolling window of the reference rows win_st ... win_st+N_win of every status_ref,
+        # moved forward while flying so only the flown part of the references is evaluated
+        N_win = freq_ctrl
+        ref_win = np.zeros((N_ref,N_win+1,18))
+        def fill_ref_win(win_st, idx_active):
+            for r in np.unique(ref_idx[idx_active]):
+                ref = status_refs[r]
+                N_r = min(win_st+N_win+1, ref.N)
+                ref.fill(N_r-1)
+                ref_win[r,:N_r-win_st,:] = ref.status[win_st:N_r,2:]
+                ref_win[r,N_r-win_st:,:] = ref.status[ref.N-1,2:]
+            return win_st
+
+        rec = SimulationRecord(N, record=record, N_vehicle=M)
+        failure_idx = -np.ones(M, dtype=np.int)
+        failure_start_idx = -np.ones(M, dtype=np.int)
+        pos_err = np.zeros(M)
+        yaw_err = np.ones(M)
+
+        idx_active = np.arange(M)
+        win_st = fill_ref_win(0, idx_active)
+        model = self.get_model_batch(M)
+        if seed is not None:
+            model.manual_seed([get_trial_seed(seed, trial) for trial in np.tile(np.arange(N_flight), N_ref)])
+        controller = UAV_pid_tracking_batch(N_vehicle=M)
+        traj_ref = ref_win[ref_idx,0,:]
+        att_init = np.zeros((M,3))
+        att_init[:,2] = traj_ref[:,15]
+        model.set_state(position=traj_ref[:,0:3], velocity=traj_ref[:,3:6], attitude_euler_angle=att_init)
+
+        for it in range(N):
+            if it+1 > win_st+N_win:
+                win_st = fill_ref_win(it, idx_active)
+            traj_ref = ref_win[ref_idx[idx_active],it-win_st,:]
+            ms_c = controller.control_update(traj_ref, model.pos, model.vel, model.acc, model.att, \
+                                             model.angV, model.angA, dt)
+            model.proceed_motor_speed(ms_c, dt)
+
+            rec.set_rows(idx_active, it, model, ms_c, freq_ctrl)
+
+            # Errors against the next reference row, kept on the last row as in simulation_core
+            flag_next = it < N_set[idx_active]-1
+            idx_next = idx_active[flag_next]
+            if idx_next.shape[0] > 0:
+                traj_ref_next = ref_win[ref_idx[idx_next],it+1-win_st,:]
+                att_next = model.att[flag_next,2]
+                pos_err[idx_next] = np.linalg.norm(traj_ref_next[:,0:3]-model.pos[flag_next,:], axis=1)
+                yaw_err[idx_next] = np.maximum(np.cos(traj_ref_next[:,15]-att_next), \
+                                               np.cos(np.pi-traj_ref_next[:,15]+att_next))
+                rec.set_error((idx_next,it+1), pos_err[idx_next], np.arccos(np.clip(yaw_err[idx_next], -1., 1.)))
+
+            pos_err_t = pos_err[idx_active]
+            yaw_err_t = yaw_err[idx_active]
+            flag_start = (pos_err_t > min_pos_err) | (yaw_err_t < min_yaw_err)
+            failure_start_idx[idx_active[flag_start & (failure_start_idx[idx_active] == -1)]] = it
+            failure_start_idx[idx_active[(pos_err_t < min_pos_err) & (yaw_err_t > min_yaw_err)]] = -1
+
+            flag_fail = (pos_err_t > max_pos_err) | (yaw_err_t < max_yaw_err)
+            failure_idx[idx_active[flag_fail]] = it
+            flag_keep = ~flag_fail & (it+1 < N_set[idx_active])
+            if not np.all(flag_keep):
+                idx_active = idx_active[flag_keep]
+                model.select(flag_keep)
+                controller.select(flag_keep)
+            if idx_active.shape[0] == 0:
+                break
+
+        print("Batch flights: {}, failed: {}".format(M, np.sum(failure_idx != -1)))
+        debug_arrays = [[] for r in range(N_ref)]
+        for m in range(M):
+            N_m = N_set[m]
+            debug_value = rec.get_debug_value(m, N_m)
+            if record == "full":
+                debug_value["ref"] = status_refs[ref_idx[m]].get_array()
+            debug_value["failure_idx"] = np.int(failure_idx[m])
+            debug_value["failure_start_idx"] = np.int(failure_start_idx[m])
+            debug_value["failure_end_idx"] = -1
+            debug_arrays[ref_idx[m]].append(debug_value)
+        for debug_array in debug_arrays:
+            for trial in range(N_flight, N_trial):
+                debug_array.append(dict(debug_array[0]))
+        return debug_arrays
+
+    def run_simulation_from_der_batch(self, t_sets, d_ordereds, d_ordereds_yaw=None,
+                                      N_trial=1, max_pos_err=5.0, min_pos_err=0.5, 
+                                      max_yaw_err=15.0, min_yaw_err=5.0, 
+                                      freq_ctrl=200, ref_chunk_size=None, record="full", seed=None):
+        """run_simulation_from_der for a list of trajectories flown together by simulation_core_batch"""
+        if ref_chunk_size is None:
+            ref_chunk_size = freq_ctrl
+        if d_ordereds_yaw is None:
+            d_ordereds_yaw = [None for t_set in t_sets]
+        
+        dt = 1./freq_ctrl
+        status_refs = []
+        for t_set, d_ordered, d_ordered_yaw in zip(t_sets, d_ordereds, d_ordereds_yaw):
+            total_time = np.sum(t_set)
+            N = np.int(np.floor(total_time/dt))
+            t_array = total_time*np.array(range(N))/N
+            traj = self.get_piecewise_trajectory(t_set, d_ordered, d_ordered_yaw)
+            status_refs.append(StatusReference(t_array, traj=traj, chunk_size=ref_chunk_size))
+        
+        return self.simulation_core_batch(status_refs, N_trial=N_trial, 
+                                          max_pos_err=max_pos_err, min_pos_err=min_pos_err, 
+                                          max_yaw_err=max_yaw_err, min_yaw_err=min_yaw_err, 
+                                          freq_ctrl=freq_ctrl, record=record, seed=seed)
+
     def plot_result(self, debug_value, save_dir="trajectory/result", 
                     flag_save=False, save_idx="0", t_set=None, d_ordered=None):
         if flag_save and (not os.path.exists(save_dir)):
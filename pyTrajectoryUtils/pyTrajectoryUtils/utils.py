@@ -7,6 +7,7 @@ import numpy as np
 import pandas as pd
 from scipy.special import factorial
 from scipy.special import comb, perm
+from scipy import sparse
 from multiprocessing import Pipe, Process
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -38,6 +39,17 @@ def parmap(f,X):
     return [p.recv() for (p,c) in pipe]
 
 
+def yaw_xy_to_der(yaw_xy):
+    """yaw, dyaw, ddyaw (..., 3) from the (cos, sin) yaw derivatives yaw_xy (..., 3, 2)"""
+    yaw_xy = np.asarray(yaw_xy)
+    norm_sq = yaw_xy[...,0,0]**2+yaw_xy[...,0,1]**2
+    yaw_ret = np.empty(yaw_xy.shape[:-2]+(3,))
+    yaw_ret[...,0] = np.arctan2(yaw_xy[...,0,1],yaw_xy[...,0,0])
+    yaw_ret[...,1] = (-yaw_xy[...,0,1]*yaw_xy[...,1,0]+yaw_xy[...,0,0]*yaw_xy[...,1,1])/norm_sq
+    yaw_ret[...,2] = (-yaw_xy[...,0,1]*yaw_xy[...,2,0]+yaw_xy[...,0,0]*yaw_xy[...,2,1])/norm_sq \
+        -2*(yaw_xy[...,0,0]*yaw_xy[...,1,0]+yaw_xy[...,0,1]*yaw_xy[...,1,1])/norm_sq*yaw_ret[...,1]
+    return yaw_ret
+
 def unwrap(ang):
     return (ang+np.pi)%(2*np.pi)-np.pi
 
@@ -133,6 +145,77 @@ def Euler2quat(att):
     
     return q
 
+# Batched variants of the quaternion helpers above, over the leading axes of (...,4) / (...,3) arrays
+def mul_quat_batch(quat1, quat0):
+    w0, x0, y0, z0 = quat0[...,0], quat0[...,1], quat0[...,2], quat0[...,3]
+    w1, x1, y1, z1 = quat1[...,0], quat1[...,1], quat1[...,2], quat1[...,3]
+    out = np.empty(np.broadcast(w0, w1).shape+(4,))
+    out[...,0] = -x1 * x0 - y1 * y0 - z1 * z0 + w1 * w0
+    out[...,1] = x1 * w0 + y1 * z0 - z1 * y0 + w1 * x0
+    out[...,2] = -x1 * z0 + y1 * w0 + z1 * x0 + w1 * y0
+    out[...,3] = x1 * y0 - y1 * x0 + z1 * w0 + w1 * z0
+    return out
+
+def inv_quat_batch(q):
+    return q*np.array([1.,-1.,-1.,-1.])/(q**2).sum(axis=-1)[...,np.newaxis]
+
+def vecvec2quat_batch(vec1, vec2):
+    vec1, vec2 = np.broadcast_arrays(vec1, vec2)
+    quat = np.empty(vec1.shape[:-1]+(4,))
+    quat[...,0] = np.sqrt((vec1**2).sum(axis=-1)*(vec2**2).sum(axis=-1)) + (vec1*vec2).sum(axis=-1)
+    quat[...,1] = vec1[...,1]*vec2[...,2] - vec1[...,2]*vec2[...,1]
+    quat[...,2] = vec1[...,2]*vec2[...,0] - vec1[...,0]*vec2[...,2]
+    quat[...,3] = vec1[...,0]*vec2[...,1] - vec1[...,1]*vec2[...,0]
+
+    # Opposite vectors, any axis orthogonal to vec1
+    idx_opp = quat[...,0] < 1e-6
+    if np.any(idx_opp):
+        vec1_opp = vec1[idx_opp]
+        quat_opp = np.zeros((vec1_opp.shape[0],4))
+        flag_x = np.abs(vec1_opp[:,0]) > np.abs(vec1_opp[:,2])
+        quat_opp[:,1] = np.where(flag_x, -vec1_opp[:,1], 0.)
+        quat_opp[:,2] = np.where(flag_x, vec1_opp[:,0], -vec1_opp[:,2])
+        quat_opp[:,3] = np.where(flag_x, 0., vec1_opp[:,1])
+        quat[idx_opp] = quat_opp
+    return quat/np.sqrt((quat**2).sum(axis=-1))[...,np.newaxis]
+
+def quat_rotate_batch(quat, vec):
+    # Same expression as quat_rotate
+    q0, q1, q2, q3 = quat[...,0], quat[...,1], quat[...,2], quat[...,3]
+    v0, v1, v2 = vec[...,0], vec[...,1], vec[...,2]
+    invNormSq = 1./(q0**2+q1**2+q2**2+q3**2)
+    out = np.empty(np.broadcast(q0, v0).shape+(3,))
+    out[...,0] = (v0*q0**2 - 2.*v2*q0*q2 + 2.*v1*q0*q3 +
+                  v0*q1**2 + 2.*v1*q1*q2 + 2.*v2*q1*q3 -
+                  v0*q2**2 - v0*q3**2)*invNormSq
+    out[...,1] = (v1*q0**2 + 2.*v2*q0*q1 - 2.*v0*q0*q3 -
+                  v1*q1**2 + 2.*v0*q1*q2 + v1*q2**2 +
+                  2.*v2*q2*q3 - v1*q3**2)*invNormSq
+    out[...,2] = (v2*q0**2 - 2.*v1*q0*q1 + 2.*v0*q0*q2 -
+                  v2*q1**2 + 2.*v0*q1*q3 - v2*q2 +
+                  2.*v1*q2*q3 + v2*q3**2)*invNormSq
+    return out
+
+def quat2Euler_batch(q):
+    q0, q1, q2, q3 = q[...,0], q[...,1], q[...,2], q[...,3]
+    att = np.empty(q.shape[:-1]+(3,))
+    att[...,0] = np.arctan2(2*(q0*q1+q2*q3), (1.-2.*(q1**2+q2**2)))
+    att[...,1] = np.arcsin(np.clip(2.*(q0*q2-q3*q1), -1., 1.))
+    att[...,2] = np.arctan2(2.*(q0*q3+q1*q2), (1.-2.*(q2**2+q3**2)))
+    return att
+
+def Euler2quat_batch(att):
+    c = np.cos(att/2)
+    s = np.sin(att/2)
+    cr, cp, cy = c[...,0], c[...,1], c[...,2]
+    sr, sp, sy = s[...,0], s[...,1], s[...,2]
+    q = np.empty(att.shape[:-1]+(4,))
+    q[...,0] = cy * cp * cr + sy * sp * sr
+    q[...,1] = sr * cp * cy - cr * sp * sy
+    q[...,2] = cr * sp * cy + sr * cp * sy
+    q[...,3] = cr * cp * sy - sr * sp * cy
+    return q
+
 # body->unity
 def ned2enu(pos, att):
     r_bias2 = R.from_euler('x', 180, degrees=True)
@@ -265,6 +348,14 @@ class BaseTrajFunc(object):
         self.v1_sanity_yaw_end = np.zeros((MAX_SYS_DEG_YAW+1, N_POINTS, MAX_POLY_DEG_YAW-MAX_SYS_DEG_YAW))
         for der in range(MAX_SYS_DEG_YAW+1):
             self.v0_sanity_yaw_end[der,:,:], self.v1_sanity_yaw_end[der,:,:] = self.generate_single_sampling_matrix_yaw(N=N_POINTS, der=der, endpoint=True)
+        
+        # Hessian blocks [[W0, W1], [W1.T, W2]] of the integral of squared der-th derivative
+        self.sum_block = np.zeros((MAX_SYS_DEG+1, 2*self.N_DER, 2*self.N_DER))
+        for der in range(MAX_SYS_DEG+1):
+            self.sum_block[der,:,:] = self.generate_sum_block(der=der)
+        self.sum_block_yaw = np.zeros((MAX_SYS_DEG_YAW+1, 2*self.N_DER_YAW, 2*self.N_DER_YAW))
+        for der in range(MAX_SYS_DEG_YAW+1):
+            self.sum_block_yaw[der,:,:] = self.generate_sum_block(der=der, flag_yaw=True)
             
     ###############################################################################
     def generate_basis(self, s, POLY_DEG=-1, der=0):
@@ -276,6 +367,78 @@ class BaseTrajFunc(object):
                 basis[i] = s**(i-der)*perm(i,der)
         return basis
     
+    def generate_time_scale(self, t_set, N_der, der=0):
+        """(N_POLY, N_der) tensor of t^k/t^der, the diagonal of generate_basis(t,N_der-1,0)/t^der per segment"""
+        t_set = np.array(t_set, dtype=np.float64)
+        return np.power(t_set[:,None], np.arange(N_der)[None,:]-der)
+    
+    def generate_sum_block(self, der=4, flag_yaw=False):
+        if flag_yaw:
+            m = self.MAX_POLY_DEG_YAW + 1
+            V = np.hstack([self.v0_mat_yaw[0,:,:].T, self.v1_mat_yaw[0,:,:].T])
+        else:
+            m = self.MAX_POLY_DEG + 1
+            V = np.hstack([self.v0_mat[0,:,:].T, self.v1_mat[0,:,:].T])
+        idx = np.arange(m)
+        perm_der = perm(idx, der)
+        denom = idx[:,None]+idx[None,:]+1-2*der
+        Q = np.zeros((m,m))
+        mask = (idx[:,None] >= der) & (idx[None,:] >= der)
+        Q[mask] = (np.outer(perm_der, perm_der)[mask])/denom[mask]
+        return V.T.dot(Q).dot(V)
+    
+    def get_sum_block(self, der=4, flag_yaw=False):
+        if flag_yaw:
+            if der <= self.MAX_SYS_DEG_YAW:
+                return self.sum_block_yaw[der,:,:]
+        elif der <= self.MAX_SYS_DEG:
+            return self.sum_block[der,:,:]
+        return self.generate_sum_block(der=der, flag_yaw=flag_yaw)
+    
+    def assemble_block_banded(self, blocks, N_block, N_der, flag_loop=False, flag_sparse=False):
+        """Sums the (2*N_der, 2*N_der) blocks of segment i onto the rows and columns of end points i and i+1
+
+        Args:
+            blocks: (N_POLY, 2*N_der, 2*N_der) np array
+            N_block: number of end points
+        Returns:
+            (N_block*N_der, N_block*N_der) np array or scipy.sparse csc_matrix if flag_sparse
+        """
+        N_POLY = blocks.shape[0]
+        seg_idx = np.arange(N_POLY)
+        if flag_loop:
+            seg_idx_n = (seg_idx+1)%N_block
+        else:
+            seg_idx_n = seg_idx+1
+        der_idx = np.arange(N_der)
+        idx = np.concatenate([seg_idx[:,None]*N_der+der_idx[None,:], \
+                              seg_idx_n[:,None]*N_der+der_idx[None,:]], axis=1)
+        row = np.broadcast_to(idx[:,:,None], blocks.shape)
+        col = np.broadcast_to(idx[:,None,:], blocks.shape)
+        N = N_block*N_der
+        if flag_sparse:
+            return sparse.csc_matrix((blocks.ravel(), (row.ravel(), col.ravel())), shape=(N,N))
+        Mat = np.zeros((N,N))
+        np.add.at(Mat, (row, col), blocks)
+        return Mat
+    
+    def assemble_sampling_matrix(self, v_blocks, N, N_der, N_col, flag_loop=False, flag_sparse=False):
+        """Places the (N, 2*N_der) sampling block of segment i on rows i*N and columns of end points i, i+1"""
+        N_POLY = v_blocks.shape[0]
+        seg_idx = np.arange(N_POLY)
+        der_idx = np.arange(N_der)
+        idx = np.concatenate([seg_idx[:,None]*N_der+der_idx[None,:], \
+                              (seg_idx[:,None]+1)*N_der+der_idx[None,:]], axis=1)
+        if flag_loop:
+            idx = idx%N_col
+        row = np.broadcast_to((seg_idx[:,None]*N+np.arange(N)[None,:])[:,:,None], v_blocks.shape)
+        col = np.broadcast_to(idx[:,None,:], v_blocks.shape)
+        if flag_sparse:
+            return sparse.csr_matrix((v_blocks.ravel(), (row.ravel(), col.ravel())), shape=(N*N_POLY,N_col))
+        V = np.zeros((N*N_POLY,N_col))
+        V[row, col] = v_blocks
+        return V
+    
     def generate_interpolation_matrix_coeff(self, m=-1, p=-1):
         if m == -1:
             m = self.MAX_POLY_DEG + 1
@@ -328,7 +491,7 @@ class BaseTrajFunc(object):
         
         return v0, v1
     
-    def generate_sampling_matrix(self, t_set, N=20, der=1, endpoint=False):
+    def generate_sampling_matrix(self, t_set, N=20, der=1, endpoint=False, flag_sparse=False):
         if N != self.N_POINTS or der > self.MAX_SYS_DEG:
             v0, v1 = self.generate_single_sampling_matrix(N=N, der=der, endpoint=False)
             if endpoint:
@@ -340,36 +503,24 @@ class BaseTrajFunc(object):
 
         N_POLY = t_set.shape[0]
         
-        V = np.zeros((N*N_POLY,self.N_DER*(N_POLY+1)))
-        for i in range(N_POLY):
-            T2_mat = np.diag(self.generate_basis(t_set[i],self.N_DER-1,0))/(t_set[i]**der)
-            if endpoint and i==(N_POLY-1):
-                V[i*N:(i+1)*N,i*self.N_DER:(i+1)*self.N_DER] = v0_end.dot(T2_mat)
-                V[i*N:(i+1)*N,(i+1)*self.N_DER:(i+2)*self.N_DER] = v1_end.dot(T2_mat)
-            else:
-                V[i*N:(i+1)*N,i*self.N_DER:(i+1)*self.N_DER] = v0.dot(T2_mat)
-                V[i*N:(i+1)*N,(i+1)*self.N_DER:(i+2)*self.N_DER] = v1.dot(T2_mat)
+        T2_mat = self.generate_time_scale(t_set, self.N_DER, der)[:,None,:]
+        v_blocks = np.concatenate([v0[None,:,:]*T2_mat, v1[None,:,:]*T2_mat], axis=2)
+        if endpoint:
+            v_blocks[-1,:,:] = np.hstack([v0_end, v1_end])*np.tile(T2_mat[-1,:,:], (1,2))
 
-        return V
+        return self.assemble_sampling_matrix(v_blocks, N, self.N_DER, self.N_DER*(N_POLY+1), flag_sparse=flag_sparse)
     
-    def generate_sampling_matrix_loop(self, t_set, N=20, der=1):
+    def generate_sampling_matrix_loop(self, t_set, N=20, der=1, flag_sparse=False):
         if N != self.N_POINTS or der > self.MAX_SYS_DEG:
             v0, v1 = self.generate_single_sampling_matrix(N=N, der=der, endpoint=False)
         else:
             v0, v1 = self.v0_sanity[der,:,:], self.v1_sanity[der,:,:]
         N_POLY = t_set.shape[0]-1
         
-        V = np.zeros((N*(N_POLY+1),self.N_DER*(N_POLY+1)))
-        for i in range(N_POLY):
-            T2_mat = np.diag(self.generate_basis(t_set[i],self.N_DER-1,0))/(t_set[i]**der)
-            V[i*N:(i+1)*N,i*self.N_DER:(i+1)*self.N_DER] = v0.dot(T2_mat)
-            V[i*N:(i+1)*N,(i+1)*self.N_DER:(i+2)*self.N_DER] = v1.dot(T2_mat)
-        
-        T2_mat = np.diag(self.generate_basis(t_set[N_POLY],self.N_DER-1,0))/(t_set[N_POLY]**der)
-        V[N_POLY*N:(N_POLY+1)*N,N_POLY*self.N_DER:(N_POLY+1)*self.N_DER] = v0.dot(T2_mat)
-        V[N_POLY*N:(N_POLY+1)*N,:self.N_DER] = v1.dot(T2_mat)
+        T2_mat = self.generate_time_scale(t_set, self.N_DER, der)[:,None,:]
+        v_blocks = np.concatenate([v0[None,:,:]*T2_mat, v1[None,:,:]*T2_mat], axis=2)
 
-        return V
+        return self.assemble_sampling_matrix(v_blocks, N, self.N_DER, self.N_DER*(N_POLY+1), flag_loop=True, flag_sparse=flag_sparse)
     
     def generate_single_point_matrix_yaw(self, x, der=1):
         m = self.MAX_POLY_DEG_YAW + 1
@@ -398,7 +549,7 @@ class BaseTrajFunc(object):
         
         return v0, v1
     
-    def generate_sampling_matrix_yaw(self, t_set, N=20, der=1, endpoint=False):
+    def generate_sampling_matrix_yaw(self, t_set, N=20, der=1, endpoint=False, flag_sparse=False):
         if N != self.N_POINTS or der > self.MAX_SYS_DEG_YAW:
             v0, v1 = self.generate_single_sampling_matrix_yaw(N=N, der=der, endpoint=False)
             if endpoint:
@@ -409,36 +560,24 @@ class BaseTrajFunc(object):
                 v0_end, v1_end = self.v0_sanity_yaw_end[der,:,:], self.v1_sanity_yaw_end[der,:,:]
         N_POLY = t_set.shape[0]
         
-        V = np.zeros((N*N_POLY,self.N_DER_YAW*(N_POLY+1)))
-        for i in range(N_POLY):
-            T2_mat = np.diag(self.generate_basis(t_set[i],self.N_DER_YAW-1,0))/(t_set[i]**der)
-            if endpoint and i==(N_POLY-1):
-                V[i*N:(i+1)*N,i*self.N_DER_YAW:(i+1)*self.N_DER_YAW] = v0_end.dot(T2_mat)
-                V[i*N:(i+1)*N,(i+1)*self.N_DER_YAW:(i+2)*self.N_DER_YAW] = v1_end.dot(T2_mat)
-            else:
-                V[i*N:(i+1)*N,i*self.N_DER_YAW:(i+1)*self.N_DER_YAW] = v0.dot(T2_mat)
-                V[i*N:(i+1)*N,(i+1)*self.N_DER_YAW:(i+2)*self.N_DER_YAW] = v1.dot(T2_mat)
+        T2_mat = self.generate_time_scale(t_set, self.N_DER_YAW, der)[:,None,:]
+        v_blocks = np.concatenate([v0[None,:,:]*T2_mat, v1[None,:,:]*T2_mat], axis=2)
+        if endpoint:
+            v_blocks[-1,:,:] = np.hstack([v0_end, v1_end])*np.tile(T2_mat[-1,:,:], (1,2))
 
-        return V
+        return self.assemble_sampling_matrix(v_blocks, N, self.N_DER_YAW, self.N_DER_YAW*(N_POLY+1), flag_sparse=flag_sparse)
     
-    def generate_sampling_matrix_loop_yaw(self, t_set, N=20, der=1):
+    def generate_sampling_matrix_loop_yaw(self, t_set, N=20, der=1, flag_sparse=False):
         if N != self.N_POINTS or der > self.MAX_SYS_DEG_YAW:
             v0, v1 = self.generate_single_sampling_matrix_yaw(N=N, der=der, endpoint=False)
         else:
             v0, v1 = self.v0_sanity_yaw[der,:,:], self.v1_sanity_yaw[der,:,:]
         N_POLY = t_set.shape[0]-1
         
-        V = np.zeros((N*(N_POLY+1),self.N_DER_YAW*(N_POLY+1)))
-        for i in range(N_POLY):
-            T2_mat = np.diag(self.generate_basis(t_set[i],self.N_DER_YAW-1,0))/(t_set[i]**der)
-            V[i*N:(i+1)*N,i*self.N_DER_YAW:(i+1)*self.N_DER_YAW] = v0.dot(T2_mat)
-            V[i*N:(i+1)*N,(i+1)*self.N_DER_YAW:(i+2)*self.N_DER_YAW] = v1.dot(T2_mat)
-        
-        T2_mat = np.diag(self.generate_basis(t_set[N_POLY],self.N_DER_YAW-1,0))/(t_set[N_POLY]**der)
-        V[N_POLY*N:(N_POLY+1)*N,N_POLY*self.N_DER_YAW:(N_POLY+1)*self.N_DER_YAW] = v0.dot(T2_mat)
-        V[N_POLY*N:(N_POLY+1)*N,:self.N_DER_YAW] = v1.dot(T2_mat)
+        T2_mat = self.generate_time_scale(t_set, self.N_DER_YAW, der)[:,None,:]
+        v_blocks = np.concatenate([v0[None,:,:]*T2_mat, v1[None,:,:]*T2_mat], axis=2)
 
-        return V
+        return self.assemble_sampling_matrix(v_blocks, N, self.N_DER_YAW, self.N_DER_YAW*(N_POLY+1), flag_loop=True, flag_sparse=flag_sparse)
     
     def generate_weight_matrix(self, t_set, N_POINTS):
         N_POLY = t_set.shape[0]
@@ -465,28 +604,12 @@ class BaseTrajFunc(object):
         return M_inv
     
     def get_yaw_der(self, yaw_xy):
-        yaw = np.arctan2(yaw_xy[:,0,1],yaw_xy[:,0,0])
-        dyaw = -np.multiply(yaw_xy[:,0,1],yaw_xy[:,1,0]) \
-                +np.multiply(yaw_xy[:,0,0],yaw_xy[:,1,1])
-        
-        for j in range(dyaw.shape[0]):
-            dyaw[j] /= np.linalg.norm(yaw_xy[j,0,:])**2
-
-        ddyaw = -np.multiply(yaw_xy[:,0,1],yaw_xy[:,2,0]) \
-                +np.multiply(yaw_xy[:,0,0],yaw_xy[:,2,1])
-
-        for j in range(ddyaw.shape[0]):
-            ddyaw[j] = (-yaw_xy[j,0,1]*yaw_xy[j,2,0]+yaw_xy[j,0,0]*yaw_xy[j,2,1]) \
-                            /np.linalg.norm(yaw_xy[j,0,:])**2 - \
-                        2*(yaw_xy[j,0,0]*yaw_xy[j,1,0]+yaw_xy[j,0,1]*yaw_xy[j,1,1]) \
-                            /np.linalg.norm(yaw_xy[j,0,:])**2*dyaw[j]
-        
-        yaw_ret = np.zeros((yaw.shape[0],3))
-        yaw_ret[:,0] = yaw
-        yaw_ret[:,1] = dyaw
-        yaw_ret[:,2] = ddyaw
-        
-        return yaw_ret
+        """yaw, dyaw, ddyaw (S, 3) from the (cos, sin) yaw derivatives yaw_xy (S, 3, 2)"""
+        return yaw_xy_to_der(yaw_xy)
+    
+    def get_yaw_der_batch(self, yaw_xy):
+        """get_yaw_der over B trajectories, yaw_xy (B, S, 3, 2) to (B, S, 3)"""
+        return yaw_xy_to_der(yaw_xy)
 
     def check_flag_loop(self, t_set, d_ordered):
         if d_ordered.shape[0] == t_set.shape[0]*self.N_DER and t_set.shape[0] != 1:
@@ -546,6 +669,88 @@ class BaseTrajFunc(object):
         poly_coeff_yaw = np.array(poly_coeff_yaw)
         
         return poly_coeff, poly_coeff_yaw
+    
+    def get_piecewise_trajectory(self, t_set, d_ordered, d_ordered_yaw=None):
+        return PiecewiseTrajectory(self, t_set, d_ordered, d_ordered_yaw)
+
+
+class PiecewiseTrajectory(object):
+    def __init__(self, traj_func, t_set, d_ordered, d_ordered_yaw=None):
+        """Piecewise polynomial form of (t_set, d_ordered, d_ordered_yaw) for vectorized evaluation
+        
+        traj_func (BaseTrajFunc): provides der_to_poly
+        Coefficients are stored per segment in the normalized time u=(t-t_start)/t_seg,
+        all derivative orders are evaluated in one Horner pass.
+        """
+        self.t_set = np.array(t_set, dtype=np.float64)
+        self.t_cum = np.concatenate(([0.], np.cumsum(self.t_set)))
+        self.total_time = self.t_cum[-1]
+        self.N_POLY = self.t_set.shape[0]
+        
+        poly_coeff, poly_coeff_yaw = traj_func.der_to_poly(t_set, d_ordered, d_ordered_yaw)
+        self.coeff = self.get_der_coeff(poly_coeff, traj_func.MAX_SYS_DEG)
+        if np.all(d_ordered_yaw != None):
+            self.coeff_yaw = self.get_der_coeff(poly_coeff_yaw, traj_func.MAX_SYS_DEG_YAW)
+        else:
+            self.coeff_yaw = None
+        return
+    
+    def get_der_coeff(self, poly_coeff, max_der):
+        """(N_POLY, max_der+1, deg+1, dim) contiguous array, normalized coefficients of every derivative"""
+        deg = poly_coeff.shape[1]-1
+        k = np.arange(deg+1)
+        coeff_u = poly_coeff*np.power(self.t_set[:,None,None], k[None,:,None])
+        coeff = np.zeros((self.N_POLY, max_der+1, deg+1, poly_coeff.shape[2]))
+        for der in range(max_der+1):
+            coeff[:,der,:deg+1-der,:] = coeff_u[:,der:,:]*perm(k[der:], der)[None,:,None]
+        return np.ascontiguousarray(coeff)
+    
+    def get_sample_time(self, N, endpoint=True):
+        """Times of the rows of generate_sampling_matrix(t_set, N)"""
+        u = np.tile(np.arange(N)/N, self.N_POLY)
+        if endpoint:
+            u[-N:] = np.arange(N)/(N-1)
+        return self.t_cum[np.repeat(np.arange(self.N_POLY), N)]+u*np.repeat(self.t_set, N)
+    
+    def get_segment(self, t):
+        seg = np.clip(np.searchsorted(self.t_cum, t, side='right')-1, 0, self.N_POLY-1)
+        return seg, (t-self.t_cum[seg])/self.t_set[seg]
+    
+    def horner(self, coeff, t, der):
+        seg, u = self.get_segment(np.asarray(t, dtype=np.float64))
+        c = coeff[seg[:,None], np.array(der)[None,:],:,:]
+        val = c[:,:,-1,:]
+        for k in range(c.shape[2]-2,-1,-1):
+            val = val*u[:,None,None]+c[:,:,k,:]
+        return val*np.power(self.t_set[seg][:,None,None], -np.array(der)[None,:,None])
+    
+    def eval(self, t, der=0):
+        """Position derivatives at times t
+        
+        Returns:
+            (N_t, 3) np array if der is an int, (N_t, len(der), 3) otherwise
+        """
+        if np.isscalar(der):
+            return self.horner(self.coeff, t, [der])[:,0,:]
+        return self.horner(self.coeff, t, der)
+    
+    def eval_sample(self, N, der=0, endpoint=True):
+        """eval at the rows of generate_sampling_matrix(t_set, N, der)"""
+        return self.eval(self.get_sample_time(N, endpoint=endpoint), der=der)
+    
+    def eval_yaw(self, t):
+        """yaw, dyaw, ddyaw (N_t, 3) at times t from the (cos, sin) yaw polynomial, same as get_yaw_der"""
+        if self.coeff_yaw is None:
+            return np.zeros((np.asarray(t).shape[0],3))
+        return yaw_xy_to_der(self.horner(self.coeff_yaw, t, [0,1,2]))
+    
+    def get_status(self, t):
+        """(N_t, 18) pos, vel, acc, jerk, snap, yaw, dyaw, ddyaw at times t"""
+        N_t = np.asarray(t).shape[0]
+        status = np.zeros((N_t,18))
+        status[:,:15] = self.eval(t, der=[0,1,2,3,4]).reshape(N_t,15)
+        status[:,15:] = self.eval_yaw(t)
+        return status
 
 
 class TrajectoryTools(BaseTrajFunc):
@@ -807,19 +1012,11 @@ class TrajectoryTools(BaseTrajFunc):
     ###############################################################################
     def _get_sample_pos_data(self, t_set, d_ordered, d_ordered_yaw=None):
         flag_loop = self.check_flag_loop(t_set,d_ordered)
-        N_POLY = t_set.shape[0]
-        if flag_loop:
-            V_t = self.generate_sampling_matrix_loop(t_set, N=self.N_POINTS, der=0)
-            if np.all(d_ordered_yaw != None):
-                V_t_yaw = self.generate_sampling_matrix_loop_yaw(t_set, N=self.N_POINTS, der=0)
-        else:
-            V_t = self.generate_sampling_matrix(t_set, N=self.N_POINTS, der=0, endpoint=True)
-            if np.all(d_ordered_yaw != None):
-                V_t_yaw = self.generate_sampling_matrix_yaw(t_set, N=self.N_POINTS, der=0)
-        val = V_t.dot(d_ordered)
+        traj = self.get_piecewise_trajectory(t_set, d_ordered, d_ordered_yaw)
+        t_sample = traj.get_sample_time(self.N_POINTS, endpoint=not flag_loop)
+        val = traj.eval(t_sample)
         if np.all(d_ordered_yaw != None):
-            val_yaw_xy = V_t_yaw.dot(d_ordered_yaw)
-            val_yaw = np.arctan2(val_yaw_xy[:,1],val_yaw_xy[:,0])
+            val_yaw = traj.eval_yaw(t_sample)[:,0]
             return val, val_yaw
         return val, None
         
@@ -909,11 +1106,8 @@ class TrajectoryTools(BaseTrajFunc):
         
     def get_max_speed(self, t_set, d_ordered, flag_print=False):
         flag_loop = self.check_flag_loop(t_set,d_ordered)
-        if flag_loop:
-            V_t = self.generate_sampling_matrix_loop(t_set, N=self.N_POINTS, der=1)
-        else:
-            V_t = self.generate_sampling_matrix(t_set, N=self.N_POINTS, der=1, endpoint=True)
-        val = V_t.dot(d_ordered)
+        traj = self.get_piecewise_trajectory(t_set, d_ordered)
+        val = traj.eval(traj.get_sample_time(self.N_POINTS, endpoint=not flag_loop), der=1)
         val_norm = np.linalg.norm(val, axis=1, ord=2)
         max_speed = np.max(val_norm)
         if flag_print:
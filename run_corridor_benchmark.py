@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import numpy as np
+import argparse
+from pyDOE import lhs
+
+from pyTrajectoryUtils.pyTrajectoryUtils.utils import *
+from mfboTrajectory.minSnapTrajectoryPolytopes import MinSnapTrajectoryPolytopes
+from mfboTrajectory.multiFidelityModelPolytopes import get_waypoints_plane, benchmark_corridor_mode
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='corridor constraint benchmark')
+    parser.add_argument('-n', "--sample_name", type=str, help="trajectory name", default='traj_13')
+    parser.add_argument("-y", "--yaw_mode", type=int, help="assign yaw mode", default=0)
+    parser.add_argument("-o", "--qp_optimizer", type=str, help="select optimizer for quadratic programming", default='osqp')
+    parser.add_argument("-N", "--N_sample", type=int, help="number of alpha samples", default=20)
+    parser.add_argument("-s", "--seed", type=int, help="random seed", default=123)
+    parser.add_argument("-u", "--use_sim", action='store_true', help="Run run_sim_loop on every solved sample", default=False)
+    args = parser.parse_args()
+    
+    qp_optimizer = args.qp_optimizer.lower()
+    assert qp_optimizer in ['osqp', 'gurobi','cvxopt','osqp_native']
+    
+    polygon_filedir = './constraints_data'
+    polygon_filename = 'polytopes_constraints.yaml'
+    
+    poly = MinSnapTrajectoryPolytopes(drone_model="default", yaw_mode=args.yaw_mode, qp_optimizer=qp_optimizer)
+    points, plane_pos_set, t_set_sta, waypoints = get_waypoints_plane(polygon_filedir, polygon_filename, args.sample_name, flag_t_set=True)
+    
+    np.random.seed(args.seed)
+    alpha_set = lhs(t_set_sta.shape[0], args.N_sample)
+    result = benchmark_corridor_mode(poly, alpha_set, t_set_sta, points, plane_pos_set, waypoints, \
+                                     lb=0.6, ub=1.4, flag_sim=args.use_sim)
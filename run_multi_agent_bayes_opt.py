@@ -12,7 +12,7 @@ import matplotlib.pyplot as plt
 from pyTrajectoryUtils.pyTrajectoryUtils.utils import *
 from mfboTrajectory.utils import *
 from mfboTrajectory.agents_two_drones import ActiveMFDGP, TwoDrone
-from mfboTrajectory.minSnapTrajectoryPolytopes import MinSnapTrajectoryPolytopes
+from mfboTrajectory.minSnapTrajectoryPolytopes import MinSnapTrajectoryPolytopes, get_sim_pool
 from mfboTrajectory.multiFidelityModelPolytopes import get_waypoints_plane, meta_low_fidelity, get_dataset_init, check_dataset_init, meta_low_fidelity_multi, get_dataset_init_multi
 from mfboTrajectory.utilsConvexDecomp import *
 
@@ -34,6 +34,8 @@ if __name__ == "__main__":
     parser.add_argument("-m", "--max_iter", type=int, help="assign maximum iteration", default=50)
     parser.add_argument("-o", "--qp_optimizer", type=str, help="select optimizer for quadratic programming", default='osqp')
     parser.add_argument("-u", "--use_sim", action='store_true', help="Use sim for sanity check instead of differential check ", default=False)
+    parser.add_argument("-w", "--N_sim_worker", type=int, help="Number of simulator workers for optimize_alpha with --use_sim, 0 runs it sequentially", default=0)
+    parser.add_argument("-n", "--sim_native", action='store_true', help="Fly --use_sim checks with the native rollout instead of the Python simulation_core (check run_rollout_parity.py -m native first)", default=False)
     parser.add_argument("-a", "--optimize_alpha", action='store_true', help="Optimize alpha or load from file", default=False)
     parser.add_argument("-d", "--generate_dataset", action='store_true', help="Generate Dataset or load from file", default=False)
     parser.add_argument("-t", "--train_model", action='store_true', help="Train the Bayesian optimisation model or just plot output of an already trained model", default=False)
@@ -52,7 +54,7 @@ if __name__ == "__main__":
     # PARSE ARGPARSE
     # select optimizer
     qp_optimizer = args.qp_optimizer.lower()
-    assert qp_optimizer in ['osqp', 'gurobi','cvxopt']
+    assert qp_optimizer in ['osqp', 'gurobi','cvxopt','osqp_native']
     
     yaw_mode = args.yaw_mode
     sample_name_ = sample_name[args.sample_idx]
@@ -87,11 +89,16 @@ if __name__ == "__main__":
 
     
     print("Initializing dataset")
+    flag_native_sim = args.sim_native
     if args.use_sim:
-        sanity_check_t = lambda t_set, d_ordered, d_ordered_yaw: \
-            poly.run_sim_loop(t_set, d_ordered, d_ordered_yaw, plane_pos_set1, max_col_err=max_col_err, N_trial=N_trial)
+        # Each drone is checked against its own corridor, as with --N_sim_worker
+        sanity_check_t1 = lambda t_set, d_ordered, d_ordered_yaw: \
+            poly.run_sim_loop(t_set, d_ordered, d_ordered_yaw, plane_pos_set1, max_col_err=max_col_err, N_trial=N_trial, flag_native=flag_native_sim)
+        sanity_check_t2 = lambda t_set, d_ordered, d_ordered_yaw: \
+            poly.run_sim_loop(t_set, d_ordered, d_ordered_yaw, plane_pos_set2, max_col_err=max_col_err, N_trial=N_trial, flag_native=flag_native_sim)
     else:
-        sanity_check_t = None
+        sanity_check_t1 = None
+        sanity_check_t2 = None
     print("Start generating initial trajectory")
     t_set_sta1, d_ordered1, d_ordered_yaw1 = poly.update_traj(t_set_sta1, 
                                                             points1, 
@@ -128,13 +135,27 @@ if __name__ == "__main__":
     print("Done generating initial trajectory")
     if args.optimize_alpha:
         print("Start generating time optimized trajectory")
+        sim_pool = None
+        sim_kwargs1 = None
+        sim_kwargs2 = None
+        N_parallel = None
+        if args.use_sim and args.N_sim_worker > 0:
+            # Each drone is checked against its own corridor
+            sim_kwargs1 = dict(plane_pos_set=plane_pos_set1, max_col_err=max_col_err, N_trial=N_trial, flag_native=flag_native_sim)
+            sim_kwargs2 = dict(plane_pos_set=plane_pos_set2, max_col_err=max_col_err, N_trial=N_trial, flag_native=flag_native_sim)
+            # Shared by both drones, every worker keeps its own simulator
+            sim_pool = get_sim_pool(args.N_sim_worker, drone_model=drone_model, yaw_mode=yaw_mode, qp_optimizer=qp_optimizer)
+            N_parallel = args.N_sim_worker
         t_set_sim1, d_ordered1, d_ordered_yaw1, alpha_sim1 = poly.optimize_alpha(points1,  
                                                                                 t_set_sta1,  # initial time array
                                                                                 d_ordered1,  # initial position array
                                                                                 d_ordered_yaw1,  # initial yaw angle array
                                                                                 alpha_scale=1.0,  # alpha scaling
-                                                                                sanity_check_t=sanity_check_t,  # sim env to check valid trajectory
+                                                                                sanity_check_t=sanity_check_t1,  # sim env to check valid trajectory
                                                                                 flag_return_alpha=True,  # returns alpha value if true
+                                                                                sim_pool=sim_pool,  # parallel simulator search if not None
+                                                                                sim_kwargs=sim_kwargs1,
+                                                                                N_parallel=N_parallel,
                                                                                 )
 
         t_set_sim2, d_ordered2, d_ordered_yaw2, alpha_sim2 = poly.optimize_alpha(points2,  
@@ -142,11 +163,17 @@ if __name__ == "__main__":
                                                                                 d_ordered2,  # initial position array
                                                                                 d_ordered_yaw2,  # initial yaw angle array
                                                                                 alpha_scale=1.0,  # alpha scaling
-                                                                                sanity_check_t=sanity_check_t,  # sim env to check valid trajectory
+                                                                                sanity_check_t=sanity_check_t2,  # sim env to check valid trajectory
                                                                                 flag_return_alpha=True,  # returns alpha value if true
+                                                                                sim_pool=sim_pool,  # parallel simulator search if not None
+                                                                                sim_kwargs=sim_kwargs2,
+                                                                                N_parallel=N_parallel,
                                                                                 )
 
         print("alpha_sim Drone 2: {}".format(alpha_sim2))
+        if sim_pool is not None:
+            sim_pool.close()
+            sim_pool.join()
 
         # ENFORCE EQUAL SCALING
         if alpha_sim1 != alpha_sim2:
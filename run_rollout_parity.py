@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import time
+import numpy as np
+import argparse
+
+from pyTrajectoryUtils.pyTrajectoryUtils.utils import *
+from pyTrajectoryUtils.pyTrajectoryUtils.trajectorySimulation import TrajectorySimulation, StatusReference
+
+def get_circle_traj(traj_sim, N_poly, radius, t_seg):
+    # Closed circle at 1m height, waypoint velocities tangent to the circle
+    ang = np.linspace(0, 2*np.pi, N_poly+1)
+    speed = radius*2*np.pi/(N_poly*t_seg)
+    d_ordered = np.zeros(((N_poly+1)*traj_sim.N_DER,3))
+    d_ordered_yaw = np.zeros(((N_poly+1)*traj_sim.N_DER_YAW,2))
+    for i in range(N_poly+1):
+        d_ordered[i*traj_sim.N_DER,:] = [radius*np.cos(ang[i]), radius*np.sin(ang[i]), -1.]
+        d_ordered[i*traj_sim.N_DER+1,:] = [-speed*np.sin(ang[i]), speed*np.cos(ang[i]), 0.]
+        d_ordered_yaw[i*traj_sim.N_DER_YAW,:] = [np.cos(ang[i]), np.sin(ang[i])]
+    d_ordered[1,:] = 0.
+    d_ordered[-traj_sim.N_DER+1,:] = 0.
+    return np.ones(N_poly)*t_seg, d_ordered, d_ordered_yaw
+
+def run_core(traj_sim, simulation_core, status_ref, N_trial):
+    # Same initial model, clocks and integrators for both implementations
+    traj_sim.env.initialize_state()
+    traj_sim.controller.reset_state()
+    t_st = time.time()
+    debug_array = simulation_core(status_ref, N_trial=N_trial,
+                                  max_pos_err=2.0, min_pos_err=0.1,
+                                  max_yaw_err=120., min_yaw_err=60.,
+                                  freq_ctrl=200)
+    return time.time()-t_st, debug_array
+
+def run_core_batch(traj_sim, status_refs, N_trial):
+    # IMU bias random walk off as on the pybind model, the batch model draws from np.random
+    model_batch = traj_sim.get_model_batch(1)
+    model_batch.acc_bias_process = 0.
+    model_batch.gyro_bias_process = 0.
+    t_st = time.time()
+    debug_arrays = traj_sim.simulation_core_batch(status_refs, N_trial=N_trial,
+                                                  max_pos_err=2.0, min_pos_err=0.1,
+                                                  max_yaw_err=120., min_yaw_err=60.,
+                                                  freq_ctrl=200)
+    return time.time()-t_st, debug_arrays
+
+def compare_debug_array(res_ref, res, tol, name):
+    flag_pass = True
+    for trial in range(len(res_ref)):
+        for key in ["failure_idx", "failure_start_idx", "failure_end_idx"]:
+            if res_ref[trial][key] != res[trial][key]:
+                print("[{}][{}] {}: {} != {}".format(name, trial, key, res_ref[trial][key], res[trial][key]))
+                flag_pass = False
+        for key in ["time", "pos", "vel", "acc", "att", "att_q", "acc_raw", "gyro_raw", \
+                    "acc_lpf", "gyro_lpf", "ms", "ms_c", "pos_err", "yaw_err"]:
+            if res_ref[trial][key].shape != res[trial][key].shape:
+                print("[{}][{}] {}: shape {} != {}".format(name, trial, key, res_ref[trial][key].shape, res[trial][key].shape))
+                flag_pass = False
+                continue
+            err = np.max(np.abs(res_ref[trial][key]-res[trial][key]))
+            print("[{}][{}] {}: max abs diff {:.3e}".format(name, trial, key, err))
+            if not err <= tol:
+                flag_pass = False
+    return flag_pass
+
+def get_status_ref(traj_sim, t_set, d_ordered, d_ordered_yaw, freq_ctrl=200):
+    total_time = np.sum(t_set)
+    N = np.int(np.floor(total_time*freq_ctrl))
+    t_array = total_time*np.array(range(N))/N
+    traj = traj_sim.get_piecewise_trajectory(t_set, d_ordered, d_ordered_yaw)
+    status_ref = StatusReference(t_array, traj=traj, chunk_size=freq_ctrl)
+    status_ref.fill(N-1)
+    return status_ref
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='simulation_core_native / simulation_core_batch parity check against simulation_core')
+    parser.add_argument("-p", "--N_poly", type=int, help="number of segments", default=8)
+    parser.add_argument("-t", "--t_seg", type=float, help="segment time", default=1.5)
+    parser.add_argument("-r", "--radius", type=float, help="circle radius", default=3.0)
+    parser.add_argument("-n", "--N_trial", type=int, help="number of flights", default=2)
+    parser.add_argument("-m", "--mode", type=str, choices=["native", "batch", "all"], help="cores checked against simulation_core", default="all")
+    parser.add_argument("--tol", type=float, help="max abs difference allowed", default=1e-6)
+    args = parser.parse_args()
+
+    traj_sim = TrajectorySimulation()
+    # IMU bias random walk off, both runs draw from the same generator otherwise
+    model = traj_sim.env.vehicle_set[traj_sim.vehicle_id]["model"]
+    model.uav_sim.setIMUBias(0., 0., 0., 0.)
+
+    t_set, d_ordered, d_ordered_yaw = get_circle_traj(traj_sim, args.N_poly, args.radius, args.t_seg)
+    status_ref = get_status_ref(traj_sim, t_set, d_ordered, d_ordered_yaw)
+    t_py, res_py = run_core(traj_sim, traj_sim.simulation_core, status_ref, args.N_trial)
+
+    flag_pass = True
+    if args.mode in ["native", "all"]:
+        t_native, res_native = run_core(traj_sim, traj_sim.simulation_core_native, status_ref, args.N_trial)
+        flag_pass &= compare_debug_array(res_py, res_native, args.tol, "native")
+        print("simulation_core: {:.3f} s, simulation_core_native: {:.3f} s, speedup: {:.1f}x".format( \
+            t_py, t_native, t_py/t_native))
+    if args.mode in ["batch", "all"]:
+        # A second, shorter and faster reference in the same batch checks the per-flight bookkeeping
+        t_set2, d_ordered2, d_ordered_yaw2 = get_circle_traj(traj_sim, max(args.N_poly-2,2), 0.5*args.radius, 0.75*args.t_seg)
+        status_ref2 = get_status_ref(traj_sim, t_set2, d_ordered2, d_ordered_yaw2)
+        t_py2, res_py2 = run_core(traj_sim, traj_sim.simulation_core, status_ref2, args.N_trial)
+        t_batch, res_batch = run_core_batch(traj_sim, [status_ref, status_ref2], args.N_trial)
+        flag_pass &= compare_debug_array(res_py, res_batch[0], args.tol, "batch")
+        flag_pass &= compare_debug_array(res_py2, res_batch[1], args.tol, "batch2")
+        print("simulation_core: {:.3f} s, simulation_core_batch ({} flights): {:.3f} s".format( \
+            t_py+t_py2, 2*args.N_trial, t_batch))
+    if flag_pass:
+        print("Parity check passed")
+    else:
+        prRed("Parity check failed")
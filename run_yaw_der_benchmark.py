@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import time
+import numpy as np
+import argparse
+
+from pyTrajectoryUtils.pyTrajectoryUtils.utils import *
+
+def get_yaw_der_loop(yaw_xy):
+    # Row by row reference of get_yaw_der
+    yaw_ret = np.zeros((yaw_xy.shape[0],3))
+    for j in range(yaw_xy.shape[0]):
+        norm_sq = np.linalg.norm(yaw_xy[j,0,:])**2
+        yaw_ret[j,0] = np.arctan2(yaw_xy[j,0,1],yaw_xy[j,0,0])
+        yaw_ret[j,1] = (-yaw_xy[j,0,1]*yaw_xy[j,1,0]+yaw_xy[j,0,0]*yaw_xy[j,1,1])/norm_sq
+        yaw_ret[j,2] = (-yaw_xy[j,0,1]*yaw_xy[j,2,0]+yaw_xy[j,0,0]*yaw_xy[j,2,1])/norm_sq \
+            -2*(yaw_xy[j,0,0]*yaw_xy[j,1,0]+yaw_xy[j,0,1]*yaw_xy[j,1,1])/norm_sq*yaw_ret[j,1]
+    return yaw_ret
+
+def run_timer(f, N_repeat):
+    t_st = time.time()
+    for it in range(N_repeat):
+        res = f()
+    return (time.time()-t_st)/N_repeat, res
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='get_yaw_der benchmark')
+    parser.add_argument("-p", "--N_poly", type=int, help="number of segments", default=10)
+    parser.add_argument("-b", "--N_batch", type=int, help="number of trajectories of the batched variant", default=100)
+    parser.add_argument("-r", "--N_repeat", type=int, help="number of repetitions", default=20)
+    parser.add_argument("-s", "--seed", type=int, help="random seed", default=123)
+    args = parser.parse_args()
+
+    traj_func = BaseTrajFunc()
+    N_sample = traj_func.N_POINTS*args.N_poly
+    np.random.seed(args.seed)
+    yaw_xy = np.random.randn(args.N_batch, N_sample, 3, 2)
+
+    t_loop, res_loop = run_timer(lambda: get_yaw_der_loop(yaw_xy[0]), args.N_repeat)
+    t_vec, res_vec = run_timer(lambda: traj_func.get_yaw_der(yaw_xy[0]), args.N_repeat)
+    print("get_yaw_der, {} samples".format(N_sample))
+    print("  loop: {:.3e} s, vectorized: {:.3e} s, speedup: {:.1f}x, max err: {:.2e}".format( \
+        t_loop, t_vec, t_loop/t_vec, np.max(np.abs(res_loop-res_vec))))
+
+    t_seq, res_seq = run_timer(lambda: np.array([traj_func.get_yaw_der(yaw_xy[b]) for b in range(args.N_batch)]), args.N_repeat)
+    t_batch, res_batch = run_timer(lambda: traj_func.get_yaw_der_batch(yaw_xy), args.N_repeat)
+    print("get_yaw_der_batch, {} x {} samples".format(args.N_batch, N_sample))
+    print("  per trajectory: {:.3e} s, batched: {:.3e} s, speedup: {:.1f}x, max err: {:.2e}".format( \
+        t_seq, t_batch, t_seq/t_batch, np.max(np.abs(res_seq-res_batch))))